@@ -20,6 +20,9 @@ setup(name='smetcollect',
           'six',
           'click'
       ],
+      extras_require={
+          'columns': ['numpy']
+      },
       entry_points='''
         [console_scripts]
         smet-collect=smetcollect.scripts.cli:main
@@ -1,9 +1,16 @@
 from .bundle import (Bundle, BundleStatus)
 from .collect import (CollectorConfig, TweetCollector, RawImport)
-from .collect import (Compressor, CompressorConfig, Archiver, Purger, PurgerConfig, Rebuilder, Uncompressor)
+from .collect import (Compressor, CompressorConfig, Archiver, Purger, PurgerConfig, Rebuilder, Uncompressor,
+                      Verifier, VerifierConfig, DictionaryTrainer, DictionaryTrainerConfig,
+                      Compactor, CompactorConfig, Recompressor, RecompressorConfig, Partitioner, PartitionerConfig,
+                      Columnizer)
+from .collect import (DagScheduler, Pipeline, PipelineConfig, PipelineJobs, ShardedPipeline, RateBudgetLedger)
 from .process.analyze import (GenericAnalyzer, HashtagAnalyzerConfig, MetadataAnalyzerConfig,
-                              MetadataPlusAnalyzerConfig)
+                              MetadataPlusAnalyzerConfig, AggregatesAnalyzerConfig,
+                              CooccurrenceAnalyzerConfig)
+from .process.fused import (FusedProcessor, FusedProcessorConfig)
 from .process.jq import (JqEngineConfig, JqEngine)
+from .process.py import (PyEngineConfig, PyEngine)
 
 from . import bundle
 from . import process
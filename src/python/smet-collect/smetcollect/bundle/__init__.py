@@ -17,3 +17,13 @@ from .bundle import (datetime_to_results_filename, results_filename_to_datetime,
 from .bundle import (BundleStatus)
 from .bundle import (default_current_datetime_provider, default_progress_func)
 from . import status_db
+from . import archive
+from . import container
+from . import storage
+from . import pruned
+from . import columns
+from . import sketch
+from . import aggregates
+from . import cooccur
+from . import snapshot
+from .raw import RawReader
@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+aggregates.py
+
+Per-candidate, per-hour aggregates of the tweets of a race, updated as each run is analyzed.
+
+The aggregates of a race are in the sqlite db analyzed/<race>/aggregates/aggregates.db. For each candidate and hour
+(by the date of the tweet) the db holds the number of tweets, their favorite and retweet counts, and a sketch of
+their users (see sketch.HyperLogLog). Rolling-window questions, like the tweets per candidate over the last 7 days,
+are answered by summing hours, without reading the per-run files.
+
+For each candidate and hour the db also holds a space-saving summary (see sketch.SpaceSaving) of the hashtags of the
+tweets, lower-cased as in the hashtag analysis. The summaries of the hours of a window are merged to find the top
+hashtags of each candidate, with bounds on the error of each count, in memory bounded by the capacity of the
+summaries. Runs added before the hashtags were aggregated have no hashtag summaries.
+
+Consecutive runs find many of the same tweets. Each tweet of a candidate is counted once, with the favorite and
+retweet counts it had when it was first seen. The runs that have been added are recorded, so adding a run again
+changes nothing.
+"""
+
+import calendar
+import json
+import sqlite3
+from collections import OrderedDict
+
+from .bundle import twitter_date_to_epoch, aggregates_filename
+from .sketch import HyperLogLog, SpaceSaving
+
+seconds_per_hour = 3600
+
+schema = [
+    "CREATE TABLE IF NOT EXISTS runs (run TEXT PRIMARY KEY)",
+    # The empty string stands for tweets without a candidate, since NULLs are never equal in a primary key
+    "CREATE TABLE IF NOT EXISTS seen (candidate TEXT, id INTEGER, PRIMARY KEY (candidate, id))",
+    "CREATE TABLE IF NOT EXISTS hours (candidate TEXT, hour INTEGER, tweets INTEGER, favs INTEGER, retweets INTEGER, "
+    "users BLOB, PRIMARY KEY (candidate, hour))",
+    "CREATE TABLE IF NOT EXISTS hashtags (candidate TEXT, hour INTEGER, summary TEXT, PRIMARY KEY (candidate, hour))"
+]
+
+
+def datetime_to_epoch(dt):
+    """Seconds since the epoch of a naive UTC datetime"""
+    return calendar.timegm(dt.utctimetuple())
+
+
+def candidate_key(candidate):
+    return candidate if candidate is not None else ""
+
+
+def candidate_name(key):
+    return key if key != "" else None
+
+
+class HourAggregate(object):
+    """The aggregates of the tweets of one candidate in one hour"""
+
+    def __init__(self, tweets=0, favs=0, retweets=0, users=None):
+        self.tweets = tweets
+        self.favs = favs
+        self.retweets = retweets
+        self.users = users if users is not None else HyperLogLog()
+
+    def add_tweet(self, record):
+        self.tweets += 1
+        self.favs += record.get("fav") or 0
+        self.retweets += record.get("rtc") or 0
+        if record.get("uid") is not None:
+            self.users.add(record["uid"])
+
+    def merge(self, other):
+        self.tweets += other.tweets
+        self.favs += other.favs
+        self.retweets += other.retweets
+        self.users.merge(other.users)
+
+    def summary(self):
+        return OrderedDict([("tweets", self.tweets), ("favs", self.favs), ("retweets", self.retweets),
+                            ("users", self.users.count())])
+
+
+class RaceAggregates(object):
+    """The aggregates db of a race"""
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path, timeout=60)
+        with self.connection:
+            for statement in schema:
+                self.connection.execute(statement)
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def has_run(self, run_name):
+        return self.connection.execute("SELECT 1 FROM runs WHERE run = ?", (run_name,)).fetchone() is not None
+
+    def add_run(self, run_name, records):
+        """Add the tweets of the run that have not been seen before.
+        :return: A dict of candidate -> HourAggregate of the tweets that were added, or None if the run had been
+        added already
+        """
+        with self.connection:
+            if self.has_run(run_name):
+                return None
+            new_hours = {}
+            new_hashtags = {}
+            by_candidate = OrderedDict()
+            for record in records:
+                key = candidate_key(record.get("candidate"))
+                cursor = self.connection.execute("INSERT OR IGNORE INTO seen VALUES (?, ?)", (key, record["id"]))
+                if cursor.rowcount < 1:
+                    continue
+                hour = twitter_date_to_epoch(record["date"]) // seconds_per_hour * seconds_per_hour
+                new_hours.setdefault((key, hour), HourAggregate()).add_tweet(record)
+                for tag in set(hashtag.lower() for hashtag in record.get("hashtags") or []):
+                    new_hashtags.setdefault((key, hour), SpaceSaving()).add(tag)
+                by_candidate.setdefault(candidate_name(key), HourAggregate()).add_tweet(record)
+            for (key, hour), aggregate in new_hours.items():
+                row = self.connection.execute("SELECT tweets, favs, retweets, users FROM hours "
+                                              "WHERE candidate = ? AND hour = ?", (key, hour)).fetchone()
+                if row is not None:
+                    aggregate.merge(HourAggregate(row[0], row[1], row[2], HyperLogLog.from_bytes(row[3])))
+                self.connection.execute("INSERT OR REPLACE INTO hours VALUES (?, ?, ?, ?, ?, ?)",
+                                        (key, hour, aggregate.tweets, aggregate.favs, aggregate.retweets,
+                                         sqlite3.Binary(aggregate.users.to_bytes())))
+            for (key, hour), summary in new_hashtags.items():
+                row = self.connection.execute("SELECT summary FROM hashtags WHERE candidate = ? AND hour = ?",
+                                              (key, hour)).fetchone()
+                if row is not None:
+                    summary.merge(SpaceSaving.from_json(json.loads(row[0])))
+                self.connection.execute("INSERT OR REPLACE INTO hashtags VALUES (?, ?, ?)",
+                                        (key, hour, json.dumps(summary.to_json())))
+            self.connection.execute("INSERT INTO runs VALUES (?)", (run_name,))
+        return by_candidate
+
+    def hourly(self, start, end, candidate=None):
+        """Return the (candidate, hour, HourAggregate) of the hours from start up to end, by candidate and hour.
+        :param start: A naive UTC datetime
+        :param end: A naive UTC datetime
+        :param candidate: Restrict to the candidate if given
+        """
+        query = "SELECT candidate, hour, tweets, favs, retweets, users FROM hours WHERE hour >= ? AND hour < ?"
+        params = [datetime_to_epoch(start), datetime_to_epoch(end)]
+        if candidate is not None:
+            query += " AND candidate = ?"
+            params.append(candidate_key(candidate))
+        query += " ORDER BY candidate, hour"
+        for key, hour, tweets, favs, retweets, users in self.connection.execute(query, params):
+            yield candidate_name(key), hour, HourAggregate(tweets, favs, retweets, HyperLogLog.from_bytes(users))
+
+    def window(self, start, end):
+        """Return a list of the aggregates of each candidate over the hours from start up to end."""
+        by_candidate = OrderedDict()
+        for candidate, hour, aggregate in self.hourly(start, end):
+            if candidate in by_candidate:
+                by_candidate[candidate].merge(aggregate)
+            else:
+                by_candidate[candidate] = aggregate
+        result = []
+        for candidate, aggregate in by_candidate.items():
+            summary = OrderedDict([("name", candidate)])
+            summary.update(aggregate.summary())
+            result.append(summary)
+        return result
+
+    def top_hashtags(self, start, end, n=10):
+        """Return a list of the n most used hashtags of each candidate over the hours from start up to end.
+
+        Each hashtag has the count of tweets with it, which is an upper bound, and min_count, a lower bound. uses is
+        the number of hashtags of all the tweets, and a hashtag that is not listed is in at most max_error tweets.
+        """
+        by_candidate = OrderedDict()
+        query = "SELECT candidate, summary FROM hashtags WHERE hour >= ? AND hour < ? ORDER BY candidate, hour"
+        for key, data in self.connection.execute(query, (datetime_to_epoch(start), datetime_to_epoch(end))):
+            summary = SpaceSaving.from_json(json.loads(data))
+            if key in by_candidate:
+                by_candidate[key].merge(summary)
+            else:
+                by_candidate[key] = summary
+        result = []
+        for key, summary in by_candidate.items():
+            hashtags = [OrderedDict([("tag", tag), ("count", count), ("min_count", count - error)])
+                        for tag, count, error in summary.top(n)]
+            result.append(OrderedDict([("name", candidate_name(key)), ("uses", summary.total),
+                                       ("max_error", summary.floor()), ("hashtags", hashtags)]))
+        return result
@@ -0,0 +1,882 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+archive.py
+
+Reading and writing the archives that hold the compressed raw data of a run.
+
+An archive is a tar file that contains one folder, named like the run, with one file for each page of search
+results. The tar stream is cut into blocks that are compressed independently, possibly in parallel, and written one
+after the other. For bz2 and xz, a sequence of compressed streams is itself a valid compressed file, so the archives
+can be read by tar, bzip2, xz and the python 3 bz2/lzma modules. The python 2 bz2 module only reads the first
+stream, so on python 2 the archives are read with a MultiStreamBz2Reader.
+
+Archives in the frames format are not tar files, but a sequence of independently compressed pages followed by an index
+of the pages by name and search term. FramedRunReader reads single pages from them without decompressing the rest.
+Archives in the zdict format are frames compressed with a dictionary trained for the race.
+Archives in the dedup format keep the tweets and users of all the runs of a race once, in a DedupStore.
+
+Next to each archive is a manifest, <run>.manifest.json, with the size and sha256 of every page in the archive. The
+manifest lets an archive be verified by reading it once, without needing the raw data.
+
+The archives of old runs may be moved into a container (see container.py). The functions here accept the path of an
+archive in a container wherever they accept the path of an archive.
+"""
+
+import bz2
+import hashlib
+import io
+import json
+import os
+import tarfile
+import struct
+import time
+import zlib
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+import six
+
+from . import container, dedup
+from .dictionary import DictionaryStore, dictionary_kinds
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+default_codec = "bz2"
+
+# The archives of recently listed race folders, keyed by folder, with the modification time they were listed at
+listing_cache = {}
+
+
+class Bz2Codec(object):
+    """Compatible with tar -cjf"""
+    name = "bz2"
+    tar = True
+    extension = ".tar.bz2"
+    default_level = 9
+    # A multiple of the 900k blocks bzip2 uses at level 9
+    block_size = 4 * 900 * 1000
+
+    @staticmethod
+    def available():
+        return True
+
+    @staticmethod
+    def compress_block(data, level):
+        return bz2.compress(data, level)
+
+    @staticmethod
+    def decompress_block(data):
+        return bz2.decompress(data)
+
+    @staticmethod
+    def open_reader(fileobj):
+        if six.PY2:
+            # BZ2File only opens a path there, and stops after the first stream
+            return MultiStreamBz2Reader(fileobj)
+        return bz2.BZ2File(fileobj)
+
+
+class MultiStreamBz2Reader(object):
+    """A readable file object that decompresses a sequence of bz2 streams from another file object."""
+    chunk_size = 64 * 1024
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.decompressor = bz2.BZ2Decompressor()
+        self.buffer = b""
+        self.offset = 0
+
+    def fill(self):
+        """Decompress the next chunk of the file into the buffer. Return False at the end of the file."""
+        data = self.fileobj.read(self.chunk_size)
+        if not data:
+            return False
+        chunks = []
+        while data:
+            try:
+                chunks.append(self.decompressor.decompress(data))
+            except EOFError:
+                # The previous stream ended exactly at the end of the last chunk
+                self.decompressor = bz2.BZ2Decompressor()
+                continue
+            data = self.decompressor.unused_data
+            if data:
+                # The start of the next stream
+                self.decompressor = bz2.BZ2Decompressor()
+        self.buffer = self.buffer[self.offset:] + b"".join(chunks)
+        self.offset = 0
+        return True
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) - self.offset < size:
+            if not self.fill():
+                break
+        end = len(self.buffer) if size < 0 else self.offset + size
+        data = self.buffer[self.offset:end]
+        self.offset += len(data)
+        return data
+
+    def close(self):
+        # The file object belongs to the caller
+        pass
+
+
+class XzCodec(object):
+    """Slower than bz2, but with a higher compression ratio. Requires python 3."""
+    name = "xz"
+    tar = True
+    extension = ".tar.xz"
+    default_level = 6
+    block_size = 8 * 1024 * 1024
+
+    @staticmethod
+    def available():
+        return lzma is not None
+
+    @staticmethod
+    def compress_block(data, level):
+        return lzma.compress(data, preset=level)
+
+    @staticmethod
+    def decompress_block(data):
+        return lzma.decompress(data)
+
+    @staticmethod
+    def open_reader(fileobj):
+        return lzma.LZMAFile(fileobj)
+
+
+class ZstdCodec(object):
+    """Much faster than bz2 at a similar ratio. Requires the zstandard package."""
+    name = "zstd"
+    tar = True
+    extension = ".tar.zst"
+    default_level = 3
+    block_size = 8 * 1024 * 1024
+
+    @staticmethod
+    def available():
+        return zstandard is not None
+
+    @staticmethod
+    def compress_block(data, level):
+        return zstandard.ZstdCompressor(level=level).compress(data)
+
+    @staticmethod
+    def decompress_block(data):
+        return zstandard.ZstdDecompressor().decompress(data)
+
+    @staticmethod
+    def open_reader(fileobj):
+        return zstandard.ZstdDecompressor().stream_reader(fileobj, read_across_frames=True)
+
+
+class FramesCodec(object):
+    """Not a tar file, but a sequence of independently compressed pages with an index, so single pages can be read
+    without decompressing the rest of the run. See FramedRunWriter."""
+    name = "frames"
+    extension = ".frames"
+    tar = False
+    frame_codec = Bz2Codec
+    default_level = Bz2Codec.default_level
+
+    @staticmethod
+    def available():
+        return True
+
+
+class ZdictFramesCodec(object):
+    """The frames format, with each page compressed with the newest dictionary trained for the race."""
+    name = "zdict"
+    extension = ".zframes"
+    tar = False
+
+    @staticmethod
+    def available():
+        return len(dictionary_kinds()) > 0
+
+
+class DedupCodec(object):
+    """Not a tar file, but the skeletons of the pages, with the tweets and users they contain stored once for the
+    whole race in a DedupStore next to the archives. See DedupRunWriter."""
+    name = "dedup"
+    extension = ".dedup"
+    tar = False
+    default_level = 6
+
+    @staticmethod
+    def available():
+        return True
+
+
+codecs = [Bz2Codec, XzCodec, ZstdCodec, FramesCodec, ZdictFramesCodec, DedupCodec]
+
+
+def fast_codec():
+    """The codec to compress new runs with when compression must keep up with collection."""
+    return ZstdCodec.name if ZstdCodec.available() else default_codec
+
+
+def dense_codec():
+    """The codec to recompress runs that are no longer read often with, for the highest ratio."""
+    return XzCodec.name if XzCodec.available() else default_codec
+
+
+def codec_names():
+    return [codec.name for codec in codecs]
+
+
+def codec_for_name(name):
+    """Return the codec with the name. Raises ValueError if there is no such codec or it cannot be used."""
+    for codec in codecs:
+        if codec.name == name:
+            if not codec.available():
+                raise ValueError("Codec {} is not available in this python installation".format(name))
+            return codec
+    raise ValueError("Unknown codec {}. Known codecs are {}".format(name, ", ".join(codec_names())))
+
+
+def extension_for_codec(name):
+    for codec in codecs:
+        if codec.name == name:
+            return codec.extension
+    raise ValueError("Unknown codec {}. Known codecs are {}".format(name, ", ".join(codec_names())))
+
+
+def is_tar(path):
+    return codec_for_path(path).tar
+
+
+def codec_for_path(path):
+    """Return the codec of the archive at path, based on its extension."""
+    for codec in codecs:
+        if path.endswith(codec.extension):
+            return codec_for_name(codec.name)
+    raise ValueError("{} is not an archive".format(path))
+
+
+def temporary_path(path):
+    """The path an archive is written to before it is moved into place."""
+    return path + ".tmp"
+
+
+def manifest_path(path):
+    """The path of the manifest for the archive at path."""
+    return path[:-len(codec_for_path(path).extension)] + ".manifest.json"
+
+
+def page_checksum(contents):
+    return hashlib.sha256(contents).hexdigest()
+
+
+def archive_exists(path):
+    """Return True if there is an archive at path, which may be in a container."""
+    if container.split_member_path(path) is not None:
+        return container.member_exists(path)
+    return os.path.exists(path)
+
+
+def split_archive_filename(filename):
+    """Return the (run folder name, codec) of an archive filename, or None if it is not the name of an archive."""
+    for codec in codecs:
+        if filename.endswith(codec.extension):
+            return filename[:-len(codec.extension)], codec
+    return None
+
+
+def race_archive_paths(folder):
+    """Return a dict of run folder name -> path of its archive for the archives in the compressed folder of a race.
+
+    A standalone archive is preferred to one in a container, and a day container to a month container. The folder is
+    listed once, and the listing is reused until the folder changes. Archives are only added to a container from a
+    standalone archive, which is then removed, so a container only changes what is found here when the folder does.
+    """
+    try:
+        mtime = os.stat(folder).st_mtime
+    except OSError:
+        return {}
+    cached = listing_cache.get(folder)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    listed_at = time.time()
+    filenames = os.listdir(folder)
+    paths = {}
+    # From the least to the most preferred, so the preferred path is the one that remains
+    container_names = [name for name in filenames if name.endswith(container.container_extension)]
+    # Month containers have shorter names than day containers
+    for name in sorted(container_names, key=lambda name: (len(name), name)):
+        container_path = os.path.join(folder, name)
+        for member in container.read_index(container_path):
+            split = split_archive_filename(member)
+            if split is not None:
+                paths[split[0]] = os.path.join(container_path, member)
+    # Standalone archives in the reverse order of the codecs
+    standalone = []
+    for name in filenames:
+        split = split_archive_filename(name)
+        if split is not None:
+            standalone.append((codecs.index(split[1]), split[0], name))
+    for rank, run_folder, name in sorted(standalone, reverse=True):
+        paths[run_folder] = os.path.join(folder, name)
+    # A change made in the same tick of the clock as the listing does not change the modification time, so only the
+    # listing of a folder that had not changed for a while is kept
+    if listed_at - mtime > 1:
+        listing_cache[folder] = (mtime, paths)
+    return paths
+
+
+def open_archive_file(path):
+    """Open the archive at path, which may be in a container, for reading bytes."""
+    if container.split_member_path(path) is not None:
+        return container.MemberFile(path)
+    return open(path, "rb")
+
+
+def race_folder_for_archive(path):
+    """The compressed folder of the race the archive at path belongs to."""
+    split = container.split_member_path(path)
+    return os.path.dirname(split[0] if split is not None else path)
+
+
+def read_manifest(path):
+    """Return the manifest for the archive at path, or None if it does not have one."""
+    if container.split_member_path(path) is not None:
+        return container.member_manifest(path)
+    if not os.path.exists(manifest_path(path)):
+        return None
+    with io.open(manifest_path(path), "rb") as f:
+        return json.loads(f.read().decode("utf-8"))
+
+
+def write_manifest(path, codec, members):
+    """Write the manifest for the archive at path.
+    :param members: A dict of member name -> {"size": ..., "sha256": ...}
+    """
+    manifest = {"archive": os.path.basename(path), "codec": codec.name, "members": members}
+    tmp_path = temporary_path(manifest_path(path))
+    with io.open(tmp_path, "wb") as f:
+        f.write(json.dumps(manifest, sort_keys=True, indent=1).encode("utf-8"))
+    os.rename(tmp_path, manifest_path(path))
+
+
+def remove_archive(path):
+    """Remove the archive at path and its manifest. Archives in a container cannot be removed."""
+    if container.split_member_path(path) is not None:
+        raise ValueError("{} is in a container and cannot be removed on its own".format(path))
+    for file_path in [path, manifest_path(path)]:
+        if os.path.exists(file_path):
+            os.remove(file_path)
+
+
+class BlockCompressedFile(object):
+    """A write-only file object that compresses its input in independent blocks.
+
+    If a pool is provided, blocks are compressed concurrently on it. The compressed blocks are written to the
+    underlying file in order.
+    """
+
+    def __init__(self, fileobj, codec, level=None, pool=None, max_pending=None):
+        """
+        :param fileobj: The file to write the compressed data to
+        :param codec: The codec to compress with
+        :param level: The compression level, or None for the default level of the codec
+        :param pool: A multiprocessing pool to compress blocks on, or None to compress in this thread
+        :param max_pending: The number of blocks that may be waiting to be written
+        """
+        self.fileobj = fileobj
+        self.codec = codec
+        self.level = level if level is not None else codec.default_level
+        self.pool = pool
+        self.max_pending = max_pending if max_pending is not None else 8
+        self.buffer = []
+        self.buffer_size = 0
+        self.pending = deque()
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffer_size += len(data)
+        if self.buffer_size >= self.codec.block_size:
+            self.submit_buffer()
+
+    def submit_buffer(self):
+        block = b"".join(self.buffer)
+        self.buffer = []
+        self.buffer_size = 0
+        if self.pool is None:
+            self.fileobj.write(self.codec.compress_block(block, self.level))
+            return
+        self.pending.append(self.pool.apply_async(self.codec.compress_block, (block, self.level)))
+        while len(self.pending) > self.max_pending:
+            self.fileobj.write(self.pending.popleft().get())
+
+    def close(self):
+        if self.buffer_size > 0:
+            self.submit_buffer()
+        while self.pending:
+            self.fileobj.write(self.pending.popleft().get())
+        self.fileobj.close()
+
+
+@contextmanager
+def open_archive(path):
+    """Open the tar archive at path for reading its members in order. Use as a context manager."""
+    if not is_tar(path):
+        raise ValueError("{} is not a tar archive. Use indexed_reader to read it.".format(path))
+    codec = codec_for_path(path)
+    with open_archive_file(path) as f:
+        reader = codec.open_reader(f)
+        try:
+            with tarfile.open(fileobj=reader, mode="r|") as archive:
+                yield archive
+        finally:
+            reader.close()
+
+
+def extract_archive(path, folder):
+    """Extract the archive at path into folder."""
+    if not is_tar(path):
+        with indexed_reader(path) as reader:
+            reader.extract(folder)
+        return
+    with open_archive(path) as archive:
+        archive.extractall(folder)
+
+
+def archive_pages(path):
+    """Return a generator of the (filename, contents) of the pages in the archive at path, ordered by filename."""
+    for filename, contents, mtime in archive_entries(path):
+        yield filename, contents
+
+
+def archive_entries(path):
+    """Return a generator of the (filename, contents, mtime) of the pages in the archive at path, ordered by
+    filename."""
+    if not is_tar(path):
+        with indexed_reader(path) as reader:
+            for filename in sorted(reader.filenames()):
+                yield filename, reader.read_page(filename), reader.entries[filename]["mtime"]
+        return
+    # Archives made by tar -cjf are in directory order, not sorted, so read them all before sorting
+    pages = []
+    with open_archive(path) as archive:
+        for info in archive:
+            if info.isfile():
+                pages.append((os.path.basename(info.name), archive.extractfile(info).read(), info.mtime))
+    for page in sorted(pages, key=lambda page: page[0]):
+        yield page
+
+
+def archive_checksums(path):
+    """Read the archive at path once and return a dict of member name -> {"size": ..., "sha256": ...}."""
+    members = {}
+    if not is_tar(path):
+        with indexed_reader(path) as reader:
+            for filename, contents in reader.pages():
+                members[reader.member_name(filename)] = {"size": len(contents), "sha256": page_checksum(contents)}
+        return members
+    with open_archive(path) as archive:
+        for info in archive:
+            if not info.isfile():
+                continue
+            contents = archive.extractfile(info).read()
+            members[info.name] = {"size": len(contents), "sha256": page_checksum(contents)}
+    return members
+
+
+def verify_archive(path, manifest=None):
+    """Check the archive at path against its manifest.
+
+    The archive is read once and the checksum of each member is compared to the one in the manifest.
+    :param manifest: The manifest to check against. If None, the manifest stored next to the archive is used.
+    :return: A list of the problems found. Empty if the archive is ok.
+    """
+    manifest = manifest if manifest is not None else read_manifest(path)
+    if manifest is None:
+        return ["Archive {} has no manifest".format(path)]
+    try:
+        found = archive_checksums(path)
+    except (IOError, EOFError, KeyError, ValueError, zlib.error, tarfile.TarError) as e:
+        return ["Archive {} could not be read: {}".format(path, e)]
+    problems = []
+    for name, expected in sorted(manifest["members"].items()):
+        actual = found.get(name)
+        if actual is None:
+            problems.append("File {} is not in archive".format(name))
+        elif actual != expected:
+            problems.append("File {} is corrupt in archive".format(name))
+    for name in sorted(set(found.keys()) - set(manifest["members"].keys())):
+        problems.append("File {} is not in manifest".format(name))
+    return problems
+
+
+def archive_writer(path, run_folder, level=None, pool=None):
+    """Return a writer for the archive at path, for the format given by its extension.
+    :param path: The path of the archive to write
+    :param run_folder: The name of the run folder the pages belong to
+    :param level: The compression level, or None for the default level of the codec
+    :param pool: A multiprocessing pool to compress on, or None to compress in this thread
+    """
+    codec = codec_for_path(path)
+    if codec is FramesCodec:
+        return FramedRunWriter(path, run_folder, level, pool)
+    if codec is ZdictFramesCodec:
+        dictionary = DictionaryStore.for_race_folder(os.path.dirname(path)).latest()
+        if dictionary is None:
+            raise ValueError("No dictionary has been trained for the race of {}".format(path))
+        return FramedRunWriter(path, run_folder, level, pool, codec=codec, frame_codec=dictionary)
+    if codec is DedupCodec:
+        return DedupRunWriter(path, run_folder, level)
+    return RunArchiveWriter(path, run_folder, level, pool)
+
+
+class RunArchiveWriter(object):
+    """Writes the pages of a run to an archive.
+
+    The archive is written to a temporary file and only moved to its final path by close(), so a partially written
+    archive is never mistaken for a complete one. The manifest is written once the archive is in place.
+    """
+
+    def __init__(self, path, run_folder, level=None, pool=None):
+        """
+        :param path: The path of the archive to write. The extension determines the codec.
+        :param run_folder: The name of the folder that contains the pages in the archive
+        :param level: The compression level, or None for the default level of the codec
+        :param pool: A multiprocessing pool to compress blocks on, or None to compress in this thread
+        """
+        self.path = path
+        self.run_folder = run_folder
+        self.codec = codec_for_path(path)
+        self.members = {}
+        self.compressed_file = BlockCompressedFile(open(temporary_path(path), "wb"), self.codec, level, pool)
+        self.tar = tarfile.open(fileobj=self.compressed_file, mode="w|")
+        self.add_folder()
+
+    def add_folder(self):
+        info = tarfile.TarInfo(self.run_folder)
+        info.type = tarfile.DIRTYPE
+        info.mode = 0o755
+        info.mtime = time.time()
+        self.tar.addfile(info)
+
+    def add_page(self, filename, contents, mtime=None):
+        """Add one page to the archive.
+        :param filename: The name of the page file
+        :param contents: The bytes of the page
+        :param mtime: The modification time to record for the page
+        """
+        info = tarfile.TarInfo(os.path.join(self.run_folder, filename))
+        info.size = len(contents)
+        info.mode = 0o644
+        info.mtime = mtime if mtime is not None else time.time()
+        self.tar.addfile(info, io.BytesIO(contents))
+        self.members[info.name] = {"size": len(contents), "sha256": page_checksum(contents)}
+
+    def close(self):
+        """Finish the archive, move it into place and write its manifest."""
+        self.tar.close()
+        self.compressed_file.close()
+        os.rename(temporary_path(self.path), self.path)
+        write_manifest(self.path, self.codec, self.members)
+
+    def abort(self):
+        """Discard the archive."""
+        self.tar.close()
+        self.compressed_file.close()
+        os.remove(temporary_path(self.path))
+
+    def verify(self):
+        """Check the written archive against its manifest. Returns a list of the problems found."""
+        return verify_archive(self.path)
+
+
+frames_magic = b"SMETFRM1"
+frames_footer = struct.Struct(">Q8s")
+
+
+def page_term(contents):
+    """The search query of a page of search results, or None if it is not one."""
+    try:
+        return json.loads(contents.decode("utf-8"))["search_metadata"]["query"]
+    except (ValueError, KeyError, TypeError):
+        return None
+
+
+class FramedRunWriter(object):
+    """Writes the pages of a run to a framed file.
+
+    A framed file is the magic bytes, followed by each page compressed on its own (a frame), then a json index with
+    the name, search term, offset and length of each frame, and finally the offset of the index and the magic bytes
+    again. Like RunArchiveWriter, the file is written to a temporary path and moved into place by close().
+    """
+
+    def __init__(self, path, run_folder, level=None, pool=None, max_pending=None, codec=FramesCodec,
+                 frame_codec=None):
+        """
+        :param path: The path of the file to write
+        :param run_folder: The name of the run folder the pages belong to
+        :param level: The compression level, or None for the default level of the codec
+        :param pool: A multiprocessing pool to compress frames on, or None to compress in this thread
+        :param max_pending: The number of frames that may be waiting to be written
+        :param codec: The codec of the file (FramesCodec or ZdictFramesCodec)
+        :param frame_codec: The codec to compress each frame with. Defaults to that of the codec.
+        """
+        self.path = path
+        self.run_folder = run_folder
+        self.codec = codec
+        self.frame_codec = frame_codec if frame_codec is not None else FramesCodec.frame_codec
+        self.level = level if level is not None else self.frame_codec.default_level
+        self.pool = pool
+        self.max_pending = max_pending if max_pending is not None else 8
+        self.pending = deque()
+        self.index = []
+        self.members = {}
+        self.file = open(temporary_path(path), "wb")
+        self.file.write(frames_magic)
+        self.offset = len(frames_magic)
+
+    def add_page(self, filename, contents, mtime=None):
+        """Add one page to the file.
+        :param filename: The name of the page file
+        :param contents: The bytes of the page
+        :param mtime: The modification time to record for the page
+        """
+        entry = OrderedDict([("name", filename), ("term", page_term(contents)), ("size", len(contents)),
+                             ("mtime", mtime if mtime is not None else time.time())])
+        self.members[os.path.join(self.run_folder, filename)] = {"size": len(contents),
+                                                                 "sha256": page_checksum(contents)}
+        if self.pool is None:
+            self.write_frame(entry, self.frame_codec.compress_block(contents, self.level))
+            return
+        self.pending.append((entry, self.pool.apply_async(self.frame_codec.compress_block, (contents, self.level))))
+        while len(self.pending) > self.max_pending:
+            self.write_pending_frame()
+
+    def write_pending_frame(self):
+        entry, result = self.pending.popleft()
+        self.write_frame(entry, result.get())
+
+    def write_frame(self, entry, frame):
+        entry["offset"] = self.offset
+        entry["length"] = len(frame)
+        self.file.write(frame)
+        self.offset += len(frame)
+        self.index.append(entry)
+
+    def close(self):
+        """Write the index, move the file into place and write its manifest."""
+        while self.pending:
+            self.write_pending_frame()
+        index = OrderedDict([("run", self.run_folder), ("frame_codec", self.frame_codec.name),
+                             ("dictionary", getattr(self.frame_codec, "version", None)), ("pages", self.index)])
+        self.file.write(json.dumps(index, separators=(',', ':')).encode("utf-8"))
+        self.file.write(frames_footer.pack(self.offset, frames_magic))
+        self.file.close()
+        os.rename(temporary_path(self.path), self.path)
+        write_manifest(self.path, self.codec, self.members)
+
+    def abort(self):
+        """Discard the file."""
+        self.file.close()
+        os.remove(temporary_path(self.path))
+
+    def verify(self):
+        """Check the written file against its manifest. Returns a list of the problems found."""
+        return verify_archive(self.path)
+
+
+class IndexedRunReader(object):
+    """Random access to the pages of an archive that is not a tar file. Use as a context manager or call close().
+
+    Subclasses set run_folder and entries, an OrderedDict of page filename -> dict with at least the mtime, and
+    implement read_page and close.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        pass
+
+    def filenames(self):
+        """The names of the pages, in the order they were written."""
+        return list(self.entries.keys())
+
+    def member_name(self, filename):
+        """The path of the page within the run, as it would be in a tar archive."""
+        return os.path.join(self.run_folder, filename)
+
+    def read_page(self, filename):
+        """Return the contents of one page. Raises KeyError if there is no page with the name."""
+        raise NotImplementedError()
+
+    def pages(self):
+        """Return a generator of the (filename, contents) of all the pages."""
+        for filename in self.entries.keys():
+            yield filename, self.read_page(filename)
+
+    def extract(self, folder):
+        """Write the pages to the run folder in folder, like extracting a tar archive would."""
+        run_path = os.path.join(folder, self.run_folder)
+        if not os.path.exists(run_path):
+            os.makedirs(run_path)
+        for filename, contents in self.pages():
+            page_path = os.path.join(run_path, filename)
+            with io.open(page_path, "wb") as f:
+                f.write(contents)
+            mtime = self.entries[filename]["mtime"]
+            os.utime(page_path, (mtime, mtime))
+
+
+def indexed_reader(path):
+    """Return the reader for the archive at path, which must not be a tar archive."""
+    codec = codec_for_path(path)
+    if codec is FramesCodec or codec is ZdictFramesCodec:
+        return FramedRunReader(path)
+    if codec is DedupCodec:
+        return DedupRunReader(path)
+    raise ValueError("{} is a tar archive. Use open_archive to read it.".format(path))
+
+
+class FramedRunReader(IndexedRunReader):
+    """Random access to the pages of a framed file."""
+
+    def __init__(self, path):
+        """
+        :param path: The path of the framed file. Raises ValueError if it is not a framed file.
+        """
+        self.path = path
+        self.file = open_archive_file(path)
+        try:
+            self.index = self.read_index()
+            self.frame_codec = self.read_frame_codec()
+        except Exception:
+            self.file.close()
+            raise
+        self.run_folder = self.index["run"]
+        self.entries = OrderedDict((entry["name"], entry) for entry in self.index["pages"])
+
+    def read_index(self):
+        self.file.seek(0, os.SEEK_END)
+        end = self.file.tell()
+        if end < len(frames_magic) + frames_footer.size:
+            raise ValueError("{} is not a framed file".format(self.path))
+        self.file.seek(end - frames_footer.size)
+        index_offset, magic = frames_footer.unpack(self.file.read(frames_footer.size))
+        if magic != frames_magic or index_offset > end - frames_footer.size:
+            raise ValueError("{} is not a framed file".format(self.path))
+        self.file.seek(index_offset)
+        index_bytes = self.file.read(end - frames_footer.size - index_offset)
+        return json.loads(index_bytes.decode("utf-8"), object_pairs_hook=OrderedDict)
+
+    def read_frame_codec(self):
+        if self.index.get("dictionary") is None:
+            return codec_for_name(self.index["frame_codec"])
+        dictionaries = DictionaryStore.for_race_folder(race_folder_for_archive(self.path))
+        return dictionaries.get(self.index["dictionary"])
+
+    def close(self):
+        self.file.close()
+
+    def terms(self):
+        """The search queries of the pages, as sent to twitter (e.g., %23chicago)."""
+        return sorted(set(entry["term"] for entry in self.entries.values() if entry["term"] is not None))
+
+    def read_frame(self, entry):
+        self.file.seek(entry["offset"])
+        return self.frame_codec.decompress_block(self.file.read(entry["length"]))
+
+    def read_page(self, filename):
+        """Return the contents of one page. Raises KeyError if there is no page with the name."""
+        return self.read_frame(self.entries[filename])
+
+    def pages_for_term(self, term):
+        """Return a generator of the (filename, contents) of the pages for the search query term."""
+        for filename, entry in self.entries.items():
+            if entry["term"] == term:
+                yield filename, self.read_frame(entry)
+
+
+class DedupRunWriter(object):
+    """Writes the pages of a run as skeletons, with their tweets and users in the DedupStore of the race.
+
+    The objects are committed to the store before the skeleton file is moved into place, so the skeletons never
+    refer to missing objects. Objects are not removed from the store when a run is deleted.
+    """
+
+    def __init__(self, path, run_folder, level=None):
+        """
+        :param path: The path of the skeleton file to write
+        :param run_folder: The name of the run folder the pages belong to
+        :param level: The zlib compression level, or None for the default
+        """
+        self.path = path
+        self.run_folder = run_folder
+        self.codec = DedupCodec
+        self.level = level if level is not None else DedupCodec.default_level
+        self.store = dedup.DedupStore(os.path.join(os.path.dirname(path), dedup.store_filename), self.level)
+        self.index = []
+        self.members = {}
+
+    def add_page(self, filename, contents, mtime=None):
+        """Add one page to the run.
+        :param filename: The name of the page file
+        :param contents: The bytes of the page
+        :param mtime: The modification time to record for the page
+        """
+        self.index.append(OrderedDict([("name", filename), ("mtime", mtime if mtime is not None else time.time()),
+                                       ("skeleton", self.store.split_page(contents))]))
+        self.members[os.path.join(self.run_folder, filename)] = {"size": len(contents),
+                                                                 "sha256": page_checksum(contents)}
+
+    def close(self):
+        """Commit the objects, move the skeleton file into place and write its manifest."""
+        self.store.commit()
+        self.store.close()
+        skeletons = OrderedDict([("run", self.run_folder), ("pages", self.index)])
+        with open(temporary_path(self.path), "wb") as f:
+            f.write(zlib.compress(json.dumps(skeletons, separators=(',', ':')).encode("utf-8"), self.level))
+        os.rename(temporary_path(self.path), self.path)
+        write_manifest(self.path, self.codec, self.members)
+
+    def abort(self):
+        """Discard the run."""
+        self.store.close()
+
+    def verify(self):
+        """Check the written run against its manifest. Returns a list of the problems found."""
+        return verify_archive(self.path)
+
+
+class DedupRunReader(IndexedRunReader):
+    """Reconstructs the pages of a run from its skeletons and the DedupStore of the race."""
+
+    def __init__(self, path):
+        """
+        :param path: The path of the skeleton file
+        """
+        self.path = path
+        with open_archive_file(path) as f:
+            skeletons = dedup.loads(zlib.decompress(f.read()))
+        self.run_folder = skeletons["run"]
+        self.entries = OrderedDict((entry["name"], entry) for entry in skeletons["pages"])
+        self.store = dedup.DedupStore(os.path.join(race_folder_for_archive(path), dedup.store_filename))
+
+    def close(self):
+        self.store.close()
+
+    def read_page(self, filename):
+        """Return the contents of one page. Raises KeyError if there is no page with the name."""
+        return self.store.join_page(self.entries[filename]["skeleton"])
@@ -11,6 +11,7 @@ A bundle is a directory with a particular structure:
 [bundle root]/      -- Any directory
     raw/            -- The raw search results from twitter
     pruned/         -- The raw search results pruned down to the core fields
+    columns/        -- The pruned tweets of each race as memory-mappable columns
     config.yaml     -- The configuration that describes the races
     credentials.yaml - Credentials for twitter
     status.db       -- The db that maintains the status for the raw data
@@ -20,12 +21,24 @@ Copyright (c) 2015 Chandrasekhar Ramakrishnan. All rights reserved.
 """
 
 from datetime import datetime
+import calendar
 import os
+import time
 
 from sqlalchemy import create_engine
 
 from .status_db import Session, Base, get_or_create, Race, Candidate, SearchTerm
 from . import config_file
+from . import archive
+from . import container
+from . import pruned
+from . import storage
+from .raw import RawReader
+from .snapshot import ConfigSnapshot
+
+aggregates_filename = "aggregates.db"
+# Seconds to wait for another connection, e.g., of a pipeline worker process, to release a lock on the status db
+status_db_timeout = 60
 
 
 def default_progress_func(structure_msg):
@@ -57,6 +70,16 @@ def run_folder_name_to_datetime(filename):
     return datetime.strptime(filename, "%Y-%m-%d-%H-%M-%S-%f_run")
 
 
+def twitter_date_to_epoch(date_str):
+    """Convert a date of the form 'Wed Aug 05 18:48:36 +0000 2015' to seconds since the epoch."""
+    parts = date_str.split(" ")
+    offset = parts.pop(4)
+    seconds = calendar.timegm(time.strptime(" ".join(parts), "%a %b %d %H:%M:%S %Y"))
+    sign = -1 if offset[0] == "-" else 1
+    offset_seconds = sign * (int(offset[1:3]) * 3600 + int(offset[3:5]) * 60)
+    return seconds - offset_seconds
+
+
 def slug_for_race(race):
     return slug_for_string(race.name)
 
@@ -66,8 +89,14 @@ def slug_for_string(s):
 
 
 def ensure_folder_exists(folder):
-    if not os.path.isdir(folder):
+    if os.path.isdir(folder):
+        return
+    try:
         os.makedirs(folder)
+    except OSError:
+        # Another thread or process may have created it in the meantime
+        if not os.path.isdir(folder):
+            raise
 
 
 # TODO rename to BasicCollectBundle
@@ -103,7 +132,8 @@ class Bundle(object):
         if self._collector_status_engine:
             return self._collector_status_engine
         if self.status_db_path is not None:
-            self._collector_status_engine = create_engine('sqlite:///{}'.format(self.status_db_path))
+            self._collector_status_engine = create_engine('sqlite:///{}'.format(self.status_db_path),
+                                                          connect_args={"timeout": status_db_timeout})
         else:
             # The in-memory db is sed for testing
             self._collector_status_engine = create_engine('sqlite:///:memory:')
@@ -120,6 +150,7 @@ class BundleStatus(object):
         :param config: A dictionary with configuration parameters. Keys include:
             datetime_provider : Return a function that gives the current time
             progress_func : A function invoked as progress occurs.
+            raw_storage : The name of the storage to write raw pages with (see storage.storage_names())
         """
         # TODO Rename to basic_bundle
         self.bundle = smet_bundle
@@ -129,9 +160,11 @@ class BundleStatus(object):
         self.datetime_provider = config["datetime_provider"] if config.get("datetime_provider") is not None \
             else default_current_datetime_provider
         self.progress_func = config["progress_func"] if config.get("progress_func") else default_progress_func
+        self.raw_storage = storage.storage_for_name(config.get("raw_storage") or storage.default_storage)
 
         Session.configure(bind=self.engine)
         self.session = Session()
+        self._snapshot = None
 
     def create_tables(self):
         """Create the tables if they have not been initialized"""
@@ -166,10 +199,20 @@ class BundleStatus(object):
                     search_term.active = True
         # TODO: need to handle races/candidates/terms being removed
         self.session.commit()
+        self._snapshot = None
 
     def races(self):
         return self.session.query(Race).all()
 
+    def snapshot(self):
+        """Return a snapshot of the races, candidates and search terms (see snapshot.py).
+
+        The snapshot is loaded once and shared by everything that uses this status, until the config is synced again.
+        """
+        if self._snapshot is None:
+            self._snapshot = ConfigSnapshot(self.session)
+        return self._snapshot
+
     def raw_data_folder_path_from_root_for_race(self, root, race):
         return os.path.join(root, "raw", race.slug)
 
@@ -182,6 +225,12 @@ class BundleStatus(object):
     def compressed_data_folder_path_for_race(self, race):
         return os.path.join(self.output_path, "compressed", race.slug)
 
+    def dictionary_folder_path_for_race(self, race):
+        return os.path.join(self.output_path, "dictionaries", race.slug)
+
+    def columns_folder_path_for_race(self, race):
+        return os.path.join(self.output_path, "columns", race.slug)
+
     def analyzed_data_folder_path(self):
         return os.path.join(self.output_path, "analyzed")
 
@@ -211,6 +260,10 @@ class BundleStatus(object):
         path_components = self.analysis_result_path_components(race, analysis_type, run, results_type)
         return self.path_from_components(path_components)
 
+    def aggregates_path_for_race(self, race):
+        """The path of the db with the rolling aggregates of the race (see aggregates.py)"""
+        return os.path.join(self.analysis_result_path(race, "aggregates"), aggregates_filename)
+
     def raw_data_folder_path_for_run(self, race, run):
         return os.path.join(self.raw_data_folder_path_for_race(race), run.results_folder)
 
@@ -222,22 +275,40 @@ class BundleStatus(object):
         return self.path_from_components(self.pruned_data_file_path_components(race, run))
 
     def robust_pruned_data_file_path_for_run(self, run):
-        """Return the file path as a folder if it exists, otherwise as json."""
+        """Return the file path as a folder if it exists, otherwise as json or gzipped json."""
         pruned_data_path = self.pruned_data_file_path_for_run(run.race, run)
         if os.path.exists(pruned_data_path):
             return pruned_data_path
-        pruned_data_json = pruned_data_path + ".json"
-        if os.path.exists(pruned_data_json):
-            return pruned_data_json
-        return None
+        return pruned.pruned_file_path(pruned_data_path)
 
     def has_pruned_data_for_run(self, race, run):
-        pruned_data_path = self.pruned_data_file_path_for_run(race, run)
-        pruned_data_json = pruned_data_path + ".json"
-        return os.path.exists(pruned_data_path) or os.path.exists(pruned_data_json)
+        """Return True if the run has been pruned, whether into its own file or into a partition."""
+        return pruned.has_pruned_run(self.pruned_data_file_path_for_run(race, run))
 
-    def compressed_data_file_path_for_run(self, race, run):
-        return os.path.join(self.compressed_data_folder_path_for_race(race), run.results_folder + ".tar.bz2")
+    def compressed_data_file_path_for_run(self, race, run, codec=None):
+        """Return the path of the archive for the run.
+
+        If no codec is given, this is the path of the existing archive, whatever its codec, or the path for the
+        default codec if there is no archive yet. An archive that has been moved into a container is found there. The
+        archives of a race are found from one listing of its folder (see archive.race_archive_paths).
+        """
+        race_folder = self.compressed_data_folder_path_for_race(race)
+        archive_path = os.path.join(race_folder, run.results_folder)
+        if codec is not None:
+            return archive_path + archive.extension_for_codec(codec)
+        path = archive.race_archive_paths(race_folder).get(run.results_folder)
+        return path if path is not None else archive_path + archive.extension_for_codec(archive.default_codec)
+
+    def container_path_for_run(self, race, run, period):
+        """Return the path of the container for the day or month (period) of the run."""
+        run_datetime = run_folder_name_to_datetime(run.results_folder)
+        return os.path.join(self.compressed_data_folder_path_for_race(race),
+                            container.container_filename(period, run_datetime))
+
+    def raw_reader(self, race, run):
+        """Return a RawReader for the pages of the run, from the raw folder or the archive."""
+        return RawReader(self.raw_data_folder_path_for_run(race, run),
+                         self.compressed_data_file_path_for_run(race, run))
 
     def polls_data_folder_path_for_race(self, race):
         return os.path.join(self.polls_data_folder_path(), race.slug)
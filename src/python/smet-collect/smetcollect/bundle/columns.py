@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+columns.py
+
+The pruned tweets of a race as columns, for analyses that only need a few fields of each tweet.
+
+The columns of a race are in columns/<race>/. Each numeric field of the pruned tweets is a file of little-endian
+64 bit integers, <field>.bin, with one value per tweet. Dates are seconds since the epoch, and a missing value (e.g.,
+the rt_ fields of a tweet that is not a retweet) is -1. The candidate, user and run of each tweet are stored as 32 bit
+codes into dictionaries, with -1 for none. The hashtags of all tweets are codes in hashtags.bin; the hashtags of
+tweet i are those from hashtag_offsets[i] to hashtag_offsets[i + 1]. meta.json holds the number of tweets, the
+dtype of each column, the dictionaries and the runs in the store.
+
+Runs are only appended. The column files are written first and meta.json last, so values past the count in
+meta.json, left by an append that was interrupted, are ignored, and cut off by the next append.
+
+Writing only needs the standard library. Reading needs numpy; the columns are memory mapped, so they are not copied.
+"""
+
+import io
+import json
+import os
+import struct
+from collections import OrderedDict
+
+from .bundle import twitter_date_to_epoch, ensure_folder_exists
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+meta_filename = "meta.json"
+numeric_fields = ["id", "date", "fav", "rtc", "uid", "ufol",
+                  "rt_id", "rt_date", "rt_fav", "rt_rtc", "rt_uid", "rt_ufol"]
+date_fields = ["date", "rt_date"]
+coded_fields = ["candidate", "u", "run"]
+column_dtypes = OrderedDict([(field, "<i8") for field in numeric_fields] +
+                            [(field, "<i4") for field in coded_fields] +
+                            [("hashtags", "<i4"), ("hashtag_offsets", "<i8")])
+struct_codes = {"<i8": "q", "<i4": "i"}
+
+
+def struct_format(dtype, length=1):
+    """The struct format of length values of the numpy dtype"""
+    return "{}{}{}".format(dtype[0], length, struct_codes[dtype])
+
+
+def column_path(folder, name):
+    return os.path.join(folder, name + ".bin")
+
+
+def read_meta(folder):
+    """Return the meta data of the columns in the folder, or None if there are none."""
+    path = os.path.join(folder, meta_filename)
+    if not os.path.exists(path):
+        return None
+    with io.open(path, "rb") as f:
+        return json.loads(f.read().decode("utf-8"), object_pairs_hook=OrderedDict)
+
+
+def empty_meta():
+    return OrderedDict([("count", 0), ("hashtag_count", 0), ("dtypes", column_dtypes),
+                        ("dictionaries", OrderedDict((name, []) for name in coded_fields + ["hashtags"])),
+                        ("runs", [])])
+
+
+def column_length(meta, name):
+    """The number of values in the column"""
+    if name == "hashtags":
+        return meta["hashtag_count"]
+    if name == "hashtag_offsets":
+        return meta["count"] + 1
+    return meta["count"]
+
+
+def numeric_value(record, field):
+    value = record.get(field)
+    if value is None:
+        return -1
+    if field in date_fields:
+        return twitter_date_to_epoch(value)
+    return int(value)
+
+
+class ColumnWriter(object):
+    """Appends the pruned tweets of runs to the columns of a race."""
+
+    def __init__(self, folder):
+        self.folder = folder
+        ensure_folder_exists(folder)
+        self.meta = read_meta(folder) or empty_meta()
+        self.codes = dict((name, dict((value, code) for code, value in enumerate(values)))
+                          for name, values in self.meta["dictionaries"].items())
+        self.runs = set(self.meta["runs"])
+        self.truncate()
+
+    def truncate(self):
+        """Cut off the values written by an append that did not finish."""
+        for name, dtype in self.meta["dtypes"].items():
+            path = column_path(self.folder, name)
+            with io.open(path, "ab") as f:
+                if name == "hashtag_offsets" and self.meta["count"] == 0:
+                    # The offsets start with the 0 of the first tweet
+                    f.truncate(0)
+                    f.write(struct.pack(struct_format(dtype), 0))
+                else:
+                    f.truncate(column_length(self.meta, name) * struct.calcsize(struct_format(dtype)))
+
+    def code(self, name, value):
+        if value is None:
+            return -1
+        codes = self.codes[name]
+        if value not in codes:
+            codes[value] = len(codes)
+            self.meta["dictionaries"][name].append(value)
+        return codes[value]
+
+    def has_run(self, run_name):
+        return run_name in self.runs
+
+    def add_run(self, run_name, records):
+        """Append the pruned tweets of the run. The run is visible to readers after close()."""
+        columns = OrderedDict((name, []) for name in self.meta["dtypes"].keys())
+        hashtag_count = self.meta["hashtag_count"]
+        for record in records:
+            for field in numeric_fields:
+                columns[field].append(numeric_value(record, field))
+            columns["candidate"].append(self.code("candidate", record.get("candidate")))
+            columns["u"].append(self.code("u", record.get("u")))
+            columns["run"].append(self.code("run", run_name))
+            for hashtag in record.get("hashtags") or []:
+                columns["hashtags"].append(self.code("hashtags", hashtag))
+            hashtag_count += len(record.get("hashtags") or [])
+            columns["hashtag_offsets"].append(hashtag_count)
+        for name, values in columns.items():
+            dtype = self.meta["dtypes"][name]
+            with io.open(column_path(self.folder, name), "ab") as f:
+                f.write(struct.pack(struct_format(dtype, len(values)), *values))
+        self.meta["count"] += len(records)
+        self.meta["hashtag_count"] = hashtag_count
+        self.meta["runs"].append(run_name)
+        self.runs.add(run_name)
+
+    def close(self):
+        """Write the meta data, making the added runs visible."""
+        path = os.path.join(self.folder, meta_filename)
+        with io.open(path + ".tmp", "wb") as f:
+            f.write(json.dumps(self.meta).encode("utf-8"))
+        os.rename(path + ".tmp", path)
+
+
+class ColumnStore(object):
+    """Reads the columns of a race as numpy arrays that are memory mapped from the column files."""
+
+    def __init__(self, folder):
+        if numpy is None:
+            raise ImportError("Reading columns requires numpy")
+        self.folder = folder
+        self.meta = read_meta(folder)
+        if self.meta is None:
+            raise IOError("No columns in {}".format(folder))
+
+    @property
+    def count(self):
+        """The number of tweets"""
+        return self.meta["count"]
+
+    @property
+    def runs(self):
+        return list(self.meta["runs"])
+
+    def column(self, name):
+        """Return the values of the column as a read-only array."""
+        dtype = numpy.dtype(self.meta["dtypes"][name])
+        length = column_length(self.meta, name)
+        if length == 0:
+            return numpy.zeros(0, dtype=dtype)
+        return numpy.memmap(column_path(self.folder, name), dtype=dtype, mode="r", shape=(length,))
+
+    def dictionary(self, name):
+        """Return the values of the codes of a coded column (candidate, u, run or hashtags)."""
+        return list(self.meta["dictionaries"][name])
+
+    def code(self, name, value):
+        """Return the code of the value in a coded column, or -1 if no tweet has the value."""
+        try:
+            return self.meta["dictionaries"][name].index(value)
+        except ValueError:
+            return -1
+
+    def hashtags(self, i):
+        """Return the hashtag codes of tweet i."""
+        offsets = self.column("hashtag_offsets")
+        return self.column("hashtags")[offsets[i]:offsets[i + 1]]
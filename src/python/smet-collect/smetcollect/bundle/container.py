@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+container.py
+
+Containers that hold the archives of many runs in one file.
+
+Hourly collection produces thousands of small run archives per race. Compaction moves the archives of old runs into
+one container per day or month. A container is the archives, copied unchanged one after the other, followed by an
+index of the name, offset, length and manifest of each archive. An archive in a container is addressed by a path
+that treats the container like a folder, e.g. compressed/<race>/2016-03.container/<run>.tar.bz2.
+
+Archives are added to an existing container by appending them and a new index after the old index, so the archives
+already in the container are not copied again. The old index is left in place, unused.
+"""
+
+import io
+import json
+import os
+import struct
+from collections import OrderedDict
+
+container_extension = ".container"
+container_magic = b"SMETCNT1"
+container_footer = struct.Struct(">Q8s")
+
+# The formats of the period of a container, by period type
+period_formats = {"day": "%Y-%m-%d", "month": "%Y-%m"}
+
+# Indexes of recently read containers, keyed by path, with the modification time and size they were read at
+index_cache = {}
+
+
+def container_filename(period_type, dt):
+    """The filename of the container for the period of type period_type (day or month) that includes dt."""
+    return dt.strftime(period_formats[period_type]) + container_extension
+
+
+def split_member_path(path):
+    """If path is an archive in a container, return the (container path, archive name). Otherwise return None."""
+    parent = os.path.dirname(path)
+    if parent.endswith(container_extension):
+        return parent, os.path.basename(path)
+    return None
+
+
+def read_index(container_path):
+    """Return the index of the container: an OrderedDict of archive name -> dict with offset, length and manifest."""
+    stat = os.stat(container_path)
+    cached = index_cache.get(container_path)
+    if cached is not None and cached[0] == (stat.st_mtime, stat.st_size):
+        return cached[1]
+    with io.open(container_path, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        end = f.tell()
+        if end < len(container_magic) + container_footer.size:
+            raise ValueError("{} is not a container".format(container_path))
+        f.seek(end - container_footer.size)
+        index_offset, magic = container_footer.unpack(f.read(container_footer.size))
+        if magic != container_magic or index_offset > end - container_footer.size:
+            raise ValueError("{} is not a container".format(container_path))
+        f.seek(index_offset)
+        index_bytes = f.read(end - container_footer.size - index_offset)
+    index = json.loads(index_bytes.decode("utf-8"), object_pairs_hook=OrderedDict)["archives"]
+    index_cache[container_path] = ((stat.st_mtime, stat.st_size), index)
+    return index
+
+
+def member_exists(path):
+    """Return True if path is an archive in a container that exists."""
+    container_path, name = split_member_path(path)
+    return os.path.isfile(container_path) and name in read_index(container_path)
+
+
+def member_manifest(path):
+    container_path, name = split_member_path(path)
+    return read_index(container_path)[name]["manifest"]
+
+
+class MemberFile(object):
+    """A read-only file object for an archive in a container."""
+
+    def __init__(self, path):
+        container_path, name = split_member_path(path)
+        entry = read_index(container_path)[name]
+        self.start = entry["offset"]
+        self.length = entry["length"]
+        self.position = 0
+        self.file = io.open(container_path, "rb")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def read(self, size=-1):
+        remaining = self.length - self.position
+        size = remaining if size is None or size < 0 else min(size, remaining)
+        self.file.seek(self.start + self.position)
+        data = self.file.read(size)
+        self.position += len(data)
+        return data
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence == os.SEEK_END:
+            offset += self.length
+        self.position = max(0, min(offset, self.length))
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def close(self):
+        self.file.close()
+
+    @property
+    def closed(self):
+        return self.file.closed
+
+
+class ContainerWriter(object):
+    """Writes a container, or adds archives to an existing one.
+
+    A new container is written to a temporary file and moved into place by close(). Archives added to an existing
+    container are appended to it, and the container is cut back to its old end by abort().
+    """
+
+    def __init__(self, path, chunk_size=1024 * 1024):
+        """
+        :param path: The path of the container to write. If there is a container there, archives are added to it.
+        :param chunk_size: The size of the chunks archives are copied in
+        """
+        self.path = path
+        self.chunk_size = chunk_size
+        if os.path.exists(path):
+            self.tmp_path = None
+            self.index = OrderedDict(read_index(path))
+            self.file = io.open(path, "r+b")
+            self.file.seek(0, os.SEEK_END)
+            self.offset = self.start_size = self.file.tell()
+            return
+        self.tmp_path = path + ".tmp"
+        self.index = OrderedDict()
+        self.file = io.open(self.tmp_path, "wb")
+        self.file.write(container_magic)
+        self.offset = len(container_magic)
+
+    def add_archive(self, name, fileobj, manifest):
+        """Copy an archive into the container.
+        :param name: The filename of the archive. An archive of the same name already in the container is replaced.
+        :param fileobj: A file object for reading the archive
+        :param manifest: The manifest of the archive
+        """
+        length = 0
+        while True:
+            chunk = fileobj.read(self.chunk_size)
+            if not chunk:
+                break
+            self.file.write(chunk)
+            length += len(chunk)
+        self.index[name] = OrderedDict([("offset", self.offset), ("length", length), ("manifest", manifest)])
+        self.offset += length
+
+    def close(self):
+        """Write the index and move the container into place."""
+        self.file.write(json.dumps({"archives": self.index}, separators=(',', ':')).encode("utf-8"))
+        self.file.write(container_footer.pack(self.offset, container_magic))
+        self.file.close()
+        if self.tmp_path is not None:
+            os.rename(self.tmp_path, self.path)
+
+    def abort(self):
+        """Discard the container, or the archives added to an existing one."""
+        if self.tmp_path is None:
+            self.file.truncate(self.start_size)
+            self.file.close()
+            return
+        self.file.close()
+        os.remove(self.tmp_path)
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+cooccur.py
+
+Sparse matrices of how often pairs of hashtags are used in the same tweet, by candidate.
+
+Hashtags are lower-cased, as in the hashtag analysis, and interned: each matrix has a list of tags and refers to them
+by their position in the list. The matrices are symmetric, so only the entries with row <= column are stored. The
+diagonal holds the number of tweets with the hashtag.
+
+The co-occurrence analysis writes the matrix of each run to analyzed/<race>/cooccur/<run>.json in coordinate form:
+for each candidate, the rows, columns and counts of the entries. update_race_matrix merges the runs into the matrix of
+the race, analyzed/<race>/cooccur/matrix.json, in compressed sparse row form: for each candidate, the columns and
+counts of row i are those from indptr[i] to indptr[i + 1]. The runs that have been merged are recorded, so merging
+again only adds new runs. As in the hashtag analysis, a tweet found by several runs is counted by each of them.
+"""
+
+import io
+import json
+import os
+from collections import OrderedDict
+
+from .pruned import write_json_atomically
+
+race_matrix_filename = "matrix.json"
+
+
+class CooccurrenceMatrix(object):
+    """The hashtag co-occurrence counts of each candidate."""
+
+    def __init__(self, tags=None, runs=None):
+        self.tags = []
+        self.codes = {}
+        self.runs = list(runs or [])
+        # candidate -> {(row, column): count}
+        self.candidates = OrderedDict()
+        for tag in tags or []:
+            self.code(tag)
+
+    def code(self, tag):
+        """Return the id of the tag, interning it if it is new."""
+        if tag not in self.codes:
+            self.codes[tag] = len(self.tags)
+            self.tags.append(tag)
+        return self.codes[tag]
+
+    def add(self, candidate, row, column, count):
+        entries = self.candidates.setdefault(candidate, {})
+        key = (row, column) if row <= column else (column, row)
+        entries[key] = entries.get(key, 0) + count
+
+    def add_tweet(self, candidate, hashtags):
+        """Count the pairs of the hashtags of a tweet."""
+        codes = sorted(set(self.code(hashtag.lower()) for hashtag in hashtags))
+        for i, row in enumerate(codes):
+            for column in codes[i:]:
+                self.add(candidate, row, column, 1)
+
+    def merge(self, other):
+        """Add the counts of the other matrix to this one."""
+        codes = [self.code(tag) for tag in other.tags]
+        for candidate, entries in other.candidates.items():
+            for (row, column), count in entries.items():
+                self.add(candidate, codes[row], codes[column], count)
+        self.runs.extend(run for run in other.runs if run not in self.runs)
+
+    def count(self, candidate, tag, other_tag):
+        """Return the number of tweets of the candidate with both hashtags."""
+        if tag not in self.codes or other_tag not in self.codes:
+            return 0
+        row, column = sorted((self.codes[tag], self.codes[other_tag]))
+        return self.candidates.get(candidate, {}).get((row, column), 0)
+
+    def related(self, candidate, tag, n=None):
+        """Return the (hashtag, count) of the hashtags used most often with the tag by the candidate."""
+        code = self.codes.get(tag)
+        result = []
+        for (row, column), count in self.candidates.get(candidate, {}).items():
+            if row == column or code not in (row, column):
+                continue
+            result.append((self.tags[column if row == code else row], count))
+        result.sort(key=lambda item: (-item[1], item[0]))
+        return result if n is None else result[:n]
+
+    def sorted_entries(self, candidate):
+        entries = self.candidates[candidate]
+        return [(row, column, entries[(row, column)]) for row, column in sorted(entries.keys())]
+
+    def to_coordinates(self):
+        """The matrix as json in coordinate form."""
+        candidates = []
+        for candidate in self.candidates.keys():
+            entries = self.sorted_entries(candidate)
+            candidates.append(OrderedDict([("name", candidate),
+                                           ("rows", [row for row, _, _ in entries]),
+                                           ("columns", [column for _, column, _ in entries]),
+                                           ("counts", [count for _, _, count in entries])]))
+        return OrderedDict([("runs", self.runs), ("tags", self.tags), ("candidates", candidates)])
+
+    def to_csr(self):
+        """The matrix as json in compressed sparse row form."""
+        candidates = []
+        for candidate in self.candidates.keys():
+            entries = self.sorted_entries(candidate)
+            indptr = [0] * (len(self.tags) + 1)
+            for row, _, _ in entries:
+                indptr[row + 1] += 1
+            for i in range(len(self.tags)):
+                indptr[i + 1] += indptr[i]
+            candidates.append(OrderedDict([("name", candidate), ("indptr", indptr),
+                                           ("columns", [column for _, column, _ in entries]),
+                                           ("counts", [count for _, _, count in entries])]))
+        return OrderedDict([("runs", self.runs), ("tags", self.tags), ("candidates", candidates)])
+
+    @staticmethod
+    def from_json(data):
+        """Return the matrix stored with to_coordinates() or to_csr()."""
+        matrix = CooccurrenceMatrix(data["tags"], data["runs"])
+        for candidate in data["candidates"]:
+            if "indptr" in candidate:
+                indptr = candidate["indptr"]
+                rows = [row for row in range(len(indptr) - 1) for _ in range(indptr[row + 1] - indptr[row])]
+            else:
+                rows = candidate["rows"]
+            matrix.candidates[candidate["name"]] = {}
+            for row, column, count in zip(rows, candidate["columns"], candidate["counts"]):
+                matrix.add(candidate["name"], row, column, count)
+        return matrix
+
+
+def read_matrix(path):
+    with io.open(path, "rb") as f:
+        return CooccurrenceMatrix.from_json(json.loads(f.read().decode("utf-8"), object_pairs_hook=OrderedDict))
+
+
+def read_race_matrix(folder):
+    """Return the matrix of the race with the co-occurrence results in folder, or an empty matrix."""
+    path = os.path.join(folder, race_matrix_filename)
+    return read_matrix(path) if os.path.exists(path) else CooccurrenceMatrix()
+
+
+def update_race_matrix(folder):
+    """Merge the runs in folder that are not yet in the matrix of the race into it, and return it."""
+    matrix = read_race_matrix(folder)
+    merged = set(matrix.runs)
+    names = sorted(name for name in os.listdir(folder) if name.endswith(".json") and name != race_matrix_filename)
+    added = False
+    for name in names:
+        if name[:-len(".json")] in merged:
+            continue
+        matrix.merge(read_matrix(os.path.join(folder, name)))
+        added = True
+    if added:
+        write_json_atomically(os.path.join(folder, race_matrix_filename), matrix.to_csr())
+    return matrix
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+dedup.py
+
+A content-addressed store for the tweets and users in raw search results.
+
+The same tweet is returned once for each search term that matches it, again by overlapping runs, and once more
+embedded in each of its retweets. The store keeps each distinct tweet and user object once, keyed by the hash of its
+contents (and indexed by its id). A page of search results is split into a skeleton, in which the tweets and users
+are replaced by references to the store, and is joined back together from the skeleton and the store.
+"""
+
+import hashlib
+import json
+import sqlite3
+import zlib
+from collections import OrderedDict
+
+import six
+
+# The name of the object store in the compressed folder of a race
+store_filename = "objects.db"
+
+# The keys of a tweet that hold other objects, and the kind of object they hold
+tweet_ref = "$tweet"
+user_ref = "$user"
+nested_keys = [("user", user_ref), ("retweeted_status", tweet_ref), ("quoted_status", tweet_ref)]
+
+# The ways the collector serializes pages. A page that is not serialized like one of these is stored verbatim.
+page_formats = [{"separators": (',', ': ')}, {"indent": 4, "separators": (',', ': ')}]
+
+
+def loads(data):
+    if isinstance(data, six.binary_type):
+        data = data.decode("utf-8")
+    return json.loads(data, object_pairs_hook=OrderedDict)
+
+
+class DedupStore(object):
+    """The objects of a race, stored once each in a sqlite db."""
+
+    def __init__(self, path, level=6, timeout=60):
+        """
+        :param path: The path of the sqlite db
+        :param level: The zlib compression level for the objects
+        :param timeout: Seconds to wait for other writers to finish
+        """
+        self.path = path
+        self.level = level
+        self.connection = sqlite3.connect(path, timeout=timeout)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS objects "
+                                "(hash TEXT PRIMARY KEY, kind TEXT, id INTEGER, body BLOB)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS objects_id ON objects (kind, id)")
+        self.pending = {}
+        self.cache = {}
+
+    def put(self, kind, obj):
+        """Add the object to the store, if it is not already there, and return its hash."""
+        body = json.dumps(obj, separators=(',', ':')).encode("utf-8")
+        key = hashlib.sha256(body).hexdigest()
+        if key not in self.pending:
+            self.pending[key] = (kind, obj.get("id"), zlib.compress(body, self.level))
+        return key
+
+    def get(self, key):
+        """Return the object with the hash key."""
+        if key in self.pending:
+            return loads(zlib.decompress(self.pending[key][2]))
+        if key not in self.cache:
+            row = self.connection.execute("SELECT body FROM objects WHERE hash = ?", (key,)).fetchone()
+            if row is None:
+                raise KeyError("Object {} is not in {}".format(key, self.path))
+            self.cache[key] = bytes(row[0])
+        return loads(zlib.decompress(self.cache[key]))
+
+    def commit(self):
+        """Write the objects added since the last commit."""
+        rows = [(key, kind, obj_id, sqlite3.Binary(body)) for key, (kind, obj_id, body) in self.pending.items()]
+        with self.connection:
+            self.connection.executemany("INSERT OR IGNORE INTO objects VALUES (?, ?, ?, ?)", rows)
+        self.pending = {}
+
+    def close(self):
+        self.connection.close()
+
+    def split_tweet(self, tweet):
+        """Store the tweet and the objects in it. Return the reference to the tweet."""
+        skeleton = OrderedDict()
+        for key, value in tweet.items():
+            skeleton[key] = value
+        for key, ref in nested_keys:
+            value = skeleton.get(key)
+            if not isinstance(value, dict):
+                continue
+            if ref == user_ref:
+                skeleton[key] = {user_ref: self.put("user", value)}
+            else:
+                skeleton[key] = self.split_tweet(value)
+        return {tweet_ref: self.put("tweet", skeleton)}
+
+    def join_tweet(self, ref):
+        tweet = self.get(ref[tweet_ref])
+        for key, _ in nested_keys:
+            value = tweet.get(key)
+            if not isinstance(value, dict):
+                continue
+            if user_ref in value:
+                tweet[key] = self.get(value[user_ref])
+            elif tweet_ref in value:
+                tweet[key] = self.join_tweet(value)
+        return tweet
+
+    def split_page(self, contents):
+        """Split the bytes of a page into a skeleton that refers to objects in the store.
+
+        The skeleton records how the page was serialized, so the page can be reconstructed exactly. Pages that are
+        not serialized like the collector does are kept verbatim.
+        """
+        try:
+            page = loads(contents)
+        except ValueError:
+            page = None
+        page_format = None
+        if isinstance(page, dict) and isinstance(page.get("statuses"), list):
+            for i, kwargs in enumerate(page_formats):
+                if json.dumps(page, **kwargs).encode("utf-8") == contents:
+                    page_format = i
+                    break
+        if page_format is None:
+            return OrderedDict([("verbatim", contents.decode("utf-8"))])
+        skeleton = OrderedDict()
+        for key, value in page.items():
+            skeleton[key] = value
+        skeleton["statuses"] = [self.split_tweet(tweet) if isinstance(tweet, dict) else tweet
+                                for tweet in page["statuses"]]
+        return OrderedDict([("format", page_format), ("page", skeleton)])
+
+    def join_page(self, skeleton):
+        """Return the bytes of the page the skeleton was split from."""
+        if "verbatim" in skeleton:
+            return skeleton["verbatim"].encode("utf-8")
+        page = OrderedDict()
+        for key, value in skeleton["page"].items():
+            page[key] = value
+        page["statuses"] = [self.join_tweet(tweet) if isinstance(tweet, dict) and tweet_ref in tweet else tweet
+                            for tweet in page["statuses"]]
+        return json.dumps(page, **page_formats[skeleton["format"]]).encode("utf-8")
@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+dictionary.py
+
+Compression dictionaries trained on the raw search results of a race.
+
+Each page of search results is a small json file with a very repetitive structure. Compressed one at a time, a
+general purpose compressor cannot learn that structure, but a dictionary trained on earlier pages gives it a head
+start. The dictionaries of a race are stored in the bundle, in dictionaries/<race>/, and are versioned: compressed
+data records the version of the dictionary it needs, so training a new dictionary never makes old data unreadable.
+"""
+
+import bz2
+import hashlib
+import io
+import json
+import os
+import re
+import shutil
+import struct
+import subprocess
+import tempfile
+import time
+import zlib
+from collections import Counter, OrderedDict
+from datetime import datetime
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# zlib cannot look further back than its 32k window, so a larger dictionary would not help
+zlib_max_dictionary_size = 32 * 1024
+default_zstd_dictionary_size = 112 * 1024
+
+# The extension of raw pages compressed with a dictionary, and the header of their contents
+page_extension = ".zd"
+page_header = struct.Struct(">4sI")
+page_magic = b"SMZD"
+
+# Split json into fragments like '"key":value,'
+fragment_re = re.compile(br'[^,{\[]*[,{\[]')
+
+
+def dictionary_kinds():
+    """The kinds of dictionaries that can be used in this python installation."""
+    kinds = []
+    if has_zdict():
+        kinds.append("zlib")
+    if zstandard is not None:
+        kinds.append("zstd")
+    return kinds
+
+
+def has_zdict():
+    """zlib dictionaries require python 3"""
+    try:
+        zlib.compressobj(zdict=b"x")
+        return True
+    except TypeError:
+        return False
+
+
+def dictionary_folder_for_race_folder(race_folder):
+    """The dictionary folder for a race, given its folder in raw/ or compressed/."""
+    race_folder = race_folder.rstrip(os.sep)
+    output_path = os.path.dirname(os.path.dirname(race_folder))
+    return os.path.join(output_path, "dictionaries", os.path.basename(race_folder))
+
+
+def train_zlib_dictionary(samples, size=zlib_max_dictionary_size):
+    """Build a zlib dictionary from the json fragments that occur in the most samples.
+    :param samples: A list of pages (bytes)
+    :param size: The maximum size of the dictionary
+    """
+    counts = Counter()
+    for sample in samples:
+        counts.update(set(fragment_re.findall(sample)))
+    scored = sorted(((count * len(fragment), fragment) for fragment, count in counts.items() if count > 1),
+                    reverse=True)
+    chosen = []
+    total = 0
+    for score, fragment in scored:
+        if total + len(fragment) > size:
+            continue
+        chosen.append(fragment)
+        total += len(fragment)
+    # Matches at short distances are cheaper, so the most useful fragments go at the end
+    return b"".join(reversed(chosen))
+
+
+def train_zstd_dictionary(samples, size=default_zstd_dictionary_size):
+    return zstandard.train_dictionary(size, samples).as_bytes()
+
+
+def train_dictionary(kind, samples, size=None):
+    """Train a dictionary of the kind ('zlib' or 'zstd') on the samples."""
+    if kind not in dictionary_kinds():
+        raise ValueError("Dictionary kind {} is not available. Available kinds are {}".format(
+            kind, ", ".join(dictionary_kinds())))
+    if kind == "zlib":
+        return train_zlib_dictionary(samples, size if size is not None else zlib_max_dictionary_size)
+    return train_zstd_dictionary(samples, size if size is not None else default_zstd_dictionary_size)
+
+
+class Dictionary(object):
+    """A trained dictionary. Can be used as the frame codec of a framed archive."""
+    name = "zdict"
+
+    def __init__(self, version, kind, data):
+        self.version = version
+        self.kind = kind
+        self.data = data
+        self.default_level = 9 if kind == "zlib" else 19
+
+    def compress_block(self, data, level=None):
+        level = level if level is not None else self.default_level
+        if self.kind == "zlib":
+            compressor = zlib.compressobj(level, zlib.DEFLATED, 15, 9, zlib.Z_DEFAULT_STRATEGY, self.data)
+            return compressor.compress(data) + compressor.flush()
+        dict_data = zstandard.ZstdCompressionDict(self.data)
+        return zstandard.ZstdCompressor(level=level, dict_data=dict_data).compress(data)
+
+    def decompress_block(self, data):
+        if self.kind == "zlib":
+            decompressor = zlib.decompressobj(zdict=self.data)
+            return decompressor.decompress(data) + decompressor.flush()
+        dict_data = zstandard.ZstdCompressionDict(self.data)
+        return zstandard.ZstdDecompressor(dict_data=dict_data).decompress(data)
+
+    def encode_page(self, contents, level=None):
+        """Compress a page for storing in a raw folder. The result records the dictionary version."""
+        return page_header.pack(page_magic, self.version) + self.compress_block(contents, level)
+
+
+class DictionaryStore(object):
+    """The versioned dictionaries of a race"""
+
+    def __init__(self, folder):
+        """
+        :param folder: The dictionary folder of the race
+        """
+        self.folder = folder
+        self.loaded = {}
+
+    @classmethod
+    def for_race_folder(cls, race_folder):
+        return cls(dictionary_folder_for_race_folder(race_folder))
+
+    def index_path(self):
+        return os.path.join(self.folder, "dictionaries.json")
+
+    def dictionary_path(self, version):
+        return os.path.join(self.folder, "{}.dict".format(version))
+
+    def index(self):
+        """Return the descriptions of the dictionaries, oldest first."""
+        if not os.path.exists(self.index_path()):
+            return []
+        with io.open(self.index_path(), "rb") as f:
+            return json.loads(f.read().decode("utf-8"))["dictionaries"]
+
+    def get(self, version):
+        """Return the dictionary with the version. Raises KeyError if there is none."""
+        if version not in self.loaded:
+            matching = [entry for entry in self.index() if entry["version"] == version]
+            if len(matching) < 1:
+                raise KeyError("No dictionary version {} in {}".format(version, self.folder))
+            with io.open(self.dictionary_path(version), "rb") as f:
+                self.loaded[version] = Dictionary(version, matching[0]["kind"], f.read())
+        return self.loaded[version]
+
+    def latest(self):
+        """Return the newest dictionary, or None if none has been trained."""
+        index = self.index()
+        if len(index) < 1:
+            return None
+        return self.get(index[-1]["version"])
+
+    def add(self, kind, data, sample_count):
+        """Store a new dictionary and return it."""
+        if not os.path.exists(self.folder):
+            os.makedirs(self.folder)
+        index = self.index()
+        version = index[-1]["version"] + 1 if index else 1
+        with io.open(self.dictionary_path(version), "wb") as f:
+            f.write(data)
+        index.append(OrderedDict([("version", version), ("kind", kind), ("size", len(data)),
+                                  ("samples", sample_count), ("created", datetime.utcnow().isoformat()),
+                                  ("sha256", hashlib.sha256(data).hexdigest())]))
+        tmp_path = self.index_path() + ".tmp"
+        with io.open(tmp_path, "wb") as f:
+            f.write(json.dumps({"dictionaries": index}, indent=1).encode("utf-8"))
+        os.rename(tmp_path, self.index_path())
+        return self.get(version)
+
+    def decode_page(self, encoded):
+        """Decompress a page written by Dictionary.encode_page."""
+        magic, version = page_header.unpack(encoded[:page_header.size])
+        if magic != page_magic:
+            raise ValueError("Not a dictionary compressed page")
+        return self.get(version).decompress_block(encoded[page_header.size:])
+
+
+def timed(func, *args):
+    start = time.time()
+    result = func(*args)
+    return result, max(time.time() - start, 1e-6)
+
+
+def benchmark_result(method, raw_size, compressed_size, compress_seconds, decompress_seconds):
+    mb = raw_size / (1024.0 * 1024.0)
+    return OrderedDict([("method", method), ("ratio", float(raw_size) / max(compressed_size, 1)),
+                        ("compress MB/s", mb / compress_seconds), ("decompress MB/s", mb / decompress_seconds)])
+
+
+def benchmark(pages, dictionaries):
+    """Compare compressing the pages of a run with tar -cjf to compressing each page with and without dictionaries.
+    :param pages: A list of (filename, contents) of the pages of a run
+    :param dictionaries: The dictionaries to compare
+    :return: A list of dicts with the method, compression ratio and speeds
+    """
+    raw_size = sum(len(contents) for filename, contents in pages)
+    results = []
+
+    tmp_folder = tempfile.mkdtemp()
+    try:
+        run_folder = os.path.join(tmp_folder, "run")
+        os.makedirs(run_folder)
+        for filename, contents in pages:
+            with io.open(os.path.join(run_folder, filename), "wb") as f:
+                f.write(contents)
+        archive_path = os.path.join(tmp_folder, "run.tar.bz2")
+        try:
+            _, compress_seconds = timed(subprocess.check_call, ['tar', '-cjf', archive_path, '-C', tmp_folder, 'run'])
+            shutil.rmtree(run_folder)
+            _, decompress_seconds = timed(subprocess.check_call, ['tar', '-xjf', archive_path, '-C', tmp_folder])
+            results.append(benchmark_result("tar -cjf", raw_size, os.path.getsize(archive_path),
+                                            compress_seconds, decompress_seconds))
+        except (OSError, subprocess.CalledProcessError):
+            pass
+    finally:
+        shutil.rmtree(tmp_folder)
+
+    def per_page(method, compress, decompress):
+        compressed, compress_seconds = timed(lambda: [compress(contents) for filename, contents in pages])
+        _, decompress_seconds = timed(lambda: [decompress(data) for data in compressed])
+        results.append(benchmark_result(method, raw_size, sum(len(data) for data in compressed),
+                                        compress_seconds, decompress_seconds))
+
+    per_page("bz2 per page", lambda data: bz2.compress(data, 9), bz2.decompress)
+    per_page("zlib per page", lambda data: zlib.compress(data, 9), zlib.decompress)
+    for dictionary in dictionaries:
+        per_page("{} dictionary v{} per page".format(dictionary.kind, dictionary.version),
+                 dictionary.compress_block, dictionary.decompress_block)
+    return results
@@ -0,0 +1,374 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+pruned.py
+
+Reading the pruned data of a run, wherever it is stored.
+
+Pruning writes one json array of tweets per run, pruned/<race>/<run>.json, or pruned/<race>/<run>.json.gz if the
+pruned data is compressed. It can also write the tweets as json lines, pruned/<race>/<run>.jsonl, with an index,
+<run>.index.json, that holds the number of tweets, the offset of each line, the lines of each candidate, and the
+smallest and largest tweet id and date. Counting, reading the tweets of one candidate, and reading one tweet then only
+need the index and the lines asked for. The index also records the size and modification time of the run file, and is
+rebuilt if the file has been rewritten since, e.g., by jq pruning the run again.
+
+Partitioning merges the pruned runs of a day or week into one partition, pruned/<race>/<partition>.jsonl, with one
+tweet per line. A tweet that several runs pruned to the same fields is stored once, whatever the order of its
+fields. Next to each partition is an index,
+<partition>.index.json, with the offset of each line and the lines of each run, and pruned/<race>/partitions.json
+records the partition of each run.
+"""
+
+import gzip
+import hashlib
+import io
+import json
+import os
+from collections import OrderedDict
+
+import six
+
+json_extension = ".json"
+gzip_extension = ".json.gz"
+lines_extension = ".jsonl"
+pruned_file_extensions = [json_extension, gzip_extension, lines_extension]
+partition_extension = lines_extension
+catalog_filename = "partitions.json"
+period_types = ["day", "week"]
+
+# Indexes of recently read partitions and catalogs, keyed by path, with the modification time and size they were
+# read at
+index_cache = {}
+
+
+def partition_filename(period_type, dt):
+    """The filename of the partition for the period of type period_type (day or week) that includes dt."""
+    if period_type == "day":
+        return dt.strftime("%Y-%m-%d") + partition_extension
+    if period_type == "week":
+        year, week, _ = dt.isocalendar()
+        return "{:04d}-W{:02d}{}".format(year, week, partition_extension)
+    raise ValueError("Unknown period {}. Known periods are {}".format(period_type, ", ".join(period_types)))
+
+
+def index_path(lines_path):
+    """The path of the index of a partition or json lines run."""
+    return lines_path[:-len(lines_extension)] + ".index.json"
+
+
+def loads(data):
+    return json.loads(data.decode("utf-8"), object_pairs_hook=OrderedDict)
+
+
+def read_cached_json(path):
+    """Read the json file at path, or return None if it does not exist. Files are re-read when they change."""
+    if not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+    cached = index_cache.get(path)
+    if cached is not None and cached[0] == (stat.st_mtime, stat.st_size):
+        return cached[1]
+    with io.open(path, "rb") as f:
+        value = loads(f.read())
+    index_cache[path] = ((stat.st_mtime, stat.st_size), value)
+    return value
+
+
+def write_json_atomically(path, value):
+    tmp_path = path + ".tmp"
+    with io.open(tmp_path, "wb") as f:
+        f.write(json.dumps(value, separators=(',', ':')).encode("utf-8"))
+    os.rename(tmp_path, path)
+
+
+def read_catalog(race_folder):
+    """Return a dict of run folder name -> partition filename for the race."""
+    catalog = read_cached_json(os.path.join(race_folder, catalog_filename))
+    return catalog if catalog is not None else OrderedDict()
+
+
+def write_catalog(race_folder, catalog):
+    write_json_atomically(os.path.join(race_folder, catalog_filename), catalog)
+
+
+def read_index(partition_path):
+    """Return the index of the partition: the offsets of its lines and the line numbers of each run."""
+    index = read_cached_json(index_path(partition_path))
+    return index if index is not None else OrderedDict([("lines", []), ("runs", OrderedDict())])
+
+
+def partition_for_run(pruned_data_path):
+    """Return the path of the partition with the run, or None if the run is not in a partition.
+    :param pruned_data_path: The pruned data path of the run, without the .json extension
+    """
+    race_folder, run_folder = os.path.split(pruned_data_path)
+    filename = read_catalog(race_folder).get(run_folder)
+    return os.path.join(race_folder, filename) if filename is not None else None
+
+
+def read_partition_run(partition_path, run_folder):
+    """Return the tweets of the run in the partition, in the order they were pruned."""
+    index = read_index(partition_path)
+    offsets = index["lines"]
+    records = []
+    with io.open(partition_path, "rb") as f:
+        for line in index["runs"][run_folder]:
+            f.seek(offsets[line])
+            records.append(loads(f.readline()))
+    return records
+
+
+def pruned_file_path(pruned_data_path):
+    """Return the path of the file with the pruned data of the run, compressed or not, or None if there is none.
+    :param pruned_data_path: The pruned data path of the run, without the .json extension
+    """
+    for extension in pruned_file_extensions:
+        path = pruned_data_path + extension
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+def open_pruned_file(path):
+    """Open the pruned file for reading. A gzipped file is decompressed as it is read."""
+    if path.endswith(gzip_extension):
+        return gzip.open(path, "rb")
+    return io.open(path, "rb")
+
+
+def dumps_line(record):
+    """The record as a line of compact json, the way jq -c writes it."""
+    return six.text_type(json.dumps(record, ensure_ascii=False, separators=(',', ':'))).encode("utf-8") + b"\n"
+
+
+def lines_index_for_records(records, offsets):
+    """Return the index of a json lines run with the records at the offsets.
+
+    Pruned tweets are grouped by candidate, so the tweets of each candidate are one range of lines. Tweet ids increase
+    with time, so the smallest and largest date are those of the tweets with the smallest and largest id.
+    """
+    candidates = []
+    min_record = max_record = None
+    for line, record in enumerate(records):
+        candidate = record.get("candidate")
+        if candidates and candidates[-1][0] == candidate:
+            candidates[-1][2] += 1
+        else:
+            candidates.append([candidate, line, 1])
+        if min_record is None or record["id"] < min_record["id"]:
+            min_record = record
+        if max_record is None or record["id"] > max_record["id"]:
+            max_record = record
+    return OrderedDict([
+        ("count", len(records)),
+        ("lines", offsets),
+        ("candidates", candidates),
+        ("min_id", min_record["id"] if min_record else None),
+        ("max_id", max_record["id"] if max_record else None),
+        ("min_date", min_record.get("date") if min_record else None),
+        ("max_date", max_record.get("date") if max_record else None)])
+
+
+def write_lines_index(lines_path, records, offsets):
+    """Write the index of the json lines run, with the size and modification time of the run file it describes."""
+    index = lines_index_for_records(records, offsets)
+    stat = os.stat(lines_path)
+    index["size"] = stat.st_size
+    index["mtime"] = stat.st_mtime
+    write_json_atomically(index_path(lines_path), index)
+
+
+def write_lines(lines_path, records):
+    """Write the pruned tweets of a run as json lines and write its index."""
+    offsets = []
+    offset = 0
+    with io.open(lines_path, "wb") as f:
+        for record in records:
+            line = dumps_line(record)
+            f.write(line)
+            offsets.append(offset)
+            offset += len(line)
+    write_lines_index(lines_path, records, offsets)
+
+
+def lines_index(lines_path):
+    """Return the index of the json lines run, building it if the run was written without one (e.g., by jq) or has
+    been rewritten since its index was."""
+    index = read_cached_json(index_path(lines_path))
+    if index is not None:
+        stat = os.stat(lines_path)
+        if index.get("size") == stat.st_size and index.get("mtime") == stat.st_mtime:
+            return index
+    offsets = []
+    records = []
+    offset = 0
+    with io.open(lines_path, "rb") as f:
+        for line in f:
+            offsets.append(offset)
+            records.append(loads(line))
+            offset += len(line)
+    write_lines_index(lines_path, records, offsets)
+    return read_cached_json(index_path(lines_path))
+
+
+def read_lines(lines_path, start=0, stop=None):
+    """Return the tweets on lines start to stop (exclusive) of the json lines run, reading only those lines."""
+    offsets = lines_index(lines_path)["lines"]
+    stop = len(offsets) if stop is None else min(stop, len(offsets))
+    if start >= stop:
+        return []
+    with io.open(lines_path, "rb") as f:
+        f.seek(offsets[start])
+        data = f.read(offsets[stop] - offsets[start]) if stop < len(offsets) else f.read()
+    return [loads(line) for line in data.splitlines()]
+
+
+def read_line(lines_path, line):
+    """Return the tweet on the line of the json lines run."""
+    records = read_lines(lines_path, line, line + 1)
+    if not records:
+        raise IndexError("{} has no line {}".format(lines_path, line))
+    return records[0]
+
+
+def read_candidate_lines(lines_path, candidate):
+    """Return the tweets of the candidate in the json lines run."""
+    records = []
+    for name, start, count in lines_index(lines_path)["candidates"]:
+        if name == candidate:
+            records.extend(read_lines(lines_path, start, start + count))
+    return records
+
+
+def remove_pruned_file(path):
+    """Remove the pruned file of a run and, for json lines, its index."""
+    os.remove(path)
+    if path.endswith(lines_extension) and os.path.exists(index_path(path)):
+        os.remove(index_path(path))
+
+
+def remove_other_pruned_files(pruned_data_path, extension):
+    """Remove the pruned files of the run in formats other than extension. Readers take the first format they find,
+    so a run pruned again in another format must not leave the old file behind."""
+    for other in pruned_file_extensions:
+        if other != extension and os.path.isfile(pruned_data_path + other):
+            remove_pruned_file(pruned_data_path + other)
+
+
+def pruned_run_count(pruned_data_path):
+    """Return the number of pruned tweets of the run. For json lines runs, only the index is read."""
+    path = pruned_file_path(pruned_data_path)
+    if path is not None and path.endswith(lines_extension):
+        return lines_index(path)["count"]
+    return len(read_pruned_run(pruned_data_path))
+
+
+def only_in_partition(pruned_data_path):
+    """Return True if the pruned data of the run is in a partition and not in a file of its own."""
+    return not os.path.exists(pruned_data_path) and pruned_file_path(pruned_data_path) is None \
+        and partition_for_run(pruned_data_path) is not None
+
+
+def has_pruned_run(pruned_data_path):
+    """Return True if there is pruned data for the run, in a file or in a partition."""
+    return os.path.exists(pruned_data_path) or pruned_file_path(pruned_data_path) is not None \
+        or partition_for_run(pruned_data_path) is not None
+
+
+def read_pruned_run(pruned_data_path):
+    """Return the pruned tweets of the run, from its file or its partition.
+    :param pruned_data_path: The pruned data path of the run, without the .json extension
+    """
+    path = pruned_file_path(pruned_data_path)
+    if path is not None and path.endswith(lines_extension):
+        return read_lines(path)
+    if path is not None:
+        with open_pruned_file(path) as f:
+            return loads(f.read())
+    partition_path = partition_for_run(pruned_data_path)
+    if partition_path is None:
+        raise IOError("No pruned data found at {}".format(pruned_data_path + json_extension))
+    return read_partition_run(partition_path, os.path.basename(pruned_data_path))
+
+
+def pruned_run_digest(pruned_data_path):
+    """Return the sha1 of the pruned data of the run, or None if there is none. For a run in a partition, this is the
+    sha1 of its lines in the partition.
+    :param pruned_data_path: The pruned data path of the run, without the .json extension
+    """
+    digest = hashlib.sha1()
+    path = pruned_file_path(pruned_data_path)
+    if path is not None:
+        with io.open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
+    partition_path = partition_for_run(pruned_data_path)
+    if partition_path is None:
+        return None
+    index = read_index(partition_path)
+    offsets = index["lines"]
+    with io.open(partition_path, "rb") as f:
+        for line in index["runs"][os.path.basename(pruned_data_path)]:
+            f.seek(offsets[line])
+            digest.update(f.readline())
+    return digest.hexdigest()
+
+
+class PartitionWriter(object):
+    """Adds runs to a partition.
+
+    Lines are only appended to the partition, so the offsets of the existing lines stay valid. The index is rewritten
+    by close(), so runs added since the last close are not visible until then.
+    """
+
+    def __init__(self, partition_path):
+        self.partition_path = partition_path
+        index = read_index(partition_path)
+        self.index = OrderedDict([("lines", []), ("runs", OrderedDict(index["runs"]))])
+        self.offsets = []
+        self.lines_by_key = {}
+        self.file = io.open(partition_path, "ab+")
+        self.scan()
+
+    def scan(self):
+        """Read the existing lines, dropping a line that was only partially written."""
+        self.file.seek(0)
+        offset = 0
+        for line in self.file:
+            if not line.endswith(b"\n"):
+                break
+            self.lines_by_key[self.record_key(loads(line))] = len(self.offsets)
+            self.offsets.append(offset)
+            offset += len(line)
+        self.file.truncate(offset)
+        self.file.seek(offset)
+        self.offset = offset
+
+    @staticmethod
+    def record_key(record):
+        """The tweet id and the sha1 of the fields of the pruned tweet, serialized in a canonical order, so the
+        same tweet pruned by runs that order its fields differently is stored once."""
+        canonical = json.dumps(record, sort_keys=True, separators=(',', ':')).encode("utf-8")
+        return record.get("id"), hashlib.sha1(canonical).hexdigest()
+
+    def add_run(self, run_folder, records):
+        """Add the tweets of a run. A tweet that is already in the partition is not written again."""
+        lines = []
+        for record in records:
+            key = self.record_key(record)
+            if key not in self.lines_by_key:
+                line = dumps_line(record)
+                self.lines_by_key[key] = len(self.offsets)
+                self.offsets.append(self.offset)
+                self.file.write(line)
+                self.offset += len(line)
+            lines.append(self.lines_by_key[key])
+        self.index["runs"][run_folder] = lines
+
+    def close(self):
+        """Write the index."""
+        self.file.close()
+        self.index["lines"] = self.offsets
+        write_json_atomically(index_path(self.partition_path), self.index)
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+raw.py
+
+Reading the raw data of a run, wherever it is stored.
+
+The raw data of a run is either in raw/ or, once it has been archived, only in its archive in compressed/. A
+RawReader serves the pages of the run from whichever exists, so reprocessing a run never needs to extract the archive
+to disk. In raw/, the pages of a run are in a folder, or in one file (see storage.py), and may have been compressed
+with a dictionary (see dictionary.py).
+"""
+
+import json
+import os
+
+from . import archive, storage
+from .dictionary import DictionaryStore, page_extension
+
+
+def raw_run_exists(raw_data_path):
+    """Return True if there are raw pages for the run with the folder path raw_data_path, in any storage."""
+    return storage.storage_for_run(raw_data_path) is not None
+
+
+def raw_run_path(raw_data_path):
+    """The path of the folder or file that holds the raw pages of the run, or raw_data_path if there is none."""
+    run_storage = storage.storage_for_run(raw_data_path)
+    return run_storage.run_path(raw_data_path) if run_storage is not None else raw_data_path
+
+
+def delete_raw_run(raw_data_path):
+    storage.storage_for_run(raw_data_path).delete_run(raw_data_path)
+
+
+def run_filenames(raw_data_path):
+    """The names of the pages of the run as they are stored, which may have the dictionary page extension."""
+    return storage.storage_for_run(raw_data_path).filenames(raw_data_path)
+
+
+def read_page(raw_data_path, filename):
+    """Return the contents of a page of the run, decompressing it if it was compressed with a dictionary."""
+    contents = storage.storage_for_run(raw_data_path).read_page(raw_data_path, filename)
+    if filename.endswith(page_extension):
+        contents = DictionaryStore.for_race_folder(os.path.dirname(raw_data_path)).decode_page(contents)
+    return contents
+
+
+def read_raw_folder(raw_data_path):
+    """Return a generator of the (filename, contents, mtime) of the raw pages of a run, ordered by filename.
+
+    Pages compressed with a dictionary are decompressed, and their filename is that of the uncompressed page.
+    :param raw_data_path: The path of the folder of the run. The pages may be in another storage.
+    """
+    dictionaries = DictionaryStore.for_race_folder(os.path.dirname(raw_data_path))
+    for filename, contents, mtime in storage.storage_for_run(raw_data_path).read_pages(raw_data_path):
+        if filename.endswith(page_extension):
+            filename = filename[:-len(page_extension)]
+            contents = dictionaries.decode_page(contents)
+        yield filename, contents, mtime
+
+
+class RawReader(object):
+    """Reads the pages of a run from raw/, or from the archive if there are no raw pages for the run."""
+
+    def __init__(self, raw_data_path, archive_path=None):
+        """
+        :param raw_data_path: The path of the raw folder of the run. The pages may be in another storage.
+        :param archive_path: The path of the archive of the run, or None if it should not be considered
+        """
+        self.raw_data_path = raw_data_path
+        self.archive_path = archive_path
+
+    def in_raw_folder(self):
+        return raw_run_exists(self.raw_data_path)
+
+    def in_archive(self):
+        return not self.in_raw_folder() and self.archive_path is not None and archive.archive_exists(self.archive_path)
+
+    def exists(self):
+        return self.in_raw_folder() or self.in_archive()
+
+    def source(self):
+        """The path the pages are read from, or None if there is no raw data for the run."""
+        if self.in_raw_folder():
+            return raw_run_path(self.raw_data_path)
+        if self.in_archive():
+            return self.archive_path
+        return None
+
+    def pages(self):
+        """Return a generator of the (filename, contents) of the pages of the run, ordered by filename.
+
+        This is the order jq reads the files of the raw folder in.
+        """
+        if self.in_raw_folder():
+            return self.folder_pages()
+        if self.in_archive():
+            return archive.archive_pages(self.archive_path)
+        raise IOError("No raw data found at {} or {}".format(self.raw_data_path, self.archive_path))
+
+    def folder_pages(self):
+        for filename, contents, mtime in read_raw_folder(self.raw_data_path):
+            yield filename, contents
+
+    def entries(self):
+        """Return a generator of the (filename, contents, mtime) of the pages of the run, ordered by filename."""
+        if self.in_raw_folder():
+            return read_raw_folder(self.raw_data_path)
+        if self.in_archive():
+            return archive.archive_entries(self.archive_path)
+        raise IOError("No raw data found at {} or {}".format(self.raw_data_path, self.archive_path))
+
+    def parsed_pages(self):
+        """Return a generator of the (filename, json) of the pages of the run, ordered by filename."""
+        for filename, contents in self.pages():
+            yield filename, json.loads(contents.decode("utf-8"))
@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+sketch.py
+
+Sketches that summarize sets too large to keep: a HyperLogLog sketch for estimating the number of distinct values
+(e.g., users), and a space-saving summary for finding the most frequent values (e.g., hashtags).
+
+Sketches of different sets can be merged into a sketch of their union, so distinct counts over any window can be
+computed from per-hour or per-run sketches. With the default precision of 12 a sketch is 4096 bytes and the
+estimates are within about 1.6% of the true count.
+
+The metadata analyzers of the python engine write the sketches of the users and retweeted tweets of each candidate
+alongside the summary of each run, as analyzed/<race>/sketches/<run>.json. The summaries have the exact distinct
+counts of a run; merging the sketches of any set of runs gives approximate distinct counts over all of them.
+
+A space-saving summary keeps at most capacity values with counts. Each count is an upper bound on how often the value
+was added, and count - error is a lower bound. A value that is not in the summary was added at most floor() times,
+and floor() is at most total / capacity, so any value added more often than that is always in the summary. Summaries
+merge with the same bounds, so the top values over any window can be computed from per-hour summaries.
+"""
+
+import base64
+import hashlib
+import io
+import json
+import math
+from collections import OrderedDict
+
+import six
+
+default_precision = 12
+default_capacity = 100
+sketches_analysis_type = "sketches"
+sketch_fields = ["users", "retweets"]
+
+
+def hash64(value):
+    """A 64 bit hash of the value that is the same in every process and python version"""
+    data = six.text_type(value).encode("utf-8")
+    return int(hashlib.sha1(data).hexdigest()[:16], 16)
+
+
+class HyperLogLog(object):
+    """Estimates the number of distinct values added to it."""
+
+    def __init__(self, precision=default_precision, registers=None):
+        """
+        :param precision: The number of bits of the hash that select a register. There are 2 ** precision registers.
+        :param registers: The registers of an existing sketch, as bytes
+        """
+        self.precision = precision
+        self.m = 1 << precision
+        self.registers = bytearray(registers) if registers is not None else bytearray(self.m)
+        if len(self.registers) != self.m:
+            raise ValueError("A sketch with precision {} has {} registers, not {}".format(
+                precision, self.m, len(self.registers)))
+
+    @staticmethod
+    def from_bytes(data):
+        """Return the sketch stored with to_bytes()."""
+        data = bytearray(data)
+        return HyperLogLog(data[0], data[1:])
+
+    def to_bytes(self):
+        return bytes(bytearray([self.precision]) + self.registers)
+
+    def add(self, value):
+        h = hash64(value)
+        bits = 64 - self.precision
+        register = h >> bits
+        rank = bits - (h & ((1 << bits) - 1)).bit_length() + 1
+        if rank > self.registers[register]:
+            self.registers[register] = rank
+
+    def update(self, values):
+        for value in values:
+            self.add(value)
+
+    def merge(self, other):
+        """Add the values of the other sketch to this one."""
+        if other.precision != self.precision:
+            raise ValueError("Cannot merge sketches with precisions {} and {}".format(self.precision, other.precision))
+        self.registers = bytearray(max(a, b) for a, b in zip(self.registers, other.registers))
+
+    def count(self):
+        """Return the estimated number of distinct values."""
+        alpha = 0.7213 / (1 + 1.079 / self.m)
+        estimate = alpha * self.m * self.m / sum(2.0 ** -r for r in self.registers)
+        zeros = sum(1 for r in self.registers if r == 0)
+        if estimate <= 2.5 * self.m and zeros > 0:
+            # Few values: count the empty registers instead
+            estimate = self.m * math.log(float(self.m) / zeros)
+        return int(round(estimate))
+
+
+class SpaceSaving(object):
+    """Keeps approximate counts of the most frequent of the values added to it."""
+
+    def __init__(self, capacity=default_capacity, items=None, total=0):
+        """
+        :param capacity: The most values to keep.
+        :param items: The (value, count, error) of the values of an existing summary
+        :param total: The sum of the counts added to an existing summary
+        """
+        self.capacity = capacity
+        self.counts = OrderedDict()
+        self.errors = {}
+        self.total = total
+        for value, count, error in items or []:
+            self.counts[value] = count
+            self.errors[value] = error
+
+    @staticmethod
+    def from_json(data):
+        """Return the summary stored with to_json()."""
+        return SpaceSaving(data["capacity"], data["items"], data["total"])
+
+    def to_json(self):
+        return OrderedDict([("capacity", self.capacity), ("total", self.total), ("items", self.top())])
+
+    def add(self, value, count=1):
+        self.total += count
+        if value in self.counts:
+            self.counts[value] += count
+        elif len(self.counts) < self.capacity:
+            self.counts[value] = count
+            self.errors[value] = 0
+        else:
+            # Replace the value with the smallest count, which the new value may have been added up to
+            smallest = min(self.counts, key=self.counts.get)
+            floor = self.counts.pop(smallest)
+            del self.errors[smallest]
+            self.counts[value] = floor + count
+            self.errors[value] = floor
+
+    def floor(self):
+        """Return the most times a value that is not in the summary can have been added."""
+        if len(self.counts) < self.capacity:
+            return 0
+        return min(self.counts.values())
+
+    def merge(self, other):
+        """Add the values of the other summary to this one."""
+        if other.capacity != self.capacity:
+            raise ValueError("Cannot merge summaries with capacities {} and {}".format(self.capacity, other.capacity))
+        floor, other_floor = self.floor(), other.floor()
+        items = []
+        for value in list(self.counts.keys()) + [v for v in other.counts.keys() if v not in self.counts]:
+            count = self.counts.get(value, floor) + other.counts.get(value, other_floor)
+            error = self.errors.get(value, floor) + other.errors.get(value, other_floor)
+            items.append((value, count, error))
+        items.sort(key=lambda item: (-item[1], item[0]))
+        total = self.total + other.total
+        self.__init__(self.capacity, items[:self.capacity], total)
+
+    def top(self, n=None):
+        """Return the (value, count, error) of the n values with the largest counts, or of all of them."""
+        items = sorted(((value, count, self.errors[value]) for value, count in self.counts.items()),
+                       key=lambda item: (-item[1], item[0]))
+        return items if n is None else items[:n]
+
+
+def write_run_sketches(path, runname, sketches):
+    """Write the sketches of the candidates of a run.
+    :param sketches: A list of (candidate, {"users": HyperLogLog, "retweets": HyperLogLog}) pairs
+    """
+    candidates = []
+    for candidate, candidate_sketches in sketches:
+        entry = OrderedDict([("name", candidate)])
+        for field in sketch_fields:
+            entry[field] = base64.b64encode(candidate_sketches[field].to_bytes()).decode("ascii")
+        candidates.append(entry)
+    with io.open(path, "wb") as f:
+        f.write(json.dumps(OrderedDict([("runname", runname), ("candidates", candidates)])).encode("utf-8"))
+
+
+def read_run_sketches(path):
+    """Return an OrderedDict of candidate -> {"users": HyperLogLog, "retweets": HyperLogLog} of the run."""
+    with io.open(path, "rb") as f:
+        data = json.loads(f.read().decode("utf-8"), object_pairs_hook=OrderedDict)
+    return OrderedDict((entry["name"], dict((field, HyperLogLog.from_bytes(base64.b64decode(entry[field])))
+                                            for field in sketch_fields))
+                       for entry in data["candidates"])
+
+
+def merge_run_sketches(paths):
+    """Return an OrderedDict of candidate -> {"users": HyperLogLog, "retweets": HyperLogLog} over all the runs."""
+    merged = OrderedDict()
+    for path in paths:
+        for candidate, candidate_sketches in read_run_sketches(path).items():
+            if candidate not in merged:
+                merged[candidate] = candidate_sketches
+                continue
+            for field in sketch_fields:
+                merged[candidate][field].merge(candidate_sketches[field])
+    return merged
+
+
+def distinct_counts(paths):
+    """Return a list of the estimated number of distinct users and retweeted tweets of each candidate over the runs
+    with the sketch files at paths."""
+    return [OrderedDict([("name", candidate)] + [(field, candidate_sketches[field].count()) for field in sketch_fields])
+            for candidate, candidate_sketches in merge_run_sketches(paths).items()]
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+snapshot.py
+
+A read-only snapshot of the races, candidates and search terms in the status db.
+
+The candidates and search terms of the status db are dynamic relationships, so walking them queries the db for each
+race and each candidate. Commands that need the whole configuration, e.g., to write the configuration of their tasks,
+use a ConfigSnapshot instead, which is loaded with one query. BundleStatus.snapshot() keeps the snapshot, so all the
+commands run with a status share it.
+"""
+
+from collections import OrderedDict
+
+import six
+
+from .status_db import Race, Candidate, SearchTerm
+
+if six.PY2:
+    from urllib import quote as urllibquote
+else:
+    from urllib.parse import quote as urllibquote
+
+
+def urlquote(string):
+    return urllibquote(string).replace("%20", " ")
+
+
+def encoded_search_term(term):
+    """Return the term as it appears in the query field of the twitter search metadata."""
+    return urlquote(term).replace(" ", "+")
+
+
+class CandidateSnapshot(object):
+    """A candidate and its search terms"""
+    __slots__ = ["name", "terms", "quoted_terms"]
+
+    def __init__(self, name):
+        self.name = name
+        self.terms = []
+        self.quoted_terms = []
+
+
+class RaceSnapshot(object):
+    """A race and its candidates"""
+    __slots__ = ["id", "name", "slug", "candidates"]
+
+    def __init__(self, race_id, name, slug):
+        self.id = race_id
+        self.name = name
+        self.slug = slug
+        self.candidates = []
+
+
+class RunSnapshot(object):
+    """The name and start of a run, for code that works with runs outside of the thread of the status db session"""
+    __slots__ = ["results_folder", "start"]
+
+    def __init__(self, results_folder, start):
+        self.results_folder = results_folder
+        self.start = start
+
+    @staticmethod
+    def for_run(run):
+        return RunSnapshot(run.results_folder, run.start)
+
+
+class ConfigSnapshot(object):
+    """The races, candidates and search terms of a bundle"""
+    __slots__ = ["races", "races_by_slug", "candidates_map"]
+
+    def __init__(self, session):
+        """Load the configuration from the status db.
+        :param session: A session of the status db
+        """
+        self.races = []
+        self.races_by_slug = {}
+        # The encoded search terms -> candidate names, for all races
+        self.candidates_map = {}
+        query = session.query(Race.id, Race.name, Race.slug, Candidate.id, Candidate.name, SearchTerm.term) \
+            .outerjoin(Candidate, Candidate.race_id == Race.id) \
+            .outerjoin(SearchTerm, SearchTerm.candidate_id == Candidate.id) \
+            .order_by(Race.id, Candidate.id, SearchTerm.id)
+        races = OrderedDict()
+        candidates = {}
+        for race_id, race_name, slug, candidate_id, candidate_name, term in query:
+            race = races.get(race_id)
+            if race is None:
+                race = races[race_id] = RaceSnapshot(race_id, race_name, slug)
+            if candidate_id is None:
+                continue
+            candidate = candidates.get(candidate_id)
+            if candidate is None:
+                candidate = candidates[candidate_id] = CandidateSnapshot(candidate_name)
+                race.candidates.append(candidate)
+            if term is None:
+                continue
+            candidate.terms.append(term)
+            candidate.quoted_terms.append(urlquote(term))
+            self.candidates_map[encoded_search_term(term)] = candidate_name
+        self.races = list(races.values())
+        self.races_by_slug = dict((race.slug, race) for race in self.races)
+
+    def race(self, slug):
+        """Return the race with the slug, or None."""
+        return self.races_by_slug.get(slug)
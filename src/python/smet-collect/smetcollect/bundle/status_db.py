@@ -42,6 +42,18 @@ def get_or_create(session, model, defaults=None, **kwargs):
         return instance, True
 
 
+def set_journal_mode(engine, mode):
+    """Set the journal mode of the sqlite db of the engine, and return the previous mode.
+
+    The mode is stored in the db file, so it applies to every connection until it is set again. In wal mode, readers
+    do not block the writer and the writer does not block readers, but it does not work on network file systems.
+    """
+    with engine.connect() as connection:
+        previous = connection.execute("PRAGMA journal_mode").scalar()
+        connection.execute("PRAGMA journal_mode={}".format(mode))
+    return previous
+
+
 class Race(Base):
     """ The representation of a race
     """
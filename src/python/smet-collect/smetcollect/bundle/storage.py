@@ -0,0 +1,287 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+storage.py
+
+The ways the raw pages of a run can be stored in raw/<race>/.
+
+The folder storage keeps one file per page in the folder of the run, raw/<race>/<run>/. This is the layout tar,
+jq and the shell tools expect, but collecting every hour creates millions of tiny files. The segment storage appends
+the pages of a run to one file, raw/<race>/<run>.segment, and the sqlite storage keeps them as blobs in one db per
+run, raw/<race>/<run>.db.
+
+Each storage is addressed by the path of the run folder, whether the folder exists or not. The storage a run is
+written with is chosen by BundleStatus.raw_storage. When reading, the storage of a run is found from the files that
+exist (see storage_for_run), so runs written with different storages can be mixed in a bundle.
+"""
+
+import io
+import os
+import shutil
+import sqlite3
+import struct
+import time
+
+default_storage = "folder"
+
+
+class FolderStorage(object):
+    """One file per page in the folder of the run."""
+    name = "folder"
+    extension = ""
+
+    @staticmethod
+    def run_path(raw_data_path):
+        return raw_data_path
+
+    @staticmethod
+    def has_run(raw_data_path):
+        return os.path.isdir(raw_data_path)
+
+    @staticmethod
+    def prepare_run(raw_data_path):
+        """Create what is needed to write pages to the run."""
+        if not os.path.isdir(raw_data_path):
+            os.makedirs(raw_data_path)
+
+    @staticmethod
+    def write_page(raw_data_path, filename, contents):
+        with io.open(os.path.join(raw_data_path, filename), "wb") as f:
+            f.write(contents)
+
+    @staticmethod
+    def filenames(raw_data_path):
+        return sorted(os.listdir(raw_data_path))
+
+    @staticmethod
+    def read_page(raw_data_path, filename):
+        """Return the contents of the page. Raises KeyError if the run has no page with the name."""
+        path = os.path.join(raw_data_path, filename)
+        if not os.path.isfile(path):
+            raise KeyError("No page {} in {}".format(filename, raw_data_path))
+        with io.open(path, "rb") as f:
+            return f.read()
+
+    @staticmethod
+    def read_pages(raw_data_path):
+        """Return a generator of the (filename, contents, mtime) of the pages, ordered by filename."""
+        for filename in FolderStorage.filenames(raw_data_path):
+            path = os.path.join(raw_data_path, filename)
+            with io.open(path, "rb") as f:
+                contents = f.read()
+            yield filename, contents, os.stat(path).st_mtime
+
+    @staticmethod
+    def delete_run(raw_data_path):
+        shutil.rmtree(raw_data_path)
+
+    @staticmethod
+    def import_run(src_raw_data_path, dst_raw_data_path):
+        """Hardlink the pages of the run at src into the run at dst, leaving the pages that are already there."""
+        FolderStorage.prepare_run(dst_raw_data_path)
+        for filename in os.listdir(src_raw_data_path):
+            dst = os.path.join(dst_raw_data_path, filename)
+            if not os.path.exists(dst):
+                os.link(os.path.join(src_raw_data_path, filename), dst)
+
+
+def link_file(src, dst):
+    """Hardlink the file src to dst, unless dst already exists."""
+    if not os.path.exists(dst):
+        os.link(src, dst)
+
+
+segment_magic = b"SMETSEG1"
+segment_record = struct.Struct(">HId")
+
+
+class SegmentStorage(object):
+    """The pages of the run appended to one file.
+
+    The file is the magic bytes followed by one record per page: the lengths of the name and contents and the
+    modification time, then the name and contents. Records are only ever appended, each with a single write, so a
+    page that was being written when the process died is ignored when reading. If a name occurs more than once, the
+    last page with the name wins.
+    """
+    name = "segment"
+    extension = ".segment"
+
+    @staticmethod
+    def run_path(raw_data_path):
+        return raw_data_path + SegmentStorage.extension
+
+    @staticmethod
+    def has_run(raw_data_path):
+        return os.path.isfile(SegmentStorage.run_path(raw_data_path))
+
+    @staticmethod
+    def prepare_run(raw_data_path):
+        folder = os.path.dirname(raw_data_path)
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        with io.open(SegmentStorage.run_path(raw_data_path), "ab") as f:
+            if f.tell() == 0:
+                f.write(segment_magic)
+
+    @staticmethod
+    def write_page(raw_data_path, filename, contents):
+        name = filename.encode("utf-8")
+        record = segment_record.pack(len(name), len(contents), time.time()) + name + contents
+        with io.open(SegmentStorage.run_path(raw_data_path), "ab") as f:
+            if f.tell() == 0:
+                f.write(segment_magic)
+            f.write(record)
+
+    @staticmethod
+    def records(raw_data_path):
+        """Return a dict of name -> (contents, mtime) of the complete records in the file."""
+        with io.open(SegmentStorage.run_path(raw_data_path), "rb") as f:
+            data = f.read()
+        if not data.startswith(segment_magic):
+            raise ValueError("{} is not a segment file".format(SegmentStorage.run_path(raw_data_path)))
+        pages = {}
+        offset = len(segment_magic)
+        while offset + segment_record.size <= len(data):
+            name_length, contents_length, mtime = segment_record.unpack_from(data, offset)
+            start = offset + segment_record.size
+            end = start + name_length + contents_length
+            if end > len(data):
+                break
+            name = data[start:start + name_length].decode("utf-8")
+            pages[name] = (data[start + name_length:end], mtime)
+            offset = end
+        return pages
+
+    @staticmethod
+    def filenames(raw_data_path):
+        return sorted(SegmentStorage.records(raw_data_path).keys())
+
+    @staticmethod
+    def read_page(raw_data_path, filename):
+        """Return the contents of the page. Raises KeyError if the run has no page with the name."""
+        return SegmentStorage.records(raw_data_path)[filename][0]
+
+    @staticmethod
+    def read_pages(raw_data_path):
+        """Return a generator of the (filename, contents, mtime) of the pages, ordered by filename."""
+        pages = SegmentStorage.records(raw_data_path)
+        for filename in sorted(pages.keys()):
+            contents, mtime = pages[filename]
+            yield filename, contents, mtime
+
+    @staticmethod
+    def delete_run(raw_data_path):
+        os.remove(SegmentStorage.run_path(raw_data_path))
+
+    @staticmethod
+    def import_run(src_raw_data_path, dst_raw_data_path):
+        link_file(SegmentStorage.run_path(src_raw_data_path), SegmentStorage.run_path(dst_raw_data_path))
+
+
+class SqliteStorage(object):
+    """The pages of the run as blobs in a sqlite db."""
+    name = "sqlite"
+    extension = ".db"
+
+    @staticmethod
+    def run_path(raw_data_path):
+        return raw_data_path + SqliteStorage.extension
+
+    @staticmethod
+    def has_run(raw_data_path):
+        return os.path.isfile(SqliteStorage.run_path(raw_data_path))
+
+    @staticmethod
+    def connect(raw_data_path):
+        connection = sqlite3.connect(SqliteStorage.run_path(raw_data_path), timeout=60)
+        connection.execute("CREATE TABLE IF NOT EXISTS pages (name TEXT PRIMARY KEY, mtime REAL, body BLOB)")
+        return connection
+
+    @staticmethod
+    def prepare_run(raw_data_path):
+        folder = os.path.dirname(raw_data_path)
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        SqliteStorage.connect(raw_data_path).close()
+
+    @staticmethod
+    def write_page(raw_data_path, filename, contents):
+        connection = SqliteStorage.connect(raw_data_path)
+        try:
+            with connection:
+                connection.execute("INSERT OR REPLACE INTO pages VALUES (?, ?, ?)",
+                                   (filename, time.time(), sqlite3.Binary(contents)))
+        finally:
+            connection.close()
+
+    @staticmethod
+    def filenames(raw_data_path):
+        connection = SqliteStorage.connect(raw_data_path)
+        try:
+            return [row[0] for row in connection.execute("SELECT name FROM pages ORDER BY name")]
+        finally:
+            connection.close()
+
+    @staticmethod
+    def read_page(raw_data_path, filename):
+        """Return the contents of the page. Raises KeyError if the run has no page with the name."""
+        connection = SqliteStorage.connect(raw_data_path)
+        try:
+            row = connection.execute("SELECT body FROM pages WHERE name = ?", (filename,)).fetchone()
+        finally:
+            connection.close()
+        if row is None:
+            raise KeyError("No page {} in {}".format(filename, SqliteStorage.run_path(raw_data_path)))
+        return bytes(row[0])
+
+    @staticmethod
+    def read_pages(raw_data_path):
+        """Return a generator of the (filename, contents, mtime) of the pages, ordered by filename."""
+        connection = SqliteStorage.connect(raw_data_path)
+        try:
+            for name, mtime, body in connection.execute("SELECT name, mtime, body FROM pages ORDER BY name"):
+                yield name, bytes(body), mtime
+        finally:
+            connection.close()
+
+    @staticmethod
+    def delete_run(raw_data_path):
+        os.remove(SqliteStorage.run_path(raw_data_path))
+
+    @staticmethod
+    def import_run(src_raw_data_path, dst_raw_data_path):
+        link_file(SqliteStorage.run_path(src_raw_data_path), SqliteStorage.run_path(dst_raw_data_path))
+
+
+storages = [FolderStorage, SegmentStorage, SqliteStorage]
+
+
+def storage_names():
+    return [storage.name for storage in storages]
+
+
+def storage_for_name(name):
+    """Return the storage with the name. Raises ValueError if there is no such storage."""
+    for storage in storages:
+        if storage.name == name:
+            return storage
+    raise ValueError("Unknown storage {}. Known storages are {}".format(name, ", ".join(storage_names())))
+
+
+def storage_for_run(raw_data_path):
+    """Return the storage that holds the run with the folder path raw_data_path, or None if there is no such run."""
+    for storage in storages:
+        if storage.has_run(raw_data_path):
+            return storage
+    return None
+
+
+def run_folder_name(filename):
+    """The name of the run stored in the file or folder in raw/<race>/ with the name, or None if it is not a run."""
+    for storage in storages[1:]:
+        if filename.endswith(storage.extension):
+            return filename[:-len(storage.extension)]
+    if "." in filename:
+        return None
+    return filename
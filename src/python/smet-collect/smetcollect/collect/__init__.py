@@ -11,5 +11,9 @@ Copyright (c) 2015 Chandrasekhar Ramakrishnan. All rights reserved.
 """
 
 from .collect import (CollectorConfig, TweetCollector, RawImport)
-from .compress import (Compressor, CompressorConfig, Archiver, Purger, PurgerConfig, Rebuilder, Uncompressor)
-
+from .compress import (Compressor, CompressorConfig, Archiver, Purger, PurgerConfig, Rebuilder, Uncompressor,
+                       Verifier, VerifierConfig, DictionaryTrainer, DictionaryTrainerConfig,
+                       Compactor, CompactorConfig, Recompressor, RecompressorConfig, Partitioner, PartitionerConfig,
+                       Columnizer)
+from .pipeline import (DagScheduler, Pipeline, PipelineConfig, PipelineJobs, ShardedPipeline)
+from .ledger import RateBudgetLedger
@@ -33,39 +33,68 @@ else:
 from ..bundle import datetime_to_results_filename, results_filename_to_datetime, datetime_to_run_folder_name, \
     run_folder_name_to_datetime, slug_for_race
 from ..bundle.status_db import Run, Search, SearchTerm, Candidate
+from ..bundle.dictionary import DictionaryStore, page_extension
+from ..bundle import raw, storage
+from .ledger import RateBudgetLedger
 
 # The default limit for running searches is 2h between search requets
 default_collector_wait_period = 2
 
 
-def write_json_string(json_str, now, folder_path):
+def write_json_string(json_str, now, folder_path, raw_storage=None):
     output_filename = datetime_to_results_filename(now)
-    out_path = os.path.join(folder_path, output_filename)
-    with open(out_path, "w") as f:
-        f.write(json_str)
+    raw_storage = raw_storage if raw_storage is not None else storage.FolderStorage
+    raw_storage.write_page(folder_path, output_filename, json_str.encode("utf-8"))
     return output_filename
 
 
-def default_results_save_func(now, results, folder_path):
-    """Write the twitter results to a new file in folder_path.
+def default_results_save_func(now, results, folder_path, raw_storage=None):
+    """Write the twitter results to a new page of the run in folder_path.
     :param results: The search results to store
-    :param folder_path: The path to write it to. Assumes that the parent directory exists.
+    :param folder_path: The path of the run folder. Assumes that the run has been prepared for the storage.
+    :param raw_storage: The storage for the pages of the run. Defaults to a file per page in folder_path.
     """
     if None == results:
         return
     results_str = json.dumps(results, separators=(',', ': '))
-    return write_json_string(results_str, now, folder_path)
+    return write_json_string(results_str, now, folder_path, raw_storage)
 
 
-def pretty_print_results_save_func(now, results, folder_path):
-    """Write the twitter results pretty printed to a new file in folder_path.
+def dictionary_results_save_func(now, results, folder_path, raw_storage=None):
+    """Write the twitter results compressed with the newest dictionary trained for the race.
+
+    Falls back to default_results_save_func if no dictionary has been trained.
+    :param results: The search results to store
+    :param folder_path: The path of the run folder. Assumes that the run has been prepared for the storage.
+    :param raw_storage: The storage for the pages of the run. Defaults to a file per page in folder_path.
+    """
+    if None == results:
+        return
+    dictionary = DictionaryStore.for_race_folder(os.path.dirname(folder_path)).latest()
+    if dictionary is None:
+        return default_results_save_func(now, results, folder_path, raw_storage)
+    results_str = json.dumps(results, separators=(',', ': '))
+    output_filename = datetime_to_results_filename(now) + page_extension
+    raw_storage = raw_storage if raw_storage is not None else storage.FolderStorage
+    raw_storage.write_page(folder_path, output_filename, dictionary.encode_page(results_str.encode("utf-8")))
+    return output_filename
+
+
+def read_results(raw_data_path, filename):
+    """Read the search results in a page of a run, which may have been compressed with a dictionary."""
+    return json.loads(raw.read_page(raw_data_path, filename).decode("utf-8"))
+
+
+def pretty_print_results_save_func(now, results, folder_path, raw_storage=None):
+    """Write the twitter results pretty printed to a new page of the run in folder_path.
     :param results: The search results to store
-    :param folder_path: The path to write it to. Assumes that the parent directory exists.
+    :param folder_path: The path of the run folder. Assumes that the run has been prepared for the storage.
+    :param raw_storage: The storage for the pages of the run. Defaults to a file per page in folder_path.
     """
     if None == results:
         return
     results_str = json.dumps(results, indent=4, separators=(',', ': '))
-    return write_json_string(results_str, now, folder_path)
+    return write_json_string(results_str, now, folder_path, raw_storage)
 
 
 def rate_limit_info(limit_remaining, limit_reset, progress_func):
@@ -97,15 +126,18 @@ def earliest_and_latest_tweet_dates(results):
 class CollectorConfig(object):
     """Gathers configuration information for the TweetCollector"""
 
-    def __init__(self, wait_period=None, save_func=None, max_depth=5):
+    def __init__(self, wait_period=None, save_func=None, max_depth=5, rate_ledger_folder=None):
         """
         :param wait_period: The minimum number of hours to wait between searches (float)
         :param save_func: A function that saves twitter data to disk
         :param max_depth: The maximum number of calls per search term. Defaults to 5, use None for unlimited
+        :param rate_ledger_folder: The folder of the rate budget ledgers shared with other collectors (see ledger.py).
+            Defaults to None, for no ledger.
         """
         self.save_func = save_func if save_func else default_results_save_func
         self.wait_period = wait_period if wait_period is not None else default_collector_wait_period
         self.max_depth = max_depth
+        self.rate_ledger_folder = rate_ledger_folder
 
 
 class TweetCollector(object):
@@ -126,6 +158,9 @@ class TweetCollector(object):
         self.until = until
         credentials = status.bundle.credentials
         self.twitter = Twython(credentials.app_key, access_token=credentials.access_token)
+        self.ledger = None
+        if self.config.rate_ledger_folder is not None:
+            self.ledger = RateBudgetLedger.for_credentials(self.config.rate_ledger_folder, credentials)
         self.called_twitter = False
         self.collector_run = None  # To be filled in
 
@@ -159,7 +194,8 @@ class TweetCollector(object):
     def run_searches_for_race(self, race):
         """Get the most recent tweets for the particular race
         """
-        race_collector = TweetRaceCollector(self.status, self.config, self.twitter, self.resume, race, self.until)
+        race_collector = TweetRaceCollector(self.status, self.config, self.twitter, self.resume, race, self.until,
+                                            self.ledger)
         race_collector.run()
         self.called_twitter = self.called_twitter or race_collector.called_twitter
 
@@ -167,17 +203,19 @@ class TweetCollector(object):
 class TweetRaceCollector(object):
     """Collects search results for one race"""
 
-    def __init__(self, status, config, twitter, resume, race, until=None):
+    def __init__(self, status, config, twitter, resume, race, until=None, ledger=None):
         """Constructor for the tweet collector
         :param status: The CollectorStatus object that tracks status state
         :param config: Configuration for the tweet collector
         :param twitter: The twitter object
         :param resume: Resume the last run if true, otherwise start a new run
         :param race: The race to run a search for
+        :param ledger: The RateBudgetLedger of the credentials, or None
         """
         self.status = status
         self.config = config
         self.twitter = twitter
+        self.ledger = ledger
         self.resume = resume
         self.race = race
         self.until = until
@@ -188,6 +226,7 @@ class TweetRaceCollector(object):
         self.collector_run = None
         self.previous_collector_run = None
         self.output_folder_path = None
+        self.output_storage = None
         self.current_time = None
 
     def initialize_state(self):
@@ -213,6 +252,8 @@ class TweetRaceCollector(object):
 
         # self.output_folder_path = os.path.join(self.status.raw_data_folder_path_for_race(self.race), run_folder_name)
         self.output_folder_path = self.status.raw_data_folder_path_for_run(self.race, self.collector_run)
+        # A resumed run is continued in the storage it was started in
+        self.output_storage = storage.storage_for_run(self.output_folder_path) or self.status.raw_storage
         self.ensure_output_folder_exists()
 
     def run(self):
@@ -346,7 +387,7 @@ class TweetRaceCollector(object):
 
     def process_results(self, results, search_term):
         now = self.current_time
-        output_filename = self.config.save_func(now, results, self.output_folder_path)
+        output_filename = self.config.save_func(now, results, self.output_folder_path, self.output_storage)
         result_max_id = long(results['search_metadata']['max_id'])
         earliest_tweet_date, latest_tweet_date = earliest_and_latest_tweet_dates(results)
 
@@ -374,19 +415,37 @@ class TweetRaceCollector(object):
             self.status.progress_func({'type': 'search', 'message': msg})
         try:
             self.called_twitter = True
+            self.wait_for_rate_budget()
             results = self.twitter.search(q=query_str, result_type=result_type,
                                           include_entities=1, count=100, **kwargs)
         except TwythonRateLimitError as inst:
             limit_reset = self.twitter.get_lastfunction_header('x-rate-limit-reset')
+            if self.ledger is not None:
+                self.ledger.record(0, limit_reset)
             limit, sleep_dur = rate_limit_info(0, limit_reset, self.status.progress_func)
             msg = 'Hit rate limit {}, sleeping {}s'.format(inst.msg, sleep_dur.total_seconds())
             self.status.progress_func({'type': 'rate-limit', 'message': msg})
             if sleep_dur.total_seconds() > 0:
                 time.sleep(sleep_dur.total_seconds())
+            self.wait_for_rate_budget()
             results = self.twitter.search(q=query_str, result_type=result_type,
                                           include_entities=1, count=100, **kwargs)
+        if self.ledger is not None:
+            self.ledger.record(self.twitter.get_lastfunction_header('x-rate-limit-remaining'),
+                               self.twitter.get_lastfunction_header('x-rate-limit-reset'))
         return results
 
+    def wait_for_rate_budget(self):
+        """Wait until the searches of the other collectors with the same credentials leave room for one more."""
+        if self.ledger is None:
+            return
+        wait = self.ledger.reserve()
+        while wait > 0:
+            msg = 'Rate budget of the credentials used up, sleeping {}s'.format(wait)
+            self.status.progress_func({'type': 'rate-limit', 'message': msg})
+            time.sleep(wait)
+            wait = self.ledger.reserve()
+
     def update_status_db(self, now, output_filename, result_max_id, search_term,
                          earliest_tweet_date, latest_tweet_date):
 
@@ -397,13 +456,10 @@ class TweetRaceCollector(object):
         self.status.session.commit()
 
     def ensure_output_folder_exists(self):
-        self.status.ensure_folder_exists(self.output_folder_path)
+        self.output_storage.prepare_run(self.output_folder_path)
 
     def read_search_results(self, search):
-        data_path = os.path.join(self.output_folder_path, search.results_path)
-        with open(data_path) as f:
-            results = json.load(f)
-        return results
+        return read_results(self.output_folder_path, search.results_path)
 
     def move_time_forward(self):
         self.current_time = self.status.datetime_provider()
@@ -447,7 +503,9 @@ class RawImport(object):
         msg = 'Importing data for race {}'.format(race.name)
         self.status.progress_func({'type': 'import', 'message': msg})
         for path in os.listdir(import_raw_data_path):
-            self.import_runs(race, import_raw_data_path, bundle_raw_data_path, path)
+            run_folder_name = storage.run_folder_name(path)
+            if run_folder_name is not None:
+                self.import_runs(race, import_raw_data_path, bundle_raw_data_path, run_folder_name)
 
     def prepare_import_run(self, race, import_run_path, bundle_run_path, run_folder_name):
         now = run_folder_name_to_datetime(run_folder_name)
@@ -457,21 +515,12 @@ class RawImport(object):
         if existing_run is not None:
             return None
 
-        # Copy the files to the bundle path if necessary and create a run
-        self.status.ensure_folder_exists(bundle_run_path)
-        self.hardlink_copy(import_run_path, bundle_run_path)
+        # Copy the pages to the bundle path if necessary and create a run
+        storage.storage_for_run(import_run_path).import_run(import_run_path, bundle_run_path)
 
         collector_run = Run(start=now, results_folder=run_folder_name, race=race)
         return collector_run
 
-    @staticmethod
-    def hardlink_copy(import_run_path, bundle_run_path):
-        for path in os.listdir(import_run_path):
-            src = os.path.join(import_run_path, path)
-            dst = os.path.join(bundle_run_path, path)
-            if not os.path.exists(dst):
-                os.link(src, dst)
-
     def import_runs(self, race, import_raw_data_path, bundle_raw_data_path, run_folder_name):
         import_run_path = os.path.join(import_raw_data_path, run_folder_name)
         bundle_run_path = os.path.join(bundle_raw_data_path, run_folder_name)
@@ -487,7 +536,7 @@ class RawImport(object):
         self.status.progress_func({'type': 'import', 'message': msg})
         self.imported_run_folders.append(run_folder_name)
 
-        for path in os.listdir(bundle_run_path):
+        for path in raw.run_filenames(bundle_run_path):
             self.import_search_results(race, collector_run, bundle_run_path, path)
 
         self.status.session.commit()
@@ -495,12 +544,11 @@ class RawImport(object):
     def import_search_results(self, race, collector_run, run_data_path, path):
         """Import the information from the data files into the db"""
         data_path = os.path.join(run_data_path, path)
-        with open(data_path) as f:
-            results = json.load(f)
-            search_metadata = results['search_metadata']
-            query_params = urlparse.parse_qs(urlparse.urlparse(search_metadata.get('refresh_url')).query)
-            search_term_str = query_params['q'][0]
-            max_id = long(search_metadata['max_id'])
+        results = read_results(run_data_path, path)
+        search_metadata = results['search_metadata']
+        query_params = urlparse.parse_qs(urlparse.urlparse(search_metadata.get('refresh_url')).query)
+        search_term_str = query_params['q'][0]
+        max_id = long(search_metadata['max_id'])
         # Find the candidate/search_term this belongs to
         candidate = race.candidates.join(SearchTerm).filter(SearchTerm.term == search_term_str).first()
         if not candidate:
@@ -520,7 +568,10 @@ class RawImport(object):
     def update_status_db(self, output_filename, collector_run, result_max_id, search_term,
                          earliest_tweet_date, latest_tweet_date):
 
-        now = results_filename_to_datetime(output_filename)
+        results_filename = output_filename
+        if results_filename.endswith(page_extension):
+            results_filename = results_filename[:-len(page_extension)]
+        now = results_filename_to_datetime(results_filename)
         search_obj = Search(date=now, max_id=result_max_id, results_path=output_filename,
                             earliest=earliest_tweet_date,
                             latest=latest_tweet_date)
@@ -19,6 +19,7 @@ import six
 
 from .. import bundle
 from . import collect
+from . import ledger
 from .. import conftest
 
 if not six.PY2:
@@ -60,7 +61,8 @@ class MockTwython(object):
     def __init__(self, data_path):
         self.data_path = data_path
         self.results_folder_path = os.path.join(self.data_path, "chicago-mayor-runoff-2015")
-        call_sequence = [os.path.join(self.results_folder_path, fn) for fn in os.listdir(self.results_folder_path)]
+        call_sequence = [os.path.join(self.results_folder_path, fn)
+                         for fn in sorted(os.listdir(self.results_folder_path))]
         # TODO Rename to original call sequences
         self.call_sequence = [fn for fn in call_sequence if os.path.isfile(fn)]
         self.call_sequence_index = 0
@@ -356,6 +358,60 @@ def test_collector_wait_period(smet_bundle, tmpdir):
     assert mock_twython_contd.seen_since_id_count == 0
 
 
+def test_rate_budget_ledger(tmpdir):
+    now = [1000.0]
+    first = ledger.RateBudgetLedger(str(tmpdir), "key", lambda: now[0])
+    second = ledger.RateBudgetLedger(str(tmpdir), "key", lambda: now[0])
+
+    # Until a search has reported the window, searches draw from a provisional one
+    assert 0 == first.reserve()
+    assert {"reset": 1000 + ledger.window_seconds, "remaining": ledger.provisional_budget - 1,
+            "provisional": True} == second.read()
+    # The first reply replaces it, even if its window ends sooner
+    first.record(2, 1900)
+
+    # The collectors share the remaining budget
+    assert 0 == second.reserve()
+    assert 0 == first.reserve()
+    assert 900 == second.reserve()
+
+    # A reply for a search reserved earlier does not give back the budget taken since
+    second.record(1, 1900)
+    assert 900 == first.reserve()
+    # Nor does a reply from an older window
+    first.record(100, 1000)
+    assert 900 == first.reserve()
+
+    # Once the window has reset, searches go ahead on a new provisional window, and the next reply corrects it
+    now[0] = 1900.0
+    assert 0 == first.reserve()
+    assert second.read()["provisional"]
+    # A late reply from the window that ended does not
+    second.record(0, 1900)
+    assert second.read()["provisional"]
+    first.record(5, 2800)
+    assert {"reset": 2800, "remaining": 5} == second.read()
+
+    # Ledgers of other credentials are separate
+    assert 0 == ledger.RateBudgetLedger(str(tmpdir), "other", lambda: now[0]).reserve()
+
+
+def test_collector_with_ledger(smet_bundle, tmpdir):
+    status = initialized_bundle_status(smet_bundle, tmpdir)
+    ledger_folder = tmpdir.join("ledger")
+
+    collector = collect.TweetCollector(status, collect.CollectorConfig(rate_ledger_folder=str(ledger_folder)))
+    mock_twython = MockTwython(results_cache_path())
+    collector.twitter = mock_twython
+    collector.run()
+
+    # The collector recorded the budget left after its last search
+    state = collector.ledger.read()
+    assert 100 - mock_twython.call_sequence_index == state["remaining"]
+    key = ledger.credentials_key(smet_bundle.credentials)
+    assert ledger_folder.join("{}.json".format(key)).check()
+
+
 def test_importer(smet_bundle, tmpdir, smet_bundle2):
     # First create an initial run structure to import
     test_collector_resuming(smet_bundle, tmpdir)
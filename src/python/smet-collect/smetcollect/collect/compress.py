@@ -10,27 +10,34 @@ Created by Chandrasekhar Ramakrishnan on 2015-11-06.
 Copyright (c) 2015 Chandrasekhar Ramakrishnan. All rights reserved.
 """
 
+import multiprocessing
 import os
 import shutil
-import subprocess
-import tarfile
-import json
 from collections import defaultdict
+from datetime import timedelta
+from multiprocessing.pool import ThreadPool
 
-from ..bundle import slug_for_race
+from ..bundle import slug_for_race, run_folder_name_to_datetime, archive, columns, container, raw, dictionary, pruned
 from ..bundle.status_db import Run
-from ..process.prune import Pruner
+from ..process.prune import Pruner, PrunerConfig
 from ..process.jq import JqEngineConfig, JqEngine
 
 
 class CompressorConfig(object):
     """Gathers configuration information for the TweetCollector"""
 
-    def __init__(self, max_depth=5):
+    def __init__(self, max_depth=5, codec=archive.default_codec, level=None, workers=None):
         """
         :param max_depth: The maximum number of runs per race to compress. Use None or non-positive to compress all.
+        :param codec: The name of the codec to compress new archives with (see archive.codec_names()).
+        :param level: The compression level, or None for the default level of the codec.
+        :param workers: The number of threads to compress with. Defaults to the number of cpus.
         """
         self.max_depth = max_depth if max_depth > 1 else None
+        archive.codec_for_name(codec)
+        self.codec = codec
+        self.level = level
+        self.workers = workers if workers is not None and workers > 0 else multiprocessing.cpu_count()
 
 
 class Compressor(object):
@@ -69,49 +76,77 @@ class Compressor(object):
             self.status.progress_func({'type': 'progress', 'message': msg})
 
     def do_compress(self):
-        """Really compress the runs"""
+        """Really compress the runs.
+
+        Compression happens in this process on a pool of threads: the codecs release the GIL while compressing a
+        block, so several runs, and several blocks of one run, are compressed at the same time.
+        """
         races = self.runs_to_compress.keys()
+        race_runs = []
         for race in races:
             self.status.ensure_folder_exists(self.status.compressed_data_folder_path_for_race(race))
             runs = self.runs_to_compress[race]
             if self.config.max_depth:
                 runs = runs[0:self.config.max_depth]
-            for run in runs:
-                self.compress_run(race, run)
+            race_runs.extend((race, run) for run in runs)
+        if len(race_runs) < 1:
+            return
 
-    def compress_run(self, race, run):
+        block_pool = ThreadPool(self.config.workers)
+        run_pool = ThreadPool(min(self.config.workers, len(race_runs)))
+        try:
+            results = [run_pool.apply_async(self.compress_run, (race, run, block_pool)) for race, run in race_runs]
+            for result in results:
+                result.get()
+        finally:
+            run_pool.close()
+            run_pool.join()
+            block_pool.close()
+            block_pool.join()
+
+    def compress_run(self, race, run, pool=None):
         raw_data_path = self.status.raw_data_folder_path_for_run(race, run)
-        if not os.path.exists(raw_data_path):
+        if not raw.raw_run_exists(raw_data_path):
             msg = "No run found at {}. Skipping...".format(self.status.path_relative_to_bundle(raw_data_path).encode('utf-8'))
             self.status.progress_func({'type': 'compress', 'message': msg})
             return
-        compressed_data_path = self.status.compressed_data_file_path_for_run(race, run)
+        compressed_data_path = self.status.compressed_data_file_path_for_run(race, run, self.config.codec)
         msg = "Compressing run {} to {}".format(
             self.status.path_relative_to_bundle(raw_data_path).encode('utf-8'),
             self.status.path_relative_to_bundle(compressed_data_path).encode('utf-8'))
         self.status.progress_func({'type': 'compress', 'message': msg})
-        subprocess.call(['tar', '-cjf', compressed_data_path,
-                         '-C', self.status.raw_data_folder_path_for_race(race),
-                         run.results_folder])
+        writer = archive.archive_writer(compressed_data_path, run.results_folder, self.config.level, pool)
+        try:
+            for filename, contents, mtime in raw.read_raw_folder(raw_data_path):
+                writer.add_page(filename, contents, mtime)
+        except Exception:
+            writer.abort()
+            raise
+        writer.close()
         if not self.verify_archive(run, raw_data_path, compressed_data_path):
             self.status.progress_func({'type': 'compress', 'message': "Removing corrupt archive..."})
-            os.remove(compressed_data_path)
+            archive.remove_archive(compressed_data_path)
             self.status.progress_func({'type': 'compress', 'message': "Done."})
 
     def verify_archive(self, run, raw_data_path, compressed_data_path):
-        """Check that the archive is ok. Return True if it is, False if there is a problem."""
-        archive = tarfile.open(compressed_data_path)
-        for path in os.listdir(raw_data_path):
-            try:
-                archive_info = archive.getmember(os.path.join(run.results_folder, path))
-                if archive_info.size < 0:
-                    msg = "File {} is corrupt in archive".format(path)
-                    self.status.progress_func({'type': 'compress', 'message': msg})
-                    return False
-            except KeyError:
-                msg = "File {} is not in archive".format(path)
+        """Check that the archive is ok. Return True if it is, False if there is a problem.
+
+        The manifest must list every file in the raw folder, and the archive is read once to compare the checksum of
+        each file against the manifest.
+        """
+        manifest = archive.read_manifest(compressed_data_path)
+        problems = archive.verify_archive(compressed_data_path, manifest)
+        if manifest is not None:
+            members = manifest["members"]
+            extension = dictionary.page_extension
+            filenames = sorted(filename[:-len(extension)] if filename.endswith(extension) else filename
+                               for filename in raw.run_filenames(raw_data_path))
+            problems.extend("File {} is not in archive".format(filename) for filename in filenames
+                            if os.path.join(run.results_folder, filename) not in members)
+        if problems:
+            for msg in problems:
                 self.status.progress_func({'type': 'compress', 'message': msg})
-                return False
+            return False
 
         msg = "Archive verified."
         self.status.progress_func({'type': 'compress', 'message': msg})
@@ -142,10 +177,144 @@ class Compressor(object):
         for run in race.runs.order_by(Run.start.desc()):
             if self.status.has_pruned_data_for_run(race, run):
                 compressed_data_path = self.status.compressed_data_file_path_for_run(race, run)
-                if not os.path.exists(compressed_data_path):
+                if not archive.archive_exists(compressed_data_path):
                     self.runs_to_compress[race].append(run)
 
 
+class RecompressorConfig(object):
+    """Configuration for recompressing the archives of old runs"""
+
+    def __init__(self, max_depth=5, codec=None, level=None, min_age_days=7, workers=None):
+        """
+        :param max_depth: The maximum number of runs per race to recompress. Use None or non-positive for all.
+        :param codec: The name of the codec to recompress with. Defaults to the densest available codec.
+        :param level: The compression level, or None for the default level of the codec.
+        :param min_age_days: Only the archives of runs at least this many days old are recompressed.
+        :param workers: The number of threads to compress with. Defaults to the number of cpus.
+        """
+        self.max_depth = max_depth if max_depth > 1 else None
+        self.codec = codec if codec is not None else archive.dense_codec()
+        archive.codec_for_name(self.codec)
+        self.level = level
+        self.min_age_days = min_age_days
+        self.workers = workers if workers is not None and workers > 0 else multiprocessing.cpu_count()
+
+
+class Recompressor(object):
+    """Recompress the archives of old runs with a codec that has a higher ratio.
+
+    New runs can be compressed with a fast codec (see archive.fast_codec) so compression keeps up with collection,
+    and recompressed once they are old. The new archive is verified against the manifest of the old one before the
+    old archive is removed. Archives in containers are left as they are.
+    """
+
+    def __init__(self, status, config=None, race=None):
+        """Constructor for the recompressor.
+        :param status: The bundle status object
+        :param config: The configuration for the recompressor (a RecompressorConfig)
+        :param race: The slug for a race if should restrict to one race
+        """
+        self.status = status
+        self.config = config if config else RecompressorConfig()
+        self.race_slug = race
+        self.runs_to_recompress = defaultdict(list)
+        self.failed_runs = []
+
+    def run(self):
+        """Run recompression for matching races"""
+        for race in self.status.races_matching_slug(self.race_slug):
+            self.collect_runs_from_race(race)
+        self.log_intermediate_progress_update()
+        self.do_recompress()
+        msg = 'Recompressing finished'
+        self.status.progress_func({'type': 'progress', 'message': msg})
+
+    def log_intermediate_progress_update(self):
+        races = self.runs_to_recompress.keys()
+        if len(races) < 1:
+            self.status.progress_func({'type': 'progress', 'message': "No runs to recompress."})
+            return
+        for key in races:
+            runs = self.runs_to_recompress[key]
+            msg = "Race {} has {} runs to recompress".format(key.name.encode('utf-8'), len(runs))
+            self.status.progress_func({'type': 'progress', 'message': msg})
+        if self.config.max_depth is not None:
+            msg = "\tLimiting to {} runs per race".format(self.config.max_depth)
+            self.status.progress_func({'type': 'progress', 'message': msg})
+
+    def do_recompress(self):
+        """Really recompress the runs, several at a time, like Compressor.do_compress"""
+        race_runs = []
+        for race, runs in self.runs_to_recompress.items():
+            if self.config.max_depth:
+                runs = runs[0:self.config.max_depth]
+            race_runs.extend((race, run) for run in runs)
+        if len(race_runs) < 1:
+            return
+
+        block_pool = ThreadPool(self.config.workers)
+        run_pool = ThreadPool(min(self.config.workers, len(race_runs)))
+        try:
+            results = [run_pool.apply_async(self.recompress_run, (race, run, block_pool)) for race, run in race_runs]
+            for result in results:
+                result.get()
+        finally:
+            run_pool.close()
+            run_pool.join()
+            block_pool.close()
+            block_pool.join()
+
+    def recompress_run(self, race, run, pool=None):
+        old_path = self.status.compressed_data_file_path_for_run(race, run)
+        new_path = self.status.compressed_data_file_path_for_run(race, run, self.config.codec)
+        manifest = archive.read_manifest(old_path)
+        if manifest is None:
+            msg = "Archive {} has no manifest. Run verify --add-missing first. Skipping...".format(
+                self.status.path_relative_to_bundle(old_path).encode('utf-8'))
+            self.status.progress_func({'type': 'error', 'message': msg})
+            self.failed_runs.append(run)
+            return
+        msg = "Recompressing {} to {}".format(self.status.path_relative_to_bundle(old_path).encode('utf-8'),
+                                              self.status.path_relative_to_bundle(new_path).encode('utf-8'))
+        self.status.progress_func({'type': 'compress', 'message': msg})
+        writer = archive.archive_writer(new_path, run.results_folder, self.config.level, pool)
+        try:
+            for filename, contents, mtime in archive.archive_entries(old_path):
+                writer.add_page(filename, contents, mtime)
+        except Exception:
+            writer.abort()
+            raise
+        writer.close()
+
+        # Both archives share the manifest path, so the manifest of the old archive is restored if the new one is bad
+        problems = archive.verify_archive(new_path, manifest)
+        if problems:
+            for problem in problems:
+                msg = "{}: {}".format(self.status.path_relative_to_bundle(new_path).encode('utf-8'), problem)
+                self.status.progress_func({'type': 'error', 'message': msg})
+            os.remove(new_path)
+            archive.write_manifest(old_path, archive.codec_for_path(old_path), manifest["members"])
+            self.failed_runs.append(run)
+            return
+        os.remove(old_path)
+
+    def collect_runs_from_race(self, race):
+        """Collect the runs in the race that are old enough and have an archive in another codec
+        """
+        msg = "Collecting runs from race {}".format(race.name.encode('utf-8'))
+        self.status.progress_func({'type': 'progress', 'message': msg})
+        cutoff = self.status.datetime_provider() - timedelta(days=self.config.min_age_days)
+        for run in race.runs.order_by(Run.start):
+            if run_folder_name_to_datetime(run.results_folder) > cutoff:
+                continue
+            compressed_data_path = self.status.compressed_data_file_path_for_run(race, run)
+            if container.split_member_path(compressed_data_path) is not None \
+                    or not os.path.exists(compressed_data_path):
+                continue
+            if archive.codec_for_path(compressed_data_path).name != self.config.codec:
+                self.runs_to_recompress[race].append(run)
+
+
 class Uncompressor(object):
     """Uncompress raw data"""
 
@@ -199,8 +368,7 @@ class Uncompressor(object):
             self.status.path_relative_to_bundle(compressed_data_path),
             self.status.path_relative_to_bundle(raw_data_path))
         self.status.progress_func({'type': 'uncompress', 'message': msg})
-        subprocess.call(['tar', '-xjf', compressed_data_path,
-                         '-C', self.status.raw_data_folder_path_for_race(race)])
+        archive.extract_archive(compressed_data_path, self.status.raw_data_folder_path_for_race(race))
 
     def collect_runs_to_uncompress(self):
         """Find runs that need to be compressed"""
@@ -227,24 +395,27 @@ class Uncompressor(object):
         for run in race.runs.order_by(Run.start.desc()):
             compressed_data_path = self.status.compressed_data_file_path_for_run(race, run)
             raw_data_path = self.status.raw_data_folder_path_for_run(race, run)
-            if os.path.exists(compressed_data_path) and not os.path.exists(raw_data_path):
+            if archive.archive_exists(compressed_data_path) and not raw.raw_run_exists(raw_data_path):
                 self.runs_to_uncompress[race].append(run)
 
 
 class Rebuilder(object):
     """Rebuild faulty pruned data. -- This is WIP and has not yet been tested."""
 
-    def __init__(self, engine, config=None, race=None):
+    def __init__(self, engine, config=None, race=None, pruner_config=None):
         """Constructor for the uncompressor collector
         :param status: The bundle status object
         :param config: The configuration for the rebuilder
         :param race: The slug for a race if should restrict to one race
+        :param pruner_config: The PrunerConfig to rebuild with, or None to rebuild each run in the format it was
+            pruned in
         """
         self.engine = engine
         self.engine_config = engine.config
         self.status = engine.status
         self.config = config if config else CompressorConfig()
         self.race_slug = race
+        self.pruner_config = pruner_config
         self.runs_to_rebuild = defaultdict(list)
 
     def run(self):
@@ -269,10 +440,9 @@ class Rebuilder(object):
             self.status.progress_func({'type': 'progress', 'message': msg})
 
     def do_rebuild(self):
-        """Really uncompress the runs"""
+        """Really rebuild the runs"""
         races = self.runs_to_rebuild.keys()
         for race in races:
-            self.status.ensure_folder_exists(self.status.raw_data_folder_path_for_race(race))
             runs = self.runs_to_rebuild[race]
             if self.config.max_depth:
                 runs = runs[0:self.config.max_depth]
@@ -280,20 +450,28 @@ class Rebuilder(object):
                 self.rebuild_run(race, run)
 
     def rebuild_run(self, race, run):
-        raw_data_path = self.status.raw_data_folder_path_for_run(race, run)
-        # Uncompress the data to get the raw data to process
-        no_raw_data = not os.path.exists(raw_data_path)
-        if no_raw_data:
-            compressed_data_path = self.status.compressed_data_file_path_for_run(race, run)
-            msg = "Uncompressing run {} to {}".format(
-                self.status.path_relative_to_bundle(compressed_data_path),
-                self.status.path_relative_to_bundle(raw_data_path))
-            self.status.progress_func({'type': 'uncompress', 'message': msg})
-            subprocess.call(['tar', '-xjf', compressed_data_path,
-                             '-C', self.status.raw_data_folder_path_for_race(race)])
-        pruner = Pruner(self.status)
+        # If the raw data has been archived, the pruner reads it straight from the archive
+        reader = self.status.raw_reader(race, run)
+        msg = "Rebuilding run from {}".format(self.status.path_relative_to_bundle(reader.source()))
+        self.status.progress_func({'type': 'rebuild', 'message': msg})
+        pruner_config = self.pruner_config_for_run(race, run)
+        pruner = Pruner(self.status, pruner_config)
         pruner.queue_processing(race, run)
         self.engine.run_without_collect(pruner)
+        # Readers take the first format they find, so only the rebuilt file may remain
+        pruned_data_path = self.status.pruned_data_file_path_for_run(race, run)
+        if os.path.isfile(pruned_data_path + pruner_config.pruned_extension()):
+            pruned.remove_other_pruned_files(pruned_data_path, pruner_config.pruned_extension())
+
+    def pruner_config_for_run(self, race, run):
+        """The configuration to prune the run with: the one given, or else one for the format of its pruned file."""
+        if self.pruner_config is not None:
+            return self.pruner_config
+        path = pruned.pruned_file_path(self.status.pruned_data_file_path_for_run(race, run))
+        if path is None:
+            return PrunerConfig(self.status)
+        return PrunerConfig(self.status, compress_pruned=path.endswith(pruned.gzip_extension),
+                            lines_pruned=path.endswith(pruned.lines_extension))
 
     def collect_runs_to_rebuild(self):
         """Find runs that need to be compressed"""
@@ -324,13 +502,11 @@ class Rebuilder(object):
     def should_rebuild_run(self, race, run):
         compressed_data_path = self.status.compressed_data_file_path_for_run(race, run)
         raw_data_path = self.status.raw_data_folder_path_for_run(race, run)
-        has_data = os.path.exists(compressed_data_path) or os.path.exists(raw_data_path)
+        has_data = archive.archive_exists(compressed_data_path) or raw.raw_run_exists(raw_data_path)
         if not self.status.has_pruned_data_for_run(race, run):
             return True if has_data else False
-        pruned_data_path = self.status.robust_pruned_data_file_path_for_run(run)
-        with open(pruned_data_path) as f:
-            json_data = json.load(f)
-        if len(json_data) < 1 and has_data:
+        count = pruned.pruned_run_count(self.status.pruned_data_file_path_for_run(race, run))
+        if count < 1 and has_data:
             return True
         return False
 
@@ -379,7 +555,7 @@ class Archiver(object):
                 runs = runs[0:self.config.max_depth]
             for run in runs:
                 compressed_data_path = self.status.compressed_data_file_path_for_run(race, run)
-                if os.path.exists(compressed_data_path):
+                if archive.archive_exists(compressed_data_path):
                     self.delete_raw_run(race, run)
 
     def delete_raw_run(self, race, run):
@@ -387,7 +563,7 @@ class Archiver(object):
         msg = "Deleting raw data for run {}".format(
             self.status.path_relative_to_bundle(raw_data_path).encode('utf-8'))
         self.status.progress_func({'type': 'archive', 'message': msg})
-        shutil.rmtree(raw_data_path)
+        raw.delete_raw_run(raw_data_path)
 
     def collect_runs_to_archive(self):
         """Find runs that need to be compressed"""
@@ -414,11 +590,178 @@ class Archiver(object):
         for run in race.runs.order_by(Run.start):
             compressed_data_path = self.status.compressed_data_file_path_for_run(race, run)
             raw_data_path = self.status.raw_data_folder_path_for_run(race, run)
-            if self.status.has_pruned_data_for_run(race, run) and os.path.exists(compressed_data_path) \
-                    and os.path.exists(raw_data_path):
+            if self.status.has_pruned_data_for_run(race, run) and archive.archive_exists(compressed_data_path) \
+                    and raw.raw_run_exists(raw_data_path):
                 self.runs_to_archive[race].append(run)
 
 
+class DictionaryTrainerConfig(object):
+    """Configuration for training compression dictionaries"""
+
+    def __init__(self, kind="zlib", max_samples=1000, size=None):
+        """
+        :param kind: The kind of dictionary, zlib or zstd
+        :param max_samples: The maximum number of pages to train on. The newest pages are used.
+        :param size: The size of the dictionary, or None for the default for the kind
+        """
+        if kind not in dictionary.dictionary_kinds():
+            raise ValueError("Dictionary kind {} is not available. Available kinds are {}".format(
+                kind, ", ".join(dictionary.dictionary_kinds())))
+        self.kind = kind
+        self.max_samples = max_samples
+        self.size = size
+
+
+class DictionaryTrainer(object):
+    """Train a compression dictionary for each race from its historical raw pages."""
+
+    def __init__(self, status, config=None, race=None):
+        """Constructor for the trainer.
+        :param status: The bundle status object
+        :param config: The configuration for the trainer (a DictionaryTrainerConfig)
+        :param race: The slug for a race if should restrict to one race
+        """
+        self.status = status
+        self.config = config if config else DictionaryTrainerConfig()
+        self.race_slug = race
+        self.trained = {}
+
+    def run(self):
+        """Train dictionaries for matching races"""
+        for race in self.status.races_matching_slug(self.race_slug):
+            self.train_race(race)
+        msg = 'Training finished'
+        self.status.progress_func({'type': 'progress', 'message': msg})
+
+    def sample_pages(self, race):
+        """Return up to max_samples pages from the newest runs of the race."""
+        samples = []
+        for run in race.runs.order_by(Run.start.desc()):
+            reader = self.status.raw_reader(race, run)
+            if not reader.exists():
+                continue
+            for filename, contents in reader.pages():
+                samples.append(contents)
+                if len(samples) >= self.config.max_samples:
+                    return samples
+        return samples
+
+    def train_race(self, race):
+        samples = self.sample_pages(race)
+        if len(samples) < 2:
+            msg = "Race {} has too few pages to train a dictionary".format(race.name.encode('utf-8'))
+            self.status.progress_func({'type': 'progress', 'message': msg})
+            return
+        data = dictionary.train_dictionary(self.config.kind, samples, self.config.size)
+        store = dictionary.DictionaryStore(self.status.dictionary_folder_path_for_race(race))
+        self.trained[race] = store.add(self.config.kind, data, len(samples))
+        msg = "Trained {} dictionary version {} for race {} from {} pages".format(
+            self.config.kind, self.trained[race].version, race.name.encode('utf-8'), len(samples))
+        self.status.progress_func({'type': 'train', 'message': msg})
+
+
+class VerifierConfig(object):
+    """Configuration for verifying archives"""
+
+    def __init__(self, max_depth=5, add_missing=False):
+        """
+        :param max_depth: The maximum number of runs per race to verify. Use None or non-positive to verify all.
+        :param add_missing: Write a manifest for archives that do not have one, computed from the archive itself.
+        """
+        self.max_depth = max_depth if max_depth > 1 else None
+        self.add_missing = add_missing
+
+
+class Verifier(object):
+    """Verify compressed runs against their manifests, without needing the raw data."""
+
+    def __init__(self, status, config=None, race=None):
+        """Constructor for the verifier.
+        :param status: The bundle status object
+        :param config: The configuration for the verifier (a VerifierConfig)
+        :param race: The slug for a race if should restrict to one race
+        """
+        self.status = status
+        self.config = config if config else VerifierConfig()
+        self.race_slug = race
+        self.runs_to_verify = defaultdict(list)
+        self.failed_runs = []
+
+    def run(self):
+        """Run verification for matching races"""
+        self.collect_runs_to_verify()
+        self.log_intermediate_progress_update()
+        self.do_verify()
+        msg = 'Verifying finished. {} archives failed verification.'.format(len(self.failed_runs))
+        self.status.progress_func({'type': 'progress', 'message': msg})
+
+    def log_intermediate_progress_update(self):
+        races = self.runs_to_verify.keys()
+        if len(races) < 1:
+            self.status.progress_func({'type': 'progress', 'message': "No runs to verify."})
+            return
+        for key in races:
+            runs = self.runs_to_verify[key]
+            msg = "Race {} has {} runs to verify".format(key.name.encode('utf-8'), len(runs))
+            self.status.progress_func({'type': 'progress', 'message': msg})
+        if self.config.max_depth is not None:
+            msg = "\tLimiting to {} runs per race".format(self.config.max_depth)
+            self.status.progress_func({'type': 'progress', 'message': msg})
+
+    def do_verify(self):
+        """Really verify the runs"""
+        races = self.runs_to_verify.keys()
+        for race in races:
+            runs = self.runs_to_verify[race]
+            if self.config.max_depth:
+                runs = runs[0:self.config.max_depth]
+            for run in runs:
+                if not self.verify_run(race, run):
+                    self.failed_runs.append(run)
+
+    def verify_run(self, race, run):
+        """Verify the archive of the run. Return True if it is ok."""
+        compressed_data_path = self.status.compressed_data_file_path_for_run(race, run)
+        relative_path = self.status.path_relative_to_bundle(compressed_data_path).encode('utf-8')
+        if archive.read_manifest(compressed_data_path) is None and self.config.add_missing:
+            msg = "Writing manifest for {}".format(relative_path)
+            self.status.progress_func({'type': 'verify', 'message': msg})
+            members = archive.archive_checksums(compressed_data_path)
+            archive.write_manifest(compressed_data_path, archive.codec_for_path(compressed_data_path), members)
+            return True
+        problems = archive.verify_archive(compressed_data_path)
+        for problem in problems:
+            msg = "{}: {}".format(relative_path, problem)
+            self.status.progress_func({'type': 'error', 'message': msg})
+        return len(problems) < 1
+
+    def collect_runs_to_verify(self):
+        """Find runs that have archives"""
+        if self.race_slug:
+            matching_races = [race for race in self.status.races() if slug_for_race(race) == self.race_slug]
+            if len(matching_races) < 1:
+                msg = "Found no races matching slug {}.".format(self.race_slug)
+                self.status.progress_func({'type': 'error', 'message': msg})
+                return
+            if len(matching_races) > 1:
+                msg = "Found multiple races matching slug {}.".format(self.race_slug, matching_races)
+                self.status.progress_func({'type': 'error', 'message': msg})
+                return
+            self.collect_runs_from_race(matching_races[0])
+        else:
+            for race in self.status.races():
+                self.collect_runs_from_race(race)
+
+    def collect_runs_from_race(self, race):
+        """Collect the runs in the race that have been compressed
+        """
+        msg = "Collecting runs from race {}".format(race.name.encode('utf-8'))
+        self.status.progress_func({'type': 'progress', 'message': msg})
+        for run in race.runs.order_by(Run.start.desc()):
+            if archive.archive_exists(self.status.compressed_data_file_path_for_run(race, run)):
+                self.runs_to_verify[race].append(run)
+
+
 class PurgerConfig(object):
     """Gathers configuration information for the TweetCollector"""
 
@@ -471,11 +814,12 @@ class Purger(object):
 
     def delete_run(self, race, run):
         raw_data_path = self.status.raw_data_folder_path_for_run(race, run)
-        self.delete_folder_or_file("raw data", raw_data_path)
+        self.delete_folder_or_file("raw data", raw.raw_run_path(raw_data_path))
         pruned_data_path = self.status.pruned_data_file_path_for_run(race, run)
         self.delete_folder_or_file("pruned data", pruned_data_path)
         compressed_data_path = self.status.compressed_data_file_path_for_run(race, run)
         self.delete_folder_or_file("compressed data", compressed_data_path)
+        self.delete_folder_or_file("archive manifest", archive.manifest_path(compressed_data_path))
         msg = "Removing run\n\t{} : {}\n\tfrom db".format(race.slug, run.start)
         self.status.progress_func({'type': 'progress', 'message': msg})
         if self.config.execute:
@@ -488,8 +832,12 @@ class Purger(object):
 
         msg = "Deleting {} for run {}".format(folder_desc, folder_or_file)
         self.status.progress_func({'type': 'progress', 'message': msg})
-        if self.config.execute:
+        if not self.config.execute:
+            return
+        if os.path.isdir(folder_or_file):
             shutil.rmtree(folder_or_file)
+        else:
+            os.remove(folder_or_file)
 
     def collect_runs_to_purge(self):
         """Find runs that need to be compressed"""
@@ -516,6 +864,278 @@ class Purger(object):
         for run in race.runs.order_by(Run.start.desc()):
             compressed_data_path = self.status.compressed_data_file_path_for_run(race, run)
             raw_data_path = self.status.raw_data_folder_path_for_run(race, run)
-            if not os.path.exists(compressed_data_path) \
-                    and not os.path.exists(raw_data_path):
+            if not archive.archive_exists(compressed_data_path) \
+                    and not raw.raw_run_exists(raw_data_path):
                 self.runs_to_purge[race].append(run)
+
+
+class CompactorConfig(object):
+    """Configuration for moving the archives of old runs into containers"""
+
+    def __init__(self, period="month", min_age_days=30):
+        """
+        :param period: The period each container covers, day or month
+        :param min_age_days: Only the archives of runs at least this many days old are moved into containers
+        """
+        if period not in container.period_formats:
+            raise ValueError("Unknown period {}. Known periods are {}".format(
+                period, ", ".join(sorted(container.period_formats.keys()))))
+        self.period = period
+        self.min_age_days = min_age_days
+
+
+class Compactor(object):
+    """Move the archives of old runs into one container per day or month.
+
+    New archives are appended to the container, and each one is verified in the container against its manifest
+    before the standalone archive is removed.
+    """
+
+    def __init__(self, status, config=None, race=None):
+        """Constructor for the compactor.
+        :param status: The bundle status object
+        :param config: The configuration for the compactor (a CompactorConfig)
+        :param race: The slug for a race if should restrict to one race
+        """
+        self.status = status
+        self.config = config if config else CompactorConfig()
+        self.race_slug = race
+        self.runs_to_compact = defaultdict(list)
+        self.failed_runs = []
+
+    def run(self):
+        """Run compaction for matching races"""
+        for race in self.status.races_matching_slug(self.race_slug):
+            self.collect_runs_from_race(race)
+        self.log_intermediate_progress_update()
+        self.do_compact()
+        msg = 'Compacting finished'
+        self.status.progress_func({'type': 'progress', 'message': msg})
+
+    def log_intermediate_progress_update(self):
+        races = self.runs_to_compact.keys()
+        if len(races) < 1:
+            self.status.progress_func({'type': 'progress', 'message': "No runs to compact."})
+            return
+        for key in races:
+            runs = self.runs_to_compact[key]
+            msg = "Race {} has {} runs to compact".format(key.name.encode('utf-8'), len(runs))
+            self.status.progress_func({'type': 'progress', 'message': msg})
+
+    def do_compact(self):
+        """Really compact the runs, one container at a time"""
+        for race, runs in self.runs_to_compact.items():
+            runs_by_container = defaultdict(list)
+            for run in runs:
+                runs_by_container[self.status.container_path_for_run(race, run, self.config.period)].append(run)
+            for container_path in sorted(runs_by_container.keys()):
+                self.compact_container(race, container_path, runs_by_container[container_path])
+
+    def compact_container(self, race, container_path, runs):
+        archive_paths = [self.status.compressed_data_file_path_for_run(race, run) for run in runs]
+        msg = "Moving {} archives into {}".format(
+            len(archive_paths), self.status.path_relative_to_bundle(container_path).encode('utf-8'))
+        self.status.progress_func({'type': 'compact', 'message': msg})
+        writer = container.ContainerWriter(container_path)
+        try:
+            for path in archive_paths:
+                manifest = archive.read_manifest(path)
+                if manifest is None:
+                    manifest = {"archive": os.path.basename(path), "codec": archive.codec_for_path(path).name,
+                                "members": archive.archive_checksums(path)}
+                with archive.open_archive_file(path) as f:
+                    writer.add_archive(os.path.basename(path), f, manifest)
+        except Exception:
+            writer.abort()
+            raise
+        writer.close()
+
+        for run, path in zip(runs, archive_paths):
+            problems = archive.verify_archive(os.path.join(container_path, os.path.basename(path)))
+            if problems:
+                for problem in problems:
+                    msg = "{}: {}".format(self.status.path_relative_to_bundle(path).encode('utf-8'), problem)
+                    self.status.progress_func({'type': 'error', 'message': msg})
+                self.failed_runs.append(run)
+                continue
+            archive.remove_archive(path)
+
+    def collect_runs_from_race(self, race):
+        """Collect the runs in the race that are old enough and have a standalone archive
+        """
+        msg = "Collecting runs from race {}".format(race.name.encode('utf-8'))
+        self.status.progress_func({'type': 'progress', 'message': msg})
+        cutoff = self.status.datetime_provider() - timedelta(days=self.config.min_age_days)
+        for run in race.runs.order_by(Run.start):
+            if run_folder_name_to_datetime(run.results_folder) > cutoff:
+                continue
+            compressed_data_path = self.status.compressed_data_file_path_for_run(race, run)
+            if container.split_member_path(compressed_data_path) is None and os.path.exists(compressed_data_path):
+                self.runs_to_compact[race].append(run)
+
+
+class PartitionerConfig(object):
+    """Configuration for merging the pruned data of old runs into partitions"""
+
+    def __init__(self, period="day", min_age_days=1):
+        """
+        :param period: The period each partition covers, day or week
+        :param min_age_days: Only the pruned data of runs at least this many days old is moved into partitions
+        """
+        if period not in pruned.period_types:
+            raise ValueError("Unknown period {}. Known periods are {}".format(period, ", ".join(pruned.period_types)))
+        self.period = period
+        self.min_age_days = min_age_days
+
+
+class Partitioner(object):
+    """Merge the pruned data of old runs into one partition per day or week.
+
+    Tweets that are found by several runs of a partition are stored only once. The runs of each partition are read
+    back from the partition and compared to their pruned files before the files are removed.
+    """
+
+    def __init__(self, status, config=None, race=None):
+        """Constructor for the partitioner.
+        :param status: The bundle status object
+        :param config: The configuration for the partitioner (a PartitionerConfig)
+        :param race: The slug for a race if should restrict to one race
+        """
+        self.status = status
+        self.config = config if config else PartitionerConfig()
+        self.race_slug = race
+        self.runs_to_partition = defaultdict(list)
+        self.failed_runs = []
+
+    def run(self):
+        """Run partitioning for matching races"""
+        for race in self.status.races_matching_slug(self.race_slug):
+            self.collect_runs_from_race(race)
+        self.log_intermediate_progress_update()
+        self.do_partition()
+        msg = 'Partitioning finished'
+        self.status.progress_func({'type': 'progress', 'message': msg})
+
+    def log_intermediate_progress_update(self):
+        races = self.runs_to_partition.keys()
+        if len(races) < 1:
+            self.status.progress_func({'type': 'progress', 'message': "No runs to partition."})
+            return
+        for key in races:
+            runs = self.runs_to_partition[key]
+            msg = "Race {} has {} runs to partition".format(key.name.encode('utf-8'), len(runs))
+            self.status.progress_func({'type': 'progress', 'message': msg})
+
+    def do_partition(self):
+        """Really partition the runs, one partition at a time"""
+        for race, runs in self.runs_to_partition.items():
+            runs_by_partition = defaultdict(list)
+            for run in runs:
+                filename = pruned.partition_filename(self.config.period,
+                                                     run_folder_name_to_datetime(run.results_folder))
+                runs_by_partition[filename].append(run)
+            for filename in sorted(runs_by_partition.keys()):
+                self.partition_runs(race, filename, runs_by_partition[filename])
+
+    def partition_runs(self, race, filename, runs):
+        race_folder = self.status.pruned_data_folder_path_for_race(race)
+        partition_path = os.path.join(race_folder, filename)
+        msg = "Moving {} runs into {}".format(
+            len(runs), self.status.path_relative_to_bundle(partition_path).encode('utf-8'))
+        self.status.progress_func({'type': 'partition', 'message': msg})
+        pruned_data_paths = [self.status.pruned_data_file_path_for_run(race, run) for run in runs]
+        records_by_run = {}
+        writer = pruned.PartitionWriter(partition_path)
+        try:
+            for run, path in zip(runs, pruned_data_paths):
+                records_by_run[run.results_folder] = pruned.read_pruned_run(path)
+                writer.add_run(run.results_folder, records_by_run[run.results_folder])
+        finally:
+            writer.close()
+
+        catalog = pruned.read_catalog(race_folder).copy()
+        partitioned_paths = []
+        for run, path in zip(runs, pruned_data_paths):
+            if pruned.read_partition_run(partition_path, run.results_folder) != records_by_run[run.results_folder]:
+                msg = "{}: differs in partition {}".format(
+                    self.status.path_relative_to_bundle(path).encode('utf-8'), filename)
+                self.status.progress_func({'type': 'error', 'message': msg})
+                self.failed_runs.append(run)
+                continue
+            catalog[run.results_folder] = filename
+            partitioned_paths.append(path)
+        pruned.write_catalog(race_folder, catalog)
+        for path in partitioned_paths:
+            pruned.remove_pruned_file(pruned.pruned_file_path(path))
+
+    def collect_runs_from_race(self, race):
+        """Collect the runs in the race that are old enough and have a pruned file
+        """
+        msg = "Collecting runs from race {}".format(race.name.encode('utf-8'))
+        self.status.progress_func({'type': 'progress', 'message': msg})
+        cutoff = self.status.datetime_provider() - timedelta(days=self.config.min_age_days)
+        for run in race.runs.order_by(Run.start):
+            if run_folder_name_to_datetime(run.results_folder) > cutoff:
+                continue
+            pruned_data_path = self.status.pruned_data_file_path_for_run(race, run)
+            if pruned.pruned_file_path(pruned_data_path) is not None:
+                self.runs_to_partition[race].append(run)
+
+
+class Columnizer(object):
+    """Append the pruned data of runs to the columns of their race (see bundle.columns)."""
+
+    def __init__(self, status, race=None):
+        """Constructor for the columnizer.
+        :param status: The bundle status object
+        :param race: The slug for a race if should restrict to one race
+        """
+        self.status = status
+        self.race_slug = race
+        self.runs_to_columnize = defaultdict(list)
+
+    def run(self):
+        """Run columnizing for matching races"""
+        for race in self.status.races_matching_slug(self.race_slug):
+            self.collect_runs_from_race(race)
+        self.log_intermediate_progress_update()
+        self.do_columnize()
+        msg = 'Columnizing finished'
+        self.status.progress_func({'type': 'progress', 'message': msg})
+
+    def log_intermediate_progress_update(self):
+        races = self.runs_to_columnize.keys()
+        if len(races) < 1:
+            self.status.progress_func({'type': 'progress', 'message': "No runs to columnize."})
+            return
+        for key in races:
+            runs = self.runs_to_columnize[key]
+            msg = "Race {} has {} runs to columnize".format(key.name.encode('utf-8'), len(runs))
+            self.status.progress_func({'type': 'progress', 'message': msg})
+
+    def do_columnize(self):
+        """Really columnize the runs, all runs of a race with one writer"""
+        for race, runs in self.runs_to_columnize.items():
+            writer = columns.ColumnWriter(self.status.columns_folder_path_for_race(race))
+            for run in runs:
+                pruned_data_path = self.status.pruned_data_file_path_for_run(race, run)
+                msg = "Columnizing run: {}".format(
+                    self.status.path_relative_to_bundle(pruned_data_path).encode('utf-8'))
+                self.status.progress_func({'type': 'columnize', 'message': msg})
+                writer.add_run(run.results_folder, pruned.read_pruned_run(pruned_data_path))
+            writer.close()
+
+    def collect_runs_from_race(self, race):
+        """Collect the pruned runs in the race that are not in its columns yet
+        """
+        msg = "Collecting runs from race {}".format(race.name.encode('utf-8'))
+        self.status.progress_func({'type': 'progress', 'message': msg})
+        meta = columns.read_meta(self.status.columns_folder_path_for_race(race))
+        columnized = set(meta["runs"]) if meta is not None else set()
+        for run in race.runs.order_by(Run.start):
+            if run.results_folder in columnized:
+                continue
+            pruned_data_path = self.status.pruned_data_file_path_for_run(race, run)
+            if pruned.pruned_file_path(pruned_data_path) is not None \
+                    or pruned.partition_for_run(pruned_data_path) is not None:
+                self.runs_to_columnize[race].append(run)
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+ledger.py
+
+A rate limit budget shared by all the collectors that search twitter with the same credentials.
+
+Twitter limits the searches of each set of app credentials to a number per window of 15 minutes. Collectors of
+different bundles, or of different jobs of one bundle, that use the same credentials would each only learn that
+the budget is used up when their next search fails, and then sleep until the window resets. With a ledger, each
+collector reserves a search from the budget before making it, and records the remaining budget and reset time that
+twitter reports after it. A collector that finds the budget used up sleeps until the window resets, so together the
+collectors use the whole window without going over.
+
+The ledger of a set of credentials is a json file, <folder>/<key>.json, where the key is derived from the app key so
+the file does not reveal it. The file is locked with fcntl while it is read and updated, so collectors in different
+processes can share it. Where fcntl is not available it is only shared by the threads of one process.
+"""
+
+import hashlib
+import io
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from ..bundle.bundle import ensure_folder_exists
+from ..bundle.pruned import write_json_atomically
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+default_ledger_folder = os.path.join(os.path.expanduser("~"), ".smet-collect", "ledger")
+
+# The length of a rate limit window
+window_seconds = 15 * 60
+# The budget assumed for a window no reply has reported yet: the search limit of user auth, the smaller one
+provisional_budget = 180
+
+
+def credentials_key(credentials):
+    """Return the name of the ledger of the credentials."""
+    return hashlib.sha1(credentials.app_key.encode("utf-8")).hexdigest()[:16]
+
+
+class RateBudgetLedger(object):
+    """The remaining searches in the current rate limit window of one set of credentials."""
+
+    # Serializes the threads of this process, since fcntl locks are held by the process
+    thread_lock = threading.Lock()
+
+    def __init__(self, folder, key, clock=time.time):
+        """
+        :param folder: The folder with the ledgers
+        :param key: The name of the ledger (see credentials_key)
+        :param clock: A function that returns the current time in seconds since the epoch
+        """
+        self.folder = folder
+        self.path = os.path.join(folder, "{}.json".format(key))
+        self.lock_path = os.path.join(folder, "{}.lock".format(key))
+        self.clock = clock
+
+    @staticmethod
+    def for_credentials(folder, credentials, clock=time.time):
+        return RateBudgetLedger(folder, credentials_key(credentials), clock)
+
+    @contextmanager
+    def locked(self):
+        with self.thread_lock:
+            ensure_folder_exists(self.folder)
+            with open(self.lock_path, "a") as lock_file:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    if fcntl is not None:
+                        fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def read(self):
+        """Return the state of the ledger, {"reset": seconds, "remaining": count}, or an empty dict.
+
+        A window that no reply has reported yet is marked with "provisional": true.
+        """
+        if not os.path.exists(self.path):
+            return {}
+        with io.open(self.path, "rb") as f:
+            return json.loads(f.read().decode("utf-8"))
+
+    def reserve(self):
+        """Take a search from the budget.
+        :return: 0 if the search can be made now, otherwise the number of seconds to wait before trying again
+        """
+        with self.locked():
+            state = self.read()
+            now = self.clock()
+            if state.get("reset") is None or now >= state["reset"]:
+                # No collector has seen the current window yet. Assume a conservative one until the first reply
+                # corrects it, so collectors starting together do not all search unchecked.
+                state = OrderedDict([("reset", now + window_seconds), ("remaining", provisional_budget - 1),
+                                     ("provisional", True)])
+                write_json_atomically(self.path, state)
+                return 0
+            if state["remaining"] > 0:
+                state["remaining"] -= 1
+                write_json_atomically(self.path, state)
+                return 0
+            return state["reset"] - now
+
+    def record(self, remaining, reset):
+        """Record the budget reported by twitter after a search.
+        :param remaining: The x-rate-limit-remaining header
+        :param reset: The x-rate-limit-reset header, the end of the window in seconds since the epoch
+        """
+        try:
+            remaining, reset = int(remaining), float(reset)
+        except (TypeError, ValueError):
+            return
+        with self.locked():
+            state = self.read()
+            if state.get("provisional"):
+                if reset <= self.clock():
+                    # A reply from a window that has already ended
+                    return
+                # The first reply for the window replaces the assumed one
+                state = {}
+            if state.get("reset") is not None and reset < state["reset"]:
+                # A reply from a window that has already been replaced
+                return
+            if state.get("reset") == reset:
+                # Searches reserved by other collectors may not have reached twitter yet
+                remaining = min(remaining, state["remaining"])
+            write_json_atomically(self.path, OrderedDict([("reset", reset), ("remaining", remaining)]))
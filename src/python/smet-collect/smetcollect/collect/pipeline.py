@@ -0,0 +1,522 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+pipeline.py
+
+Run the collect, prune, compress and archive stages of the pipeline for each run as soon as its inputs are ready.
+
+The stages of each run form a dependency graph: a run is pruned once its race has been collected, compressed once
+it has been pruned, and its raw data is deleted once it has been compressed. A DagScheduler runs each stage on a
+shared pool of threads as soon as the stages it depends on have finished, so one run can be compressing while
+another is pruning and the next race is still collecting.
+
+Only the threads of the pool run stages in parallel. Everything that uses the status db session -- collecting and
+finding the runs of a race to process -- runs in the thread that runs the scheduler, one step at a time. The stages
+on the pool only see snapshots of the races and runs (see bundle.snapshot).
+
+PipelineJobs runs pipelines in worker processes, each with its own status db session, and sends their progress and
+failures back to the parent process. The pipelines can be for different bundles, or, with a ShardedPipeline, for
+different races of one bundle. The status db is then switched to wal mode while they run, so the workers' reads do
+not block each other's writes, and each write waits for the others instead of failing.
+"""
+
+import multiprocessing
+import threading
+import traceback
+from collections import OrderedDict
+from functools import partial
+from multiprocessing.pool import ThreadPool
+
+from six.moves.queue import Empty
+
+from .collect import CollectorConfig, TweetCollector
+from .compress import Compressor, CompressorConfig, Archiver, Columnizer
+from ..bundle import Bundle, BundleStatus, archive, columns, raw
+from ..bundle.snapshot import RunSnapshot
+from ..bundle.status_db import Run, set_journal_mode
+from ..process.fused import FusedProcessor, FusedProcessorConfig
+from ..process.jq import JqEngineConfig, JqEngine
+from ..process.prune import Pruner, PrunerConfig
+from ..process.py import PyEngineConfig, PyEngine
+
+pending, running, done, failed, skipped = "pending", "running", "done", "failed", "skipped"
+progress_event, finished_event = "progress", "finished"
+
+
+class ScheduledTask(object):
+    """A task and its state in a DagScheduler"""
+    __slots__ = ["name", "func", "depends", "in_main_thread", "state", "error"]
+
+    def __init__(self, name, func, depends, in_main_thread):
+        self.name = name
+        self.func = func
+        self.depends = depends
+        self.in_main_thread = in_main_thread
+        self.state = pending
+        self.error = None
+
+
+class DagScheduler(object):
+    """Runs tasks as soon as the tasks they depend on have finished.
+
+    Tasks run on a pool of threads, except tasks that must run in the main thread, the one that calls run(). These
+    run one at a time, in the order they were added. A task that fails is logged, and the tasks that depend on it,
+    directly or not, are skipped. Tasks may add more tasks while they run.
+    """
+
+    def __init__(self, workers=None, progress_func=None):
+        """
+        :param workers: The number of threads to run tasks on. Defaults to the number of cpus.
+        :param progress_func: The function to report failures to
+        """
+        self.workers = workers if workers is not None and workers > 0 else multiprocessing.cpu_count()
+        self.progress_func = progress_func
+        self.tasks = OrderedDict()
+        self.condition = threading.Condition(threading.RLock())
+        self.running_count = 0
+        self.pool = None
+
+    def add(self, name, func, depends=(), in_main_thread=False):
+        """Add a task.
+        :param name: A unique name for the task
+        :param func: The function to call, without arguments
+        :param depends: The names of the tasks that must finish before this one starts. None entries are ignored.
+        :param in_main_thread: Run the task in the thread that runs the scheduler
+        :return: The name
+        """
+        with self.condition:
+            if name in self.tasks:
+                raise ValueError("There is already a task named {}".format(name))
+            depends = [depend for depend in depends if depend is not None]
+            for depend in depends:
+                if depend not in self.tasks:
+                    raise ValueError("Task {} depends on unknown task {}".format(name, depend))
+            self.tasks[name] = ScheduledTask(name, func, depends, in_main_thread)
+            self.dispatch()
+            self.condition.notify_all()
+        return name
+
+    def state(self, name):
+        return self.tasks[name].state
+
+    def failures(self):
+        """Return a dict of the names of the failed tasks -> the tracebacks of their errors."""
+        return OrderedDict((task.name, task.error) for task in self.tasks.values() if task.state == failed)
+
+    def is_ready(self, task):
+        """Return True if the task can start. Skip it if a task it depends on did not succeed."""
+        states = [self.tasks[depend].state for depend in task.depends]
+        if any(state in (failed, skipped) for state in states):
+            task.state = skipped
+            return False
+        return all(state == done for state in states)
+
+    def dispatch(self):
+        """Start the pending tasks for the pool that are ready. Called with the lock held."""
+        if self.pool is None:
+            return
+        # Tasks are added after the tasks they depend on, so one pass in order skips all the dependents of a failure
+        for task in self.tasks.values():
+            if task.state == pending and self.is_ready(task) and not task.in_main_thread:
+                task.state = running
+                self.running_count += 1
+                self.pool.apply_async(self.execute, (task,))
+
+    def execute(self, task):
+        """Run the task in a thread of the pool."""
+        error = self.call(task)
+        with self.condition:
+            self.finish(task, error)
+
+    def call(self, task):
+        """Run the function of the task. Returns None on success, or the traceback of the error."""
+        try:
+            task.func()
+            return None
+        except Exception:
+            return traceback.format_exc()
+
+    def finish(self, task, error):
+        """Record the result of the task and start the tasks waiting for it. Called with the lock held."""
+        task.state = done if error is None else failed
+        task.error = error
+        self.running_count -= 1
+        if error is not None and self.progress_func is not None:
+            msg = "{} failed: {}".format(task.name, error.strip().splitlines()[-1])
+            self.progress_func({'type': 'error', 'message': msg})
+        self.dispatch()
+        self.condition.notify_all()
+
+    def next_main_thread_task(self):
+        for task in self.tasks.values():
+            if task.state == pending and task.in_main_thread and self.is_ready(task):
+                return task
+        return None
+
+    def run(self):
+        """Run the tasks until all have finished or been skipped.
+        :return: A dict of the names of the failed tasks -> the tracebacks of their errors
+        """
+        self.pool = ThreadPool(self.workers)
+        try:
+            with self.condition:
+                while True:
+                    self.dispatch()
+                    task = self.next_main_thread_task()
+                    if task is not None:
+                        task.state = running
+                        self.running_count += 1
+                        self.condition.release()
+                        try:
+                            error = self.call(task)
+                        finally:
+                            self.condition.acquire()
+                        self.finish(task, error)
+                        continue
+                    if self.running_count < 1:
+                        break
+                    self.condition.wait()
+        finally:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        return self.failures()
+
+
+class PipelineConfig(object):
+    """Configuration for the pipeline"""
+
+    def __init__(self, max_depth=3, skip_collect=False, fused=False, codec=archive.default_codec,
+                 compress_pruned=False, lines_pruned=False, columnize=False, workers=None, collector_config=None,
+                 rate_ledger_folder=None):
+        """
+        :param max_depth: The max number of runs per race to process in each stage
+        :param skip_collect: Do not collect data from twitter
+        :param fused: Prune, summarize and compress each run in a single read of the raw data, with the python engine
+        :param codec: The name of the codec to compress new archives with
+        :param compress_pruned: Write the pruned data gzipped
+        :param lines_pruned: Write the pruned data as json lines with an index
+        :param columnize: Also append the pruned data to the columns of each race
+        :param workers: The number of threads to run stages on. Defaults to the number of cpus.
+        :param collector_config: The configuration for collecting. Defaults to a wait period of 1h and max_depth.
+        :param rate_ledger_folder: The folder of the rate budget ledgers for the default collector configuration
+        """
+        self.max_depth = max_depth
+        self.skip_collect = skip_collect
+        self.fused = fused
+        self.codec = codec
+        self.compress_pruned = compress_pruned
+        self.lines_pruned = lines_pruned
+        self.columnize = columnize
+        self.workers = workers if workers is not None and workers > 0 else multiprocessing.cpu_count()
+        self.collector_config = collector_config if collector_config is not None else \
+            CollectorConfig(wait_period=1.0, max_depth=max_depth, rate_ledger_folder=rate_ledger_folder)
+
+
+class Pipeline(object):
+    """Collect, prune, compress and archive the runs of the races, overlapping the stages of different runs."""
+
+    def __init__(self, status, config=None, races=None):
+        """
+        :param status: The bundle status object
+        :param config: The configuration for the pipeline (a PipelineConfig)
+        :param races: The slugs of the races to run the pipeline for. Defaults to all races.
+        """
+        self.status = status
+        self.config = config if config else PipelineConfig()
+        self.race_slugs = races
+        if self.config.fused:
+            self.prune_config = FusedProcessorConfig(status, self.config.max_depth, compress=True,
+                                                     compress_pruned=self.config.compress_pruned,
+                                                     lines_pruned=self.config.lines_pruned)
+        else:
+            self.prune_config = PrunerConfig(status, self.config.max_depth,
+                                             compress_pruned=self.config.compress_pruned,
+                                             lines_pruned=self.config.lines_pruned)
+        self.compressor_config = CompressorConfig(self.config.max_depth, self.config.codec)
+        self.scheduler = None
+        self.block_pool = None
+        self.can_prune = False
+
+    def run(self):
+        """Run the pipeline.
+        :return: A dict of the names of the stages that failed -> the tracebacks of their errors
+        """
+        self.scheduler = DagScheduler(self.config.workers, self.status.progress_func)
+        self.block_pool = ThreadPool(self.config.workers)
+        self.can_prune = self.engine().prerequisites_satisfied()
+        # Load the snapshot that the stages use before any of them run
+        self.status.snapshot()
+        try:
+            for race in self.races():
+                collect = None
+                if not self.config.skip_collect:
+                    collect = self.scheduler.add("collect:" + race.slug, partial(self.collect_race, race.slug),
+                                                 in_main_thread=True)
+                self.scheduler.add("plan:" + race.slug, partial(self.plan_race, race.slug), [collect],
+                                   in_main_thread=True)
+            failures = self.scheduler.run()
+        finally:
+            self.block_pool.close()
+            self.block_pool.join()
+        msg = 'Pipeline finished' if not failures else 'Pipeline finished with {} failed stages'.format(len(failures))
+        self.status.progress_func({'type': 'progress', 'message': msg})
+        return failures
+
+    def races(self):
+        if self.race_slugs is None:
+            return self.status.races()
+        return [race for race in self.status.races() if race.slug in self.race_slugs]
+
+    def engine(self):
+        """A new engine for a prune stage. Engines keep the state of the command they run, so stages do not share."""
+        if self.config.fused:
+            return PyEngine(self.status, PyEngineConfig())
+        return JqEngine(self.status, JqEngineConfig())
+
+    def prune_command(self):
+        if self.config.fused:
+            return FusedProcessor(self.status, self.prune_config)
+        return Pruner(self.status, self.prune_config)
+
+    def collect_race(self, race_slug):
+        collector = TweetCollector(self.status, self.config.collector_config, race=race_slug)
+        collector.run()
+
+    def plan_race(self, race_slug):
+        """Add the stages for the runs of the race that need to be processed."""
+        race = [race for race in self.status.races() if race.slug == race_slug][0]
+        race_snapshot = self.status.snapshot().race(race_slug)
+        runs = race.runs.order_by(Run.start.desc()).all()
+
+        to_prune = []
+        if self.can_prune:
+            command = self.prune_command()
+            to_prune = [run for run in runs if command.should_process_run(race, run)]
+            if self.prune_config.max_depth:
+                to_prune = to_prune[0:self.prune_config.max_depth]
+        pruned = set(run.results_folder for run in to_prune)
+        pruned.update(run.results_folder for run in runs if self.status.has_pruned_data_for_run(race, run))
+
+        to_compress = [run for run in runs if run.results_folder in pruned and not archive.archive_exists(
+            self.status.compressed_data_file_path_for_run(race, run))]
+        if self.compressor_config.max_depth:
+            to_compress = to_compress[0:self.compressor_config.max_depth]
+        compressed = set(run.results_folder for run in to_compress)
+
+        # Like the Archiver, start with the oldest runs
+        to_archive = [run for run in reversed(runs) if run.results_folder in pruned and raw.raw_run_exists(
+            self.status.raw_data_folder_path_for_run(race, run)) and (run.results_folder in compressed or
+                                                                     archive.archive_exists(
+                self.status.compressed_data_file_path_for_run(race, run)))]
+        if self.compressor_config.max_depth:
+            to_archive = to_archive[0:self.compressor_config.max_depth]
+
+        msg = "Race {} has {} runs to prune, {} to compress and {} to archive".format(
+            race_slug, len(to_prune), len(to_compress), len(to_archive))
+        self.status.progress_func({'type': 'progress', 'message': msg})
+
+        stages = {}
+        for stage, stage_runs in [("prune", to_prune), ("compress", to_compress), ("archive", to_archive)]:
+            for run in stage_runs:
+                stages[(stage, run.results_folder)] = "{}:{}/{}".format(stage, race_slug, run.results_folder)
+        prune_stages = []
+        for run in to_prune:
+            name = stages[("prune", run.results_folder)]
+            prune_stages.append(self.scheduler.add(name, partial(self.prune_run, race_snapshot,
+                                                                 RunSnapshot.for_run(run))))
+        for run in to_compress:
+            self.scheduler.add(stages[("compress", run.results_folder)],
+                               partial(self.compress_run, race_snapshot, RunSnapshot.for_run(run)),
+                               [stages.get(("prune", run.results_folder))])
+        for run in to_archive:
+            self.scheduler.add(stages[("archive", run.results_folder)],
+                               partial(self.archive_run, race_snapshot, RunSnapshot.for_run(run)),
+                               [stages.get(("prune", run.results_folder)),
+                                stages.get(("compress", run.results_folder))])
+        if self.config.columnize:
+            self.scheduler.add("columns:" + race_slug, partial(self.columnize_race, race_snapshot,
+                                                               [RunSnapshot.for_run(run) for run in reversed(runs)]),
+                               prune_stages)
+
+    def prune_run(self, race, run):
+        command = self.prune_command()
+        command.runs_to_process[race].append(run)
+        self.engine().run_without_collect(command)
+        if not self.status.has_pruned_data_for_run(race, run):
+            raise RuntimeError("Run {} was not pruned".format(run.results_folder))
+
+    def compress_run(self, race, run):
+        # The run may have been compressed while it was pruned
+        if archive.archive_exists(self.status.compressed_data_file_path_for_run(race, run)):
+            return
+        self.status.ensure_folder_exists(self.status.compressed_data_folder_path_for_race(race))
+        Compressor(self.status, self.compressor_config).compress_run(race, run, self.block_pool)
+        if not archive.archive_exists(self.status.compressed_data_file_path_for_run(race, run)):
+            raise RuntimeError("Run {} was not compressed".format(run.results_folder))
+
+    def archive_run(self, race, run):
+        if archive.archive_exists(self.status.compressed_data_file_path_for_run(race, run)):
+            Archiver(self.status, self.compressor_config).delete_raw_run(race, run)
+
+    def columnize_race(self, race, runs):
+        """Append the pruned runs of the race that are not in its columns yet, oldest first."""
+        columnizer = Columnizer(self.status)
+        meta = columns.read_meta(self.status.columns_folder_path_for_race(race))
+        columnized = set(meta["runs"]) if meta is not None else set()
+        columnizer.runs_to_columnize[race] = [run for run in runs if run.results_folder not in columnized and
+                                              self.status.has_pruned_data_for_run(race, run)]
+        columnizer.do_columnize()
+
+
+def run_pipeline_job(index, bundle_root, output_path, status_config, config, races, queue):
+    """Run the pipeline for a bundle, or some of its races, in a worker process.
+
+    The worker has its own status, with its own connection to the status db. Its progress, and at the end its failures,
+    are put on the queue for the parent.
+    """
+
+    def progress(progress_data):
+        queue.put((progress_event, index, progress_data))
+
+    try:
+        smet_bundle = Bundle(bundle_root)
+        smet_bundle.output_data_path = output_path
+        status_config = dict(status_config, progress_func=progress)
+        failures = Pipeline(BundleStatus(smet_bundle, status_config), config, races).run()
+    except Exception:
+        failures = {"job:{}".format(index): traceback.format_exc()}
+    queue.put((finished_event, index, dict(failures)))
+
+
+class PipelineJob(object):
+    """A pipeline for a PipelineJobs to run"""
+    __slots__ = ["status", "config", "races", "progress_func", "worker"]
+
+    def __init__(self, status, config, races, progress_func):
+        self.status = status
+        self.config = config
+        self.races = races
+        self.progress_func = progress_func
+        self.worker = None
+
+
+class PipelineJobs(object):
+    """Runs pipelines in worker processes, at most a given number at a time, and reports their progress."""
+
+    def __init__(self, jobs=None):
+        """
+        :param jobs: The most worker processes to run at a time. Defaults to the number of cpus.
+        """
+        self.jobs = jobs if jobs is not None and jobs > 0 else multiprocessing.cpu_count()
+        self.pipelines = []
+
+    def add(self, status, config=None, races=None, progress_func=None):
+        """Add a pipeline to run.
+        :param status: The bundle status object. Its config should have been synced, the worker does not sync it.
+        :param config: The configuration for the pipeline (a PipelineConfig)
+        :param races: The slugs of the races to run the pipeline for. Defaults to all races.
+        :param progress_func: The function to report the progress of the pipeline to. Defaults to that of the status.
+        :return: The index of the pipeline
+        """
+        progress_func = progress_func if progress_func is not None else status.progress_func
+        self.pipelines.append(PipelineJob(status, config, races, progress_func))
+        return len(self.pipelines) - 1
+
+    def start(self, index, queue):
+        job = self.pipelines[index]
+        status_config = {"datetime_provider": job.status.datetime_provider, "raw_storage": job.status.raw_storage.name}
+        job.worker = multiprocessing.Process(target=run_pipeline_job,
+                                             args=(index, job.status.bundle.bundle_root_path, job.status.output_path,
+                                                   status_config, job.config, job.races, queue))
+        job.worker.start()
+
+    def run(self):
+        """Run the pipelines and wait for them to finish.
+        :return: A list of the failures of each pipeline, dicts of the names of the failed stages -> the tracebacks
+        """
+        # The workers open their own connections, none of this process's may be carried over into them
+        for job in self.pipelines:
+            job.status.session.close()
+        queue = multiprocessing.Queue()
+        failures = [OrderedDict() for _ in self.pipelines]
+        waiting = list(range(len(self.pipelines)))
+        unfinished = set(waiting)
+        exited = set()
+        try:
+            while unfinished:
+                while waiting and len(unfinished) - len(waiting) < self.jobs:
+                    self.start(waiting.pop(0), queue)
+                try:
+                    event, index, data = queue.get(timeout=1)
+                except Empty:
+                    # A worker that has exited without finishing has crashed. Wait one more round for its last events.
+                    for index in list(unfinished):
+                        worker = self.pipelines[index].worker
+                        if worker is None or worker.is_alive():
+                            continue
+                        if index in exited:
+                            unfinished.discard(index)
+                            failures[index]["job:{}".format(index)] = "Job {} exited with code {}".format(
+                                index, worker.exitcode)
+                            msg = "Job {} exited without finishing".format(index)
+                            self.pipelines[index].progress_func({'type': 'error', 'message': msg})
+                        exited.add(index)
+                    continue
+                if event == progress_event:
+                    self.pipelines[index].progress_func(data)
+                else:
+                    unfinished.discard(index)
+                    failures[index].update(data)
+        finally:
+            for job in self.pipelines:
+                if job.worker is not None:
+                    job.worker.join()
+        return failures
+
+
+class ShardedPipeline(object):
+    """Run the pipeline for the races of a bundle in several worker processes."""
+
+    def __init__(self, status, config=None, jobs=None):
+        """
+        :param status: The bundle status object. Its config should have been synced, the workers do not sync it.
+        :param config: The configuration for the pipeline of each worker (a PipelineConfig)
+        :param jobs: The number of worker processes. Defaults to the number of cpus.
+        """
+        self.status = status
+        self.config = config if config else PipelineConfig()
+        self.jobs = jobs if jobs is not None and jobs > 0 else multiprocessing.cpu_count()
+
+    def shards(self):
+        """Return the lists of race slugs for the workers, dealing the races out in turn."""
+        slugs = [race.slug for race in self.status.snapshot().races]
+        jobs = max(1, min(self.jobs, len(slugs)))
+        return [slugs[i::jobs] for i in range(jobs)]
+
+    def job_progress(self, index, progress_data):
+        self.status.progress_func(dict(progress_data, message="[job {}] {}".format(index, progress_data['message'])))
+
+    def run(self):
+        """Run the workers and wait for them to finish.
+        :return: A dict of the names of the stages that failed -> the tracebacks of their errors
+        """
+        shards = self.shards()
+        jobs = PipelineJobs(len(shards))
+        for i, shard in enumerate(shards):
+            jobs.add(self.status, self.config, shard, partial(self.job_progress, i))
+            msg = "Job {} runs the pipeline for {} races".format(i, len(shard))
+            self.status.progress_func({'type': 'progress', 'message': msg})
+        self.status.session.close()
+        journal_mode = set_journal_mode(self.status.engine, "wal")
+        try:
+            job_failures = jobs.run()
+        finally:
+            set_journal_mode(self.status.engine, journal_mode)
+        failures = OrderedDict()
+        for each in job_failures:
+            failures.update(each)
+        msg = 'Jobs finished' if not failures else 'Jobs finished with {} failed stages'.format(len(failures))
+        self.status.progress_func({'type': 'progress', 'message': msg})
+        return failures
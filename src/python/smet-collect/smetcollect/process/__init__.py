@@ -14,5 +14,7 @@ Copyright (c) 2016 Chandrasekhar Ramakrishnan. All rights reserved.
 from . import prune
 from . import analyze
 from . import jq
+from . import py
+from . import fused
 
 # TODO Import classes directly -- can hide that the processing is done using jq, spark, etc.
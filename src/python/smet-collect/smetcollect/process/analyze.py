@@ -14,8 +14,10 @@ Copyright (c) 2015 Chandrasekhar Ramakrishnan. All rights reserved.
 
 import json
 import os
+import tempfile
 
 from . import command
+from .cache import AnalysisCache
 from ..bundle import slug_for_race
 
 
@@ -37,15 +39,14 @@ class CandidateConfigToJson(object):
         if not path:
             path = self.default_path()
         races = []
-        for race in self.status.races():
-            race_dict = {"slug": race.slug, "candidates": []}
-            races.append(race_dict)
-            for candidate in race.candidates.all():
-                terms = [term.term for term in candidate.search_terms.all()]
-                candidate_dict = {"name": candidate.name, "terms": terms}
-                race_dict["candidates"].append(candidate_dict)
-        with open(path, "w") as f:
+        for race in self.status.snapshot().races:
+            candidates = [{"name": candidate.name, "terms": candidate.terms} for candidate in race.candidates]
+            races.append({"slug": race.slug, "candidates": candidates})
+        # Write to a temporary file and rename it, so commands running at the same time never see a partial file
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, "w") as f:
             json.dump(races, f)
+        os.rename(tmp_path, path)
 
 
 class AnalyzerConfig(command.ProcessCommandConfig):
@@ -54,13 +55,24 @@ class AnalyzerConfig(command.ProcessCommandConfig):
         """The config determines which driver is run and where the results end up"""
         super(AnalyzerConfig, self).__init__(driver, script, description, max_depth, just_config)
         self.output_path_components = lambda race, run=None: status.analysis_result_path_components(race, None, run)
+        self.cached = True
 
 
 class MetadataAnalyzerConfig(command.ProcessCommandConfig):
     """Configuration for running metadata analysis"""
-    def __init__(self, status, max_depth=5, just_config=False):
-        super(MetadataAnalyzerConfig, self).__init__("MetadataSummary", "mdsummary.rb", "Analyzing", max_depth, just_config)
+    def __init__(self, status, max_depth=5, just_config=False, vectorized=False):
+        """
+        :param vectorized: Summarize with numpy when run with the python engine. Requires numpy.
+        """
+        if vectorized:
+            from .py import vectorized as vectorized_module
+            if vectorized_module.numpy is None:
+                raise ImportError("The vectorized summary requires numpy")
+        py_driver_name = "vectorized_summarize_run" if vectorized else "summarize_run"
+        super(MetadataAnalyzerConfig, self).__init__("MetadataSummary", "mdsummary.rb", "Analyzing", max_depth, just_config,
+                                                     py_driver_name)
         self.output_path_components = lambda race, run=None: status.analysis_result_path_components(race, "metadata", run)
+        self.cached = True
 
 
 class MetadataPlusAnalyzerConfig(command.ProcessCommandConfig):
@@ -68,13 +80,34 @@ class MetadataPlusAnalyzerConfig(command.ProcessCommandConfig):
     def __init__(self, status, max_depth=5, just_config=False):
         super(MetadataPlusAnalyzerConfig, self).__init__(None, "mdsummary_plus.rb", "Analyzing", max_depth, just_config)
         self.output_path_components = lambda race, run=None: status.analysis_result_path_components(race, "mdplus", run)
+        self.cached = True
 
 
 class HashtagAnalyzerConfig(command.ProcessCommandConfig):
     """Configuration for running metadata analysis"""
     def __init__(self, status, max_depth=5, just_config=False):
-        super(HashtagAnalyzerConfig, self).__init__("HashtagSummary", "hashtags.rb", "Analyzing Hashtags", max_depth, just_config)
+        super(HashtagAnalyzerConfig, self).__init__("HashtagSummary", "hashtags.rb", "Analyzing Hashtags", max_depth, just_config,
+                                                    "hashtags_run")
         self.output_path_components = lambda race, run=None: status.analysis_result_path_components(race, "hashtag", run)
+        self.cached = True
+
+
+class CooccurrenceAnalyzerConfig(command.ProcessCommandConfig):
+    """Configuration for counting the hashtags used together in each run. Only supported by the python engine."""
+    def __init__(self, status, max_depth=5, just_config=False):
+        super(CooccurrenceAnalyzerConfig, self).__init__(None, None, "Analyzing Hashtag Co-occurrence", max_depth,
+                                                         just_config, "cooccur_run")
+        self.output_path_components = lambda race, run=None: status.analysis_result_path_components(race, "cooccur",
+                                                                                                    run)
+
+
+class AggregatesAnalyzerConfig(command.ProcessCommandConfig):
+    """Configuration for adding runs to the rolling aggregates of their race. Only supported by the python engine."""
+    def __init__(self, status, max_depth=5, just_config=False):
+        super(AggregatesAnalyzerConfig, self).__init__(None, None, "Aggregating", max_depth, just_config,
+                                                       "aggregate_run")
+        self.output_path_components = lambda race, run=None: status.analysis_result_path_components(race, "aggregates",
+                                                                                                    run)
 
 
 class GenericAnalyzer(command.ProcessCommand):
@@ -92,6 +125,8 @@ class GenericAnalyzer(command.ProcessCommand):
             config = MetadataAnalyzerConfig(status)
         self.config = config
         super(GenericAnalyzer, self).__init__(self.status, config, race)
+        self.cache = AnalysisCache(status, config) if config.cached else None
+        self.keys = {}
 
     def prepare_processing(self, races):
         """Do any preparation necessary to process the races. Default does nothing."""
@@ -101,9 +136,31 @@ class GenericAnalyzer(command.ProcessCommand):
         if len(races) > 0:
             CandidateConfigToJson(self.status).save()
 
+    def should_process_run(self, race, run):
+        """Process runs without results and, if the results are cached, runs whose data or analysis has changed."""
+        if self.cache is None:
+            return super(GenericAnalyzer, self).should_process_run(race, run)
+        result_path = self.status.path_from_components(self.config.output_path_components(race, run))
+        key = self.cache.key_for_run(race, run)
+        if key is None:
+            return not os.path.exists(result_path)
+        self.keys[result_path] = key
+        return not self.cache.is_up_to_date(result_path, key)
+
     def queue_processing(self, race, run):
         pruned_data_path = self.status.pruned_data_file_path_for_run(race, run)
         analyzed_data_path_components = self.config.output_path_components(race, run)
+        result_path = self.status.path_from_components(analyzed_data_path_components)
+        if result_path in self.keys:
+            # The result is out of date. Remove it, so it is only recorded as up to date once it is rewritten.
+            if os.path.exists(result_path):
+                os.remove(result_path)
+            self.cache.expect(result_path, self.keys[result_path])
         msg = "{} run: {}".format(self.process_description(), pruned_data_path.encode('utf-8'))
         self.status.progress_func({'type': 'analyze', 'message': msg})
         self.add_spark_task(pruned_data_path, analyzed_data_path_components, slug_for_race(race))
+
+    def finish_processing(self):
+        """Record the keys of the results that have been computed."""
+        if self.cache is not None:
+            self.cache.save()
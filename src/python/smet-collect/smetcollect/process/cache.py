@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+cache.py
+
+Records what each analysis result was computed from, so analyzers only recompute the results that are out of date.
+
+A result is up to date if it exists and was computed from pruned data with the same contents, by the same analysis
+logic -- the ruby script and jq filters of the jq engine and the driver of the python engine, with the files they
+require, include or import -- with the same candidates and search terms for its race. The key of each result, a digest
+of each of these, is recorded in analyzed/analysis_cache.json after the analysis has written it. Checking a run then
+only costs hashing its pruned data. Results written before there was a cache have no key, so they are recomputed once.
+"""
+
+import ast
+import hashlib
+import io
+import json
+import os
+import re
+from collections import OrderedDict
+
+from .jq.jq import JqEngineConfig
+from ..bundle.pruned import pruned_run_digest, write_json_atomically
+
+cache_filename = "analysis_cache.json"
+
+# The folder of the smetcollect package, whose modules the python drivers import
+package_folder = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# The module of the python drivers, which the configs name without importing it
+drivers_module = __name__.rpartition(".")[0] + ".py.drivers"
+ruby_require_pattern = re.compile(r"""require_relative\s+['"]([^'"]+)['"]""")
+jq_filename_pattern = re.compile(r"""['"]([\w.-]+\.jq)['"]""")
+jq_include_pattern = re.compile(r'\b(?:include|import)\s+"([^"]+)"')
+
+
+def read_file(path):
+    with io.open(path, "rb") as f:
+        return f.read()
+
+
+def script_dependencies(script):
+    """Return the paths of the ruby script and of the ruby files and jq filters it requires or includes."""
+    ruby_folder = JqEngineConfig.default_script_parent_folder()
+    jq_folder = os.path.join(os.path.dirname(ruby_folder), "jq")
+    pending = [os.path.join(ruby_folder, script)]
+    found = set()
+    while pending:
+        path = pending.pop()
+        if path in found or not os.path.isfile(path):
+            continue
+        found.add(path)
+        text = read_file(path).decode("utf-8")
+        if path.endswith(".rb"):
+            pending.extend(os.path.join(ruby_folder, name if name.endswith(".rb") else name + ".rb")
+                           for name in ruby_require_pattern.findall(text))
+            pending.extend(os.path.join(jq_folder, name) for name in jq_filename_pattern.findall(text))
+        else:
+            pending.extend(os.path.join(jq_folder, name + ".jq") for name in jq_include_pattern.findall(text))
+    return found
+
+
+def module_file(module_name):
+    """Return the path of the file of the smetcollect module, or None if there is no such module."""
+    if module_name.split(".")[0] != os.path.basename(package_folder):
+        return None
+    base = os.path.join(os.path.dirname(package_folder), *module_name.split("."))
+    for path in [base + ".py", os.path.join(base, "__init__.py")]:
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+def parse_module(path):
+    source = read_file(path)
+    return source, ast.parse(source)
+
+
+def import_bindings(tree, module_name, path):
+    """Return a dict of the names the module binds by importing, name -> list of (module name, attribute name or
+    None) the name may refer to. Imports inside functions are included."""
+    package = module_name if path.endswith("__init__.py") else module_name.rpartition(".")[0]
+    bindings = {}
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            for alias in node.names:
+                bindings[alias.asname or alias.name.split(".")[0]] = [(alias.name, None)]
+        elif isinstance(node, ast.ImportFrom):
+            parts = package.split(".")[:len(package.split(".")) - node.level + 1] if node.level else []
+            target = ".".join(parts + ([node.module] if node.module else []))
+            for alias in node.names:
+                bindings[alias.asname or alias.name] = [(target, alias.name)]
+    return bindings
+
+
+def module_dependencies(module_name, found):
+    """Add the path of the module and of the smetcollect modules it imports, directly or indirectly, to found."""
+    path = module_file(module_name)
+    if path is None or path in found:
+        return
+    found.add(path)
+    for references in import_bindings(parse_module(path)[1], module_name, path).values():
+        for reference in references:
+            reference_dependencies(reference, found)
+
+
+def reference_dependencies(reference, found):
+    """Add the paths of the modules an imported (module name, attribute name) depends on to found."""
+    module_name, attribute = reference
+    if attribute is not None and module_file(module_name + "." + attribute) is not None:
+        module_dependencies(module_name + "." + attribute, found)
+        return
+    path = module_file(module_name)
+    if path is None:
+        return
+    if attribute is not None and path.endswith("__init__.py"):
+        # Follow a name the package re-exports to the module it comes from, rather than take all of the package
+        bindings = import_bindings(parse_module(path)[1], module_name, path)
+        if attribute in bindings:
+            for binding in bindings[attribute]:
+                reference_dependencies(binding, found)
+            return
+    module_dependencies(module_name, found)
+
+
+def driver_dependencies(driver_name, found):
+    """Return the source of the driver function and of the functions, classes and values of its module it uses, and
+    add the paths of the modules they import to found. Other drivers in the module are left out."""
+    path = module_file(drivers_module)
+    if path is None:
+        return b""
+    source, tree = parse_module(path)
+    lines = source.splitlines(True)
+    starts = [min([node.lineno] + [d.lineno for d in getattr(node, "decorator_list", [])]) - 1 for node in tree.body]
+    ends = starts[1:] + [len(lines)]
+    definitions = {}
+    for node, start, end in zip(tree.body, starts, ends):
+        names = [node.name] if isinstance(node, (ast.FunctionDef, ast.ClassDef)) else \
+            [target.id for target in getattr(node, "targets", []) if isinstance(target, ast.Name)]
+        for name in names:
+            definitions[name] = (node, start, end)
+    if driver_name not in definitions:
+        module_dependencies(drivers_module, found)
+        return b""
+    bindings = import_bindings(tree, drivers_module, path)
+    pending = [driver_name]
+    used = set()
+    segments = {}
+    while pending:
+        name = pending.pop()
+        if name in used:
+            continue
+        used.add(name)
+        if name in definitions:
+            node, start, end = definitions[name]
+            segments[start] = b"".join(lines[start:end])
+            pending.extend(child.id for child in ast.walk(node) if isinstance(child, ast.Name))
+        for reference in bindings.get(name, []):
+            reference_dependencies(reference, found)
+    return b"".join(segments[start] for start in sorted(segments))
+
+
+def logic_digest(config):
+    """Return a digest of the analysis logic of the config: its script and driver, and the files they require,
+    include or import. Changes to other scripts, drivers and modules leave the digest as it is."""
+    digest = hashlib.sha1()
+    digest.update(u"{} {}".format(config.jq_script, config.py_driver_name).encode("utf-8"))
+    # Named relative to their folders, so the digest does not depend on where they are installed
+    files = []
+    if config.jq_script is not None:
+        scripts_root = os.path.dirname(JqEngineConfig.default_script_parent_folder())
+        files.extend((os.path.relpath(path, scripts_root), path) for path in script_dependencies(config.jq_script))
+    if config.py_driver_name is not None:
+        modules = set()
+        digest.update(driver_dependencies(config.py_driver_name, modules))
+        modules_root = os.path.dirname(package_folder)
+        files.extend((os.path.relpath(path, modules_root), path) for path in modules)
+    for name, path in sorted(files):
+        digest.update(name.encode("utf-8"))
+        digest.update(read_file(path))
+    return digest.hexdigest()
+
+
+def candidates_digest(race):
+    """Return a digest of the candidates of the race and their search terms.
+    :param race: A snapshot.RaceSnapshot
+    """
+    candidates = sorted([candidate.name, sorted(candidate.terms)] for candidate in race.candidates)
+    return hashlib.sha1(json.dumps(candidates).encode("utf-8")).hexdigest()
+
+
+class AnalysisCache(object):
+    """The keys of the analysis results of a bundle, for one analysis."""
+
+    def __init__(self, status, config):
+        """
+        :param status: The CollectorStatus object that tracks status state
+        :param config: The configuration of the analysis
+        """
+        self.status = status
+        self.logic_digest = logic_digest(config)
+        self.path = os.path.join(status.analyzed_data_folder_path(), cache_filename)
+        self.entries = OrderedDict()
+        if os.path.exists(self.path):
+            with io.open(self.path, "rb") as f:
+                self.entries = json.loads(f.read().decode("utf-8"), object_pairs_hook=OrderedDict)
+        self.candidates_digests = {}
+        self.pending = OrderedDict()
+
+    def key_for_run(self, race, run):
+        """Return the key of the result of the analysis for the run, or None if the run has no pruned data."""
+        input_digest = pruned_run_digest(self.status.pruned_data_file_path_for_run(race, run))
+        if input_digest is None:
+            return None
+        if race.slug not in self.candidates_digests:
+            self.candidates_digests[race.slug] = candidates_digest(self.status.snapshot().race(race.slug))
+        return OrderedDict([("input", input_digest), ("logic", self.logic_digest),
+                            ("candidates", self.candidates_digests[race.slug])])
+
+    def is_up_to_date(self, result_path, key):
+        """Return True if the result exists and was computed for the key."""
+        return os.path.exists(result_path) and self.entries.get(self.status.path_relative_to_bundle(result_path)) == key
+
+    def expect(self, result_path, key):
+        """Note that the result is being computed for the key. The key is recorded by save() if the result exists."""
+        self.pending[result_path] = key
+
+    def save(self):
+        """Record the keys of the expected results that have been written."""
+        for result_path, key in self.pending.items():
+            if os.path.exists(result_path):
+                self.entries[self.status.path_relative_to_bundle(result_path)] = key
+        self.pending = OrderedDict()
+        self.status.ensure_folder_exists(os.path.dirname(self.path))
+        write_json_atomically(self.path, self.entries)
@@ -20,19 +20,35 @@ from ..bundle.status_db import Run
 class ProcessCommandConfig(object):
     """Configuration parameters for an analysis command"""
 
-    def __init__(self, spark_driver, jq_script, description, max_depth=5, just_config=False):
+    def __init__(self, spark_driver, jq_script, description, max_depth=5, just_config=False, py_driver_name=None):
         """
         :param spark_driver: Driver to use when run against spark engine
         :param jq_script: Script to run when processing with jq
         :param description: Description of the command
         :param max_depth: The maximum number of runs per race to prune. Use None or non-positive to prune all.
         :param just_config: Only output config, do not run the command
+        :param py_driver_name: Name of the function in py/drivers.py to call for each task when processing with the
+        python engine
         """
         self.spark_driver = spark_driver
         self.jq_script = jq_script
+        self.py_driver_name = py_driver_name
         self.process_description = description
         self.max_depth = max_depth if max_depth > 0 else None
         self.just_config = just_config
+        # Set by commands whose results only depend on the run, so they can be recomputed when it changes (cache.py)
+        self.cached = False
+
+    @property
+    def py_driver(self):
+        """The function to call for each task when processing with the python engine, or None.
+
+        The drivers are imported on first use, so the other engines do not load the python engine and numpy.
+        """
+        if self.py_driver_name is None:
+            return None
+        from .py import drivers
+        return getattr(drivers, self.py_driver_name)
 
 
 class ProcessCommand(object):
@@ -59,14 +75,15 @@ class ProcessCommand(object):
         """
         return self.config.process_description
 
-    def add_spark_task(self, in_path, out_path_components, race_slug):
+    def add_spark_task(self, in_path, out_path_components, race_slug, **extras):
         """Add a task to the list of tasks to run.
         :param in_path: The path to the input file
         :param out_path: The location to write the output file
         :param race_slug: The slug of the race
+        :param extras: Additional parameters that are passed on to the task
         :return:
         """
-        task = AnalysisTaskDef(in_path, out_path_components[0], out_path_components[1], race_slug)
+        task = AnalysisTaskDef(in_path, out_path_components[0], out_path_components[1], race_slug, extras)
         self.tasks.append(task)
 
     def generate_task_config(self, slug):
@@ -117,6 +134,11 @@ class ProcessCommand(object):
         """Do any preparation necessary to process the races. Default does nothing."""
         return
 
+    @staticmethod
+    def finish_processing():
+        """Do any work necessary once the queued tasks have been run. Default does nothing."""
+        return
+
     def collect_runs_to_process(self):
         """Find runs that need to be pruned"""
         races = self.status.races_matching_slug(self.race_slug)
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+fused.py
+
+Module for pruning a run and summarizing its metadata and hashtags in a single pass over the raw data.
+"""
+
+import os
+
+from .analyze import CandidateConfigToJson, MetadataAnalyzerConfig, HashtagAnalyzerConfig
+from .prune import Pruner, PrunerConfig
+from ..bundle import slug_for_race
+
+
+class FusedProcessorConfig(PrunerConfig):
+    """Configuration for pruning and analyzing in one pass. Only supported by the python engine."""
+
+    def __init__(self, status, max_depth=5, just_config=False, compress=False, compress_pruned=False,
+                 lines_pruned=False):
+        """
+        :param compress: Also compress the raw data while reading it.
+        :param compress_pruned: Write the pruned data gzipped, as <run>.json.gz
+        :param lines_pruned: Write the pruned data as json lines, <run>.jsonl, with an index
+        """
+        super(FusedProcessorConfig, self).__init__(status, max_depth, just_config, compress, compress_pruned,
+                                                   lines_pruned)
+        self.spark_driver = None
+        self.jq_script = None
+        self.py_driver_name = "fused_run"
+        self.process_description = "Pruning and analyzing"
+        self.metadata_config = MetadataAnalyzerConfig(status, max_depth, just_config)
+        self.hashtag_config = HashtagAnalyzerConfig(status, max_depth, just_config)
+
+
+class FusedProcessor(Pruner):
+    """Prune runs and write the metadata and hashtag summaries for them"""
+
+    def __init__(self, status, config=None, race=None):
+        """Constructor for the fused processor.
+        :param status: The CollectorStatus object that tracks status state
+        :param config: The configuration for the processor
+        :param race: The slug for a race if should restrict to one race
+        """
+        self.status = status
+        config = config if config is not None else FusedProcessorConfig(status)
+        super(FusedProcessor, self).__init__(self.status, config, race)
+
+    def output_path_components(self, race, run):
+        return [self.config.output_path_components(race, run),
+                self.config.metadata_config.output_path_components(race, run),
+                self.config.hashtag_config.output_path_components(race, run)]
+
+    def prepare_processing(self, races):
+        """Make sure the analysis folders exist and the candidate config is current."""
+        for race in races:
+            for config in [self.config.metadata_config, self.config.hashtag_config]:
+                parent = config.output_path_components(race)
+                self.status.ensure_folder_exists(self.status.path_from_components(parent))
+        if len(races) > 0:
+            CandidateConfigToJson(self.status).save()
+
+    def queue_processing(self, race, run):
+        raw_data_path = self.status.raw_data_folder_path_for_run(race, run)
+        pruned, metadata, hashtag = self.output_path_components(race, run)
+        msg = "{} run: {}".format(self.process_description(), raw_data_path.encode('utf-8'))
+        self.status.progress_func({'type': 'prune', 'message': msg})
+        extras = self.raw_extras(race, run)
+        extras.update(self.pruned_extras())
+        self.add_spark_task(raw_data_path, pruned, slug_for_race(race),
+                            mdoutfolder=metadata[0], mdoutname=metadata[1],
+                            htoutfolder=hashtag[0], htoutname=hashtag[1],
+                            **extras)
+
+    def should_process_run(self, race, run):
+        """Process runs that have raw data and are missing any of the outputs."""
+        if not self.status.raw_reader(race, run).exists():
+            return False
+        metadata, hashtag = self.output_path_components(race, run)[1:]
+        if not self.status.has_pruned_data_for_run(race, run):
+            return True
+        return not (os.path.exists(self.status.path_from_components(metadata)) and
+                    os.path.exists(self.status.path_from_components(hashtag)))
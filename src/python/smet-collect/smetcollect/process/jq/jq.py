@@ -19,6 +19,8 @@ from os.path import dirname
 
 from builtins import str
 
+from ...bundle.pruned import only_in_partition
+
 
 def log_command_execution(log_file, cmd):
     now_str = datetime.utcnow().strftime("%H:%M:%S")
@@ -297,6 +299,7 @@ class JqEngine(object):
 
         if not self.cmd.config.just_config:
             self.stop_run()
+            self.cmd.finish_processing()
 
     @abc.abstractmethod
     def queue_processing(self, race, run):
@@ -310,12 +313,28 @@ class JqEngine(object):
         """Run the command for matching races"""
         self.cmd = cmd
         self.cmd.collect_runs_to_process()
+        self.drop_partitioned_runs()
         self.cmd.log_intermediate_progress_update()
         self.status.ensure_folder_exists(self.status.tmp_folder_path())
         self.do_processing()
         msg = '{} finished'.format(self.cmd.process_description())
         self.status.progress_func({'type': 'progress', 'message': msg})
 
+    def drop_partitioned_runs(self):
+        """Drop the runs whose pruned data has been merged into a partition, which jq cannot read. They would
+        otherwise never be analyzed, and be queued again by every pass."""
+        for race, runs in list(self.cmd.runs_to_process.items()):
+            partitioned = [run for run in runs
+                           if only_in_partition(self.status.pruned_data_file_path_for_run(race, run))]
+            if not partitioned:
+                continue
+            self.cmd.runs_to_process[race] = [run for run in runs if run not in partitioned]
+            if not self.cmd.runs_to_process[race]:
+                del self.cmd.runs_to_process[race]
+            msg = "Skipping {} runs of race {} that are in partitions. Use the python engine.".format(
+                len(partitioned), race.name.encode('utf-8'))
+            self.status.progress_func({'type': 'progress', 'message': msg})
+
     def run_without_collect(self, cmd):
         """Run the engine on the command, but do not collect runs to process"""
         self.cmd = cmd
@@ -11,13 +11,32 @@ Created by Chandrasekhar Ramakrishnan on 2016-01-17.
 Copyright (c) 2016 Chandrasekhar Ramakrishnan. All rights reserved.
 """
 
+import bz2
+import gzip
 import json
+import os
+import subprocess
+import sys
+from collections import OrderedDict
+from datetime import datetime
+from multiprocessing.pool import ThreadPool
 
+import pytest
+import six
+from sqlalchemy import event
+
+import smetcollect
 from . import jq
-from ...process import analyze, prune
+from .. import py
+from ...bundle import aggregates, archive, columns, container, cooccur, dedup, dictionary, pruned, raw, sketch, \
+    storage, status_db, results_filename_to_datetime
+from ...bundle.snapshot import urlquote, encoded_search_term
+from ...process import analyze, cache, fused, prune, task_config
+from ...process.py import drivers, tweets, vectorized
 from ...collect import collect
 from ...collect import collect_test
 from ...collect import compress
+from ...collect import pipeline
 
 
 def race_pruned_data_folder_path(tmpdir):
@@ -28,6 +47,12 @@ def race_compressed_data_folder_path(tmpdir):
     return tmpdir.join("compressed", "chicago-mayor-runoff-2015")
 
 
+def race_archives(tmpdir):
+    """The archives in the compressed folder, without their manifests"""
+    return race_compressed_data_folder_path(tmpdir).listdir(lambda p: not p.basename.endswith(".manifest.json"),
+                                                            sort=True)
+
+
 def race_analyzed_data_folder_path(tmpdir):
     return tmpdir.join("analyzed", "chicago-mayor-runoff-2015", "metadata")
 
@@ -40,9 +65,11 @@ def race_log_folder_path(tmpdir):
     return tmpdir.join("log", "chicago-mayor-runoff-2015")
 
 
-def setup_bundle(smet_bundle, tmpdir):
+def setup_bundle(smet_bundle, tmpdir, raw_storage=None):
     # Setup
     status = collect_test.initialized_bundle_status(smet_bundle, tmpdir)
+    if raw_storage is not None:
+        status.raw_storage = storage.storage_for_name(raw_storage)
 
     # Run the collector
     collector = collect.TweetCollector(status)
@@ -95,8 +122,8 @@ def run_compressor_test(status, tmpdir):
     compressor = compress.Compressor(status)
     compressor.run()
 
-    compressed_output_dir = race_compressed_data_folder_path(tmpdir)
-    assert 2 == len(compressed_output_dir.listdir())
+    assert 2 == len(race_archives(tmpdir))
+    assert 4 == len(race_compressed_data_folder_path(tmpdir).listdir())
 
     # Remove runs that have been compressed
     archiver = compress.Archiver(status)
@@ -113,7 +140,7 @@ def check_summary_dict(run, correct, keys):
 def check_analyzer_output(analyzer_output_dir):
     # There should be one pruned data dir for each run
     assert 2 == len(analyzer_output_dir.listdir())
-    with analyzer_output_dir.listdir()[0].open() as f:
+    with analyzer_output_dir.listdir(sort=True)[0].open() as f:
         run1 = json.load(f)
     assert len(run1) == 2
     keys = ["idcount", "user_idcount", "rt_idcount", "rt_rtcount", "min_datetime", "max_datetime"]
@@ -132,7 +159,7 @@ def check_analyzer_output(analyzer_output_dir):
     check_summary_dict(run1[0], run_results, keys)
     check_summary_dict(run1[1], run_results, keys)
 
-    with analyzer_output_dir.listdir()[1].open() as f:
+    with analyzer_output_dir.listdir(sort=True)[1].open() as f:
         run2 = json.load(f)
     assert len(run2) == 2
     run_results = {'Rahm Emanuel': {"idcount": 500,
@@ -155,7 +182,7 @@ def check_analyzer_output(analyzer_output_dir):
 def check_hashtag_analyzer_output(analyzer_output_dir):
     # There should be one pruned data dir for each run
     assert 2 == len(analyzer_output_dir.listdir())
-    with analyzer_output_dir.listdir()[0].open() as f:
+    with analyzer_output_dir.listdir(sort=True)[0].open() as f:
         run1 = json.load(f)
     assert run1[1]['name'] == 'Rahm Emanuel'
     assert run1[1]['counts'][0]['tag'] == "jonvoyage"
@@ -165,7 +192,7 @@ def check_hashtag_analyzer_output(analyzer_output_dir):
     assert run1[0]['counts'][0]['tag'] == "blue1647"
     assert run1[0]['counts'][0]['rtc'] == 20
 
-    with analyzer_output_dir.listdir()[1].open() as f:
+    with analyzer_output_dir.listdir(sort=True)[1].open() as f:
         run2 = json.load(f)
     assert run2[1]['name'] == 'Rahm Emanuel'
     assert run2[1]['counts'][0]['tag'] == "fightfordyett"
@@ -212,6 +239,928 @@ def run_hashtag_analyzer_test(status, tmpdir):
     check_hashtag_analyzer_output(race_output_dir)
 
 
+def test_compressed_pruned_data(smet_bundle, tmpdir):
+    status = setup_bundle(smet_bundle, tmpdir)
+    engine = jq.JqEngine(status, jq.JqEngineConfig())
+    engine.run(prune.Pruner(status, prune.PrunerConfig(status, compress_pruned=True)))
+    pruned_files = race_pruned_data_folder_path(tmpdir).listdir(sort=True)
+    assert 2 == len(pruned_files)
+    assert all(path.basename.endswith(pruned.gzip_extension) for path in pruned_files)
+
+    race = status.races()[0]
+    for run in race.runs:
+        assert status.has_pruned_data_for_run(race, run)
+        path = status.robust_pruned_data_file_path_for_run(run)
+        assert path.endswith(pruned.gzip_extension)
+        assert 0 < len(pruned.read_pruned_run(status.pruned_data_file_path_for_run(race, run)))
+
+    # The jq analyzers decompress the pruned data as they read it
+    run_analyzer_test(status, tmpdir)
+    run_hashtag_analyzer_test(status, tmpdir)
+
+    # And so do the python analyzers
+    tmpdir.join("analyzed").remove()
+    py_engine = py.PyEngine(status, py.PyEngineConfig())
+    py_engine.run(analyze.GenericAnalyzer(status, analyze.MetadataAnalyzerConfig(status)))
+    check_analyzer_output(race_analyzed_data_folder_path(tmpdir))
+    py_engine.run(analyze.GenericAnalyzer(status, analyze.HashtagAnalyzerConfig(status)))
+    check_hashtag_analyzer_output(race_analyzed_hashtag_data_folder_path(tmpdir))
+
+
+def test_lines_pruned_data(smet_bundle, tmpdir):
+    status = setup_bundle(smet_bundle, tmpdir)
+    engine = jq.JqEngine(status, jq.JqEngineConfig())
+    engine.run(prune.Pruner(status, prune.PrunerConfig(status, lines_pruned=True)))
+    pruned_dir = race_pruned_data_folder_path(tmpdir)
+    assert all(path.basename.endswith(pruned.lines_extension) for path in pruned_dir.listdir())
+
+    race = status.races()[0]
+    for run in race.runs:
+        pruned_data_path = status.pruned_data_file_path_for_run(race, run)
+        lines_path = pruned_data_path + pruned.lines_extension
+        records = [json.loads(line.decode("utf-8"))
+                   for line in pruned_dir.join(run.results_folder + ".jsonl").read_binary().splitlines()]
+        # jq does not write the index, it is built on the first read
+        assert records == pruned.read_pruned_run(pruned_data_path)
+        index = pruned.lines_index(lines_path)
+        assert len(records) == index["count"] == pruned.pruned_run_count(pruned_data_path)
+        assert min(record["id"] for record in records) == index["min_id"]
+        assert max(record["id"] for record in records) == index["max_id"]
+        for i in [0, len(records) // 2, len(records) - 1]:
+            assert records[i] == pruned.read_line(lines_path, i)
+        for candidate, start, count in index["candidates"]:
+            assert [r for r in records if r["candidate"] == candidate] == \
+                pruned.read_candidate_lines(lines_path, candidate)
+
+        # The python engine writes the same index
+        copy_path = str(tmpdir.join(run.results_folder + pruned.lines_extension))
+        pruned.write_lines(copy_path, records)
+        # Other than the modification time of the file
+        copy_index = pruned.lines_index(copy_path)
+        assert [(k, v) for k, v in index.items() if k != "mtime"] == \
+            [(k, v) for k, v in copy_index.items() if k != "mtime"]
+        assert not compress.Rebuilder(engine).should_rebuild_run(race, run)
+
+        # Rewriting the run without its index, as jq does when it prunes again, does not leave a stale index
+        with open(copy_path, "wb") as f:
+            f.write(pruned.dumps_line(records[-1]))
+        assert 1 == pruned.lines_index(copy_path)["count"]
+        assert [records[-1]] == pruned.read_lines(copy_path)
+
+    run_analyzer_test(status, tmpdir)
+    run_hashtag_analyzer_test(status, tmpdir)
+
+
+def test_vectorized_metadata_summary(smet_bundle, tmpdir):
+    pytest.importorskip("numpy")
+    status = setup_bundle(smet_bundle, tmpdir)
+    engine = py.PyEngine(status, py.PyEngineConfig())
+    engine.run(prune.Pruner(status))
+    engine.run(analyze.GenericAnalyzer(status, analyze.MetadataAnalyzerConfig(status, vectorized=True)))
+    check_analyzer_output(race_analyzed_data_folder_path(tmpdir))
+
+    race = status.races()[0]
+    for run in race.runs:
+        records = pruned.read_pruned_run(status.pruned_data_file_path_for_run(race, run))
+        assert tweets.metadata_summary(records, run.results_folder) == \
+            vectorized.metadata_summary(records, run.results_folder)
+        # Summaries of tweets with other time zones and missing fields are the same too
+        records[0]["date"] = "Wed Aug 05 18:48:36 -0130 2015"
+        records[-1]["uid"] = None
+        assert tweets.metadata_summary(records, run.results_folder) == \
+            vectorized.metadata_summary(records, run.results_folder)
+    assert [] == vectorized.metadata_summary([], "empty")
+
+
+def test_distinct_sketches(smet_bundle, tmpdir):
+    status = setup_bundle(smet_bundle, tmpdir)
+    engine = py.PyEngine(status, py.PyEngineConfig())
+    engine.run(prune.Pruner(status))
+    engine.run(analyze.GenericAnalyzer(status, analyze.MetadataAnalyzerConfig(status)))
+    check_analyzer_output(race_analyzed_data_folder_path(tmpdir))
+
+    race = status.races()[0]
+    paths = []
+    users = {}
+    retweets = {}
+    for run in race.runs:
+        path = status.analysis_result_path(race, sketch.sketches_analysis_type, run)
+        paths.append(path)
+        run_sketches = sketch.read_run_sketches(path)
+        records = pruned.read_pruned_run(status.pruned_data_file_path_for_run(race, run))
+        for summary in tweets.metadata_summary(records, run.results_folder):
+            # The summary counts no uid or rt_id as one more distinct value
+            candidate_records = [record for record in records if record["candidate"] == summary["name"]]
+            run_users = set(record["uid"] for record in candidate_records)
+            run_retweets = set(record["rt_id"] for record in candidate_records if record["rt_id"] is not None)
+            assert summary["user_idcount"] == len(run_users)
+            assert abs(len(run_users) - run_sketches[summary["name"]]["users"].count()) <= len(run_users) * 0.05 + 1
+            assert abs(len(run_retweets) - run_sketches[summary["name"]]["retweets"].count()) <= \
+                len(run_retweets) * 0.05 + 1
+            users.setdefault(summary["name"], set()).update(run_users)
+            retweets.setdefault(summary["name"], set()).update(run_retweets)
+
+    counts = sketch.distinct_counts(paths)
+    assert sorted(users.keys()) == sorted(row["name"] for row in counts)
+    for row in counts:
+        assert abs(len(users[row["name"]]) - row["users"]) <= len(users[row["name"]]) * 0.05 + 1
+        assert abs(len(retweets[row["name"]]) - row["retweets"]) <= len(retweets[row["name"]]) * 0.05 + 1
+    assert [] == sketch.distinct_counts([])
+
+
+def test_analysis_cache(smet_bundle, tmpdir):
+    status = setup_bundle(smet_bundle, tmpdir)
+    engine = py.PyEngine(status, py.PyEngineConfig())
+    engine.run(prune.Pruner(status))
+    engine.run(analyze.GenericAnalyzer(status, analyze.MetadataAnalyzerConfig(status)))
+    check_analyzer_output(race_analyzed_data_folder_path(tmpdir))
+    with tmpdir.join("analyzed", cache.cache_filename).open() as f:
+        assert 2 == len(json.load(f))
+
+    def runs_to_analyze():
+        analyzer = analyze.GenericAnalyzer(status, analyze.MetadataAnalyzerConfig(status))
+        analyzer.collect_runs_to_process()
+        return [run.results_folder for runs in analyzer.runs_to_process.values() for run in runs]
+
+    # Nothing has changed, so nothing is recomputed
+    assert [] == runs_to_analyze()
+
+    # Only the run whose pruned data changed is recomputed
+    race = status.races()[0]
+    run = race.runs[0]
+    pruned_data_path = status.pruned_data_file_path_for_run(race, run)
+    records = pruned.read_pruned_run(pruned_data_path)
+    with open(pruned_data_path + pruned.json_extension, "w") as f:
+        json.dump(records[1:], f)
+    assert [run.results_folder] == runs_to_analyze()
+    engine.run(analyze.GenericAnalyzer(status, analyze.MetadataAnalyzerConfig(status)))
+    with open(status.analysis_result_path(race, "metadata", run)) as f:
+        assert len(records) - 1 == json.load(f)[0]["tweetcount"]
+    assert [] == runs_to_analyze()
+
+    # Other analyses have their own keys, and results without a key are recomputed
+    config = analyze.HashtagAnalyzerConfig(status)
+    assert cache.AnalysisCache(status, config).key_for_run(race, run) != \
+        cache.AnalysisCache(status, analyze.MetadataAnalyzerConfig(status)).key_for_run(race, run)
+    tmpdir.join("analyzed", cache.cache_filename).remove()
+    assert 2 == len(runs_to_analyze())
+
+    # The logic of an analysis is its script and driver and what they use, not the other scripts and drivers
+    scripts = set(os.path.basename(path) for path in cache.script_dependencies(config.jq_script))
+    assert {"hashtags.rb", "config_parser.rb", "twitter_hashtags.jq"} == scripts
+    modules = set()
+    source = cache.driver_dependencies("hashtags_run", modules)
+    assert b"def hashtags_run" in source and b"def summarize_run" not in source
+    modules = set(os.path.basename(path) for path in modules)
+    assert "tweets.py" in modules
+    assert not modules & {"drivers.py", "cooccur.py", "aggregates.py", "columns.py"}
+
+
+def test_jq_analysis_does_not_import_drivers():
+    # The python drivers, and numpy with them, are only imported when the python engine runs a command
+    script = "import sys, smetcollect\n" \
+             "from smetcollect.process import analyze, cache\n" \
+             "config = analyze.HashtagAnalyzerConfig(None)\n" \
+             "cache.logic_digest(config)\n" \
+             "assert 'smetcollect.process.py.drivers' not in sys.modules\n" \
+             "assert config.py_driver.__name__ == 'hashtags_run'\n"
+    package_parent = os.path.dirname(os.path.dirname(os.path.abspath(smetcollect.__file__)))
+    subprocess.check_call([sys.executable, "-c", script], cwd=package_parent)
+
+
+def test_config_snapshot(smet_bundle, tmpdir):
+    status = setup_bundle(smet_bundle, tmpdir)
+    statements = []
+
+    def count_statement(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(status.engine, "before_cursor_execute", count_statement)
+    try:
+        snapshot = status.snapshot()
+    finally:
+        event.remove(status.engine, "before_cursor_execute", count_statement)
+    assert 1 == len(statements)
+    assert snapshot is status.snapshot()
+
+    races = status.races()
+    assert [race.slug for race in races] == [race.slug for race in snapshot.races]
+    namemap = {}
+    for race in races:
+        race_snapshot = snapshot.race(race.slug)
+        assert [candidate.name for candidate in race.candidates.all()] == \
+            [candidate.name for candidate in race_snapshot.candidates]
+        for candidate, candidate_snapshot in zip(race.candidates.all(), race_snapshot.candidates):
+            terms = [term.term for term in candidate.search_terms.all()]
+            assert terms == candidate_snapshot.terms
+            assert [urlquote(term) for term in terms] == candidate_snapshot.quoted_terms
+            for term in terms:
+                namemap[encoded_search_term(term)] = candidate.name
+    assert namemap == task_config.candidates_map(status)
+    assert snapshot.race("no-such-race") is None
+
+    # Syncing the config loads a new snapshot
+    status.sync_config()
+    assert snapshot is not status.snapshot()
+
+
+def test_fused_processing(smet_bundle, tmpdir):
+    status = setup_bundle(smet_bundle, tmpdir)
+    engine = py.PyEngine(status, py.PyEngineConfig())
+    processor = fused.FusedProcessor(status)
+    engine.run(processor)
+
+    success_dir = tmpdir.join("log", "succeeded")
+    assert 1 == len(success_dir.listdir())
+    assert 2 == len(race_pruned_data_folder_path(tmpdir).listdir())
+    check_analyzer_output(race_analyzed_data_folder_path(tmpdir))
+    check_hashtag_analyzer_output(race_analyzed_hashtag_data_folder_path(tmpdir))
+
+    # Everything has been processed, so a second pass does nothing
+    processor = fused.FusedProcessor(status)
+    processor.collect_runs_to_process()
+    assert 0 == len(processor.runs_to_process)
+
+
+def test_prune_and_compress(smet_bundle, tmpdir):
+    status = setup_bundle(smet_bundle, tmpdir)
+    engine = py.PyEngine(status, py.PyEngineConfig())
+    pruner = prune.Pruner(status, prune.PrunerConfig(status, compress=True))
+    engine.run(pruner)
+
+    assert 2 == len(race_pruned_data_folder_path(tmpdir).listdir())
+    assert 2 == len(race_archives(tmpdir))
+    assert 4 == len(race_compressed_data_folder_path(tmpdir).listdir())
+
+    # The runs are compressed, so the compressor has nothing to do and the raw data can be removed
+    compressor = compress.Compressor(status)
+    compressor.collect_runs_to_compress()
+    assert 0 == len(compressor.runs_to_compress)
+    raw_output_dir = collect_test.race_output_folder_path(tmpdir)
+    page_count = sum(len(run_dir.listdir()) for run_dir in raw_output_dir.listdir())
+    archiver = compress.Archiver(status)
+    archiver.run()
+    assert 0 == len(raw_output_dir.listdir())
+
+    # The archives contain all the pages
+    uncompressor = compress.Uncompressor(status)
+    uncompressor.run()
+    assert page_count == sum(len(run_dir.listdir()) for run_dir in raw_output_dir.listdir())
+
+
+@pytest.mark.parametrize("fused_run", [False, True])
+def test_pipeline(smet_bundle, tmpdir, fused_run):
+    status = setup_bundle(smet_bundle, tmpdir)
+    config = pipeline.PipelineConfig(skip_collect=True, fused=fused_run, workers=2)
+    failures = pipeline.Pipeline(status, config).run()
+    assert 0 == len(failures)
+
+    # Each run has been pruned, compressed, and its raw data deleted
+    assert 2 == len(race_pruned_data_folder_path(tmpdir).listdir())
+    assert 2 == len(race_archives(tmpdir))
+    assert 0 == len(collect_test.race_output_folder_path(tmpdir).listdir())
+
+    # Nothing is left to do
+    scheduler_failures = pipeline.Pipeline(status, config).run()
+    assert 0 == len(scheduler_failures)
+    assert 2 == len(race_archives(tmpdir))
+
+
+def test_sharded_pipeline(smet_bundle, tmpdir):
+    status = setup_bundle(smet_bundle, tmpdir)
+    messages = []
+    status.progress_func = lambda progress_data: messages.append(progress_data['message'])
+    config = pipeline.PipelineConfig(skip_collect=True, fused=True, workers=2)
+    sharded = pipeline.ShardedPipeline(status, config, jobs=2)
+    # There are more jobs than races
+    assert [["chicago-mayor-runoff-2015"]] == sharded.shards()
+    failures = sharded.run()
+    assert 0 == len(failures)
+
+    # The worker ran the whole pipeline for its race and sent its progress back
+    assert 2 == len(race_pruned_data_folder_path(tmpdir).listdir())
+    assert 2 == len(race_archives(tmpdir))
+    assert 0 == len(collect_test.race_output_folder_path(tmpdir).listdir())
+    assert any(message.startswith("[job 0] Pipeline finished") for message in messages)
+
+    # The journal mode of the status db is restored and it can still be used here
+    assert "delete" == status_db.set_journal_mode(status.engine, "delete")
+    assert 2 == len(status.races()[0].runs.all())
+
+
+def test_pipeline_jobs(smet_bundle, tmpdir, smet_bundle2):
+    status = setup_bundle(smet_bundle, tmpdir)
+    status2 = collect_test.initialized_bundle_status(smet_bundle2)
+    messages = [], []
+    # One job at a time, so the second pipeline waits for the first
+    jobs = pipeline.PipelineJobs(1)
+    config = pipeline.PipelineConfig(skip_collect=True, fused=True, workers=2)
+    for i, each in enumerate([status, status2]):
+        jobs.add(each, config, progress_func=lambda progress_data, i=i: messages[i].append(progress_data['message']))
+    failures = jobs.run()
+    assert [{}, {}] == failures
+
+    # Each pipeline ran in its own bundle and reported its own progress
+    assert 2 == len(race_archives(tmpdir))
+    assert 0 == len(collect_test.race_output_folder_path(tmpdir).listdir())
+    assert "Race chicago-mayor-runoff-2015 has 2 runs to prune, 2 to compress and 2 to archive" in messages[0]
+    assert "Race chicago-mayor-runoff-2015 has 0 runs to prune, 0 to compress and 0 to archive" in messages[1]
+
+
+def test_dag_scheduler():
+    scheduler = pipeline.DagScheduler(workers=2)
+    finished = []
+
+    def task(name):
+        finished.append(name)
+        if name == "fail":
+            raise ValueError("failed")
+
+    def add_later():
+        scheduler.add("later", lambda: task("later"), ["first"])
+
+    scheduler.add("first", lambda: task("first"))
+    scheduler.add("second", lambda: task("second"), ["first"])
+    scheduler.add("main", lambda: task("main"), ["second"], in_main_thread=True)
+    scheduler.add("fail", lambda: task("fail"))
+    scheduler.add("skipped", lambda: task("skipped"), ["fail"])
+    scheduler.add("skipped_too", lambda: task("skipped_too"), ["skipped", "first"])
+    scheduler.add("adder", add_later, ["main"], in_main_thread=True)
+    failures = scheduler.run()
+
+    assert ["fail"] == list(failures.keys())
+    assert "ValueError" in failures["fail"]
+    assert finished.index("first") < finished.index("second") < finished.index("main") < finished.index("later")
+    assert "skipped" not in finished and "skipped_too" not in finished
+    assert pipeline.skipped == scheduler.state("skipped_too")
+    assert pipeline.done == scheduler.state("later")
+
+
+def test_rebuild_from_archive(smet_bundle, tmpdir):
+    status = setup_bundle(smet_bundle, tmpdir)
+    engine = py.PyEngine(status, py.PyEngineConfig())
+    engine.run(prune.Pruner(status, prune.PrunerConfig(status, compress=True)))
+    compress.Archiver(status).run()
+    raw_output_dir = collect_test.race_output_folder_path(tmpdir)
+    assert 0 == len(raw_output_dir.listdir())
+
+    pruned_paths = race_pruned_data_folder_path(tmpdir).listdir(sort=True)
+    pruned_data = [path.read_binary() for path in pruned_paths]
+    for path in pruned_paths:
+        path.remove()
+
+    # The pruned data is rebuilt from the archives, without extracting them
+    compress.Rebuilder(engine).run()
+    assert pruned_data == [path.read_binary() for path in race_pruned_data_folder_path(tmpdir).listdir(sort=True)]
+    assert 0 == len(raw_output_dir.listdir())
+
+    # jq reads the archives too
+    for path in pruned_paths:
+        path.remove()
+    jq.JqEngine(status, jq.JqEngineConfig()).run(prune.Pruner(status))
+    for path, expected in zip(race_pruned_data_folder_path(tmpdir).listdir(sort=True), pruned_data):
+        assert len(json.loads(expected.decode("utf-8"))) == len(json.loads(path.read_binary().decode("utf-8")))
+    assert 0 == len(raw_output_dir.listdir())
+
+    # Runs are rebuilt in the format they were pruned in
+    pruned_dir = race_pruned_data_folder_path(tmpdir)
+    names = [path.purebasename for path in pruned_paths]
+    for path in pruned_dir.listdir():
+        path.remove()
+    pruned_dir.join(names[0] + pruned.lines_extension).write_binary(b"")
+    with gzip.open(str(pruned_dir.join(names[1] + pruned.gzip_extension)), "wb") as f:
+        f.write(b"[]")
+    compress.Rebuilder(engine).run()
+    assert sorted([names[0] + pruned.lines_extension, names[0] + ".index.json", names[1] + pruned.gzip_extension]) == \
+        sorted(path.basename for path in pruned_dir.listdir())
+    for name, expected in zip(names, pruned_data):
+        assert len(json.loads(expected.decode("utf-8"))) == pruned.pruned_run_count(str(pruned_dir.join(name)))
+
+    # Rebuilding in another format removes the file in the old format
+    pruned_dir.join(names[0] + pruned.lines_extension).write_binary(b"")
+    compress.Rebuilder(engine, pruner_config=prune.PrunerConfig(status)).run()
+    assert sorted([names[0] + pruned.json_extension, names[1] + pruned.gzip_extension]) == \
+        sorted(path.basename for path in pruned_dir.listdir())
+
+
+def test_parallel_compress(smet_bundle, tmpdir):
+    status = setup_bundle(smet_bundle, tmpdir)
+    engine = py.PyEngine(status, py.PyEngineConfig())
+    engine.run(prune.Pruner(status, prune.PrunerConfig(status)))
+
+    codec = "xz" if archive.XzCodec.available() else "bz2"
+    config = compress.CompressorConfig(codec=codec, workers=2)
+    compressor = compress.Compressor(status, config)
+    compressor.run()
+    assert 2 == len(race_archives(tmpdir))
+    assert all(path.basename.endswith(archive.extension_for_codec(codec)) for path in race_archives(tmpdir))
+
+    raw_output_dir = collect_test.race_output_folder_path(tmpdir)
+    pages = {path.basename: path.read_binary() for run_dir in raw_output_dir.listdir() for path in run_dir.listdir()}
+    compress.Archiver(status, config).run()
+    assert 0 == len(raw_output_dir.listdir())
+    compress.Uncompressor(status, config).run()
+    assert pages == {path.basename: path.read_binary()
+                     for run_dir in raw_output_dir.listdir() for path in run_dir.listdir()}
+
+
+def test_verify_archives(smet_bundle, tmpdir):
+    status = setup_bundle(smet_bundle, tmpdir)
+    engine = py.PyEngine(status, py.PyEngineConfig())
+    engine.run(prune.Pruner(status, prune.PrunerConfig(status, compress=True)))
+    compress.Archiver(status).run()
+
+    # The manifests are enough to verify the archives once the raw data is gone
+    verifier = compress.Verifier(status)
+    verifier.run()
+    assert 2 == sum(len(runs) for runs in verifier.runs_to_verify.values())
+    assert 0 == len(verifier.failed_runs)
+
+    # Tampering with the manifest is noticed
+    archive_path = str(race_archives(tmpdir)[0])
+    manifest = archive.read_manifest(archive_path)
+    name = sorted(manifest["members"].keys())[0]
+    manifest["members"][name]["sha256"] = archive.page_checksum(b"")
+    assert ["File {} is corrupt in archive".format(name)] == archive.verify_archive(archive_path, manifest)
+    archive.write_manifest(archive_path, archive.codec_for_path(archive_path), manifest["members"])
+    verifier = compress.Verifier(status)
+    verifier.run()
+    assert 1 == len(verifier.failed_runs)
+
+
+@pytest.mark.parametrize("raw_storage", ["segment", "sqlite"])
+def test_raw_storage(smet_bundle, tmpdir, smet_bundle2, raw_storage):
+    status = setup_bundle(smet_bundle, tmpdir, raw_storage)
+    raw_storage = storage.storage_for_name(raw_storage)
+    raw_output_dir = collect_test.race_output_folder_path(tmpdir)
+    run_files = raw_output_dir.listdir(sort=True)
+    assert 2 == len(run_files)
+    assert all(path.isfile() and path.basename.endswith(raw_storage.extension) for path in run_files)
+    race = status.races()[0]
+    pages = {}
+    for run in race.runs:
+        reader = status.raw_reader(race, run)
+        assert reader.source() == raw_storage.run_path(reader.raw_data_path)
+        pages.update(reader.pages())
+    assert 0 < len(pages)
+
+    # Importing reads the pages through the storage
+    other_status = collect_test.initialized_bundle_status(smet_bundle2, tmpdir)
+    importer = collect.RawImport(other_status)
+    importer.run()
+    assert 2 == len(importer.imported_run_folders)
+    other_race = other_status.races()[0]
+    assert sum(len(run.searches.all()) for run in race.runs) == \
+        sum(len(run.searches.all()) for run in other_race.runs)
+
+    # Pruning and compressing read the pages through the storage
+    engine = py.PyEngine(status, py.PyEngineConfig())
+    engine.run(prune.Pruner(status, prune.PrunerConfig(status, compress=True)))
+    assert 2 == len(race_pruned_data_folder_path(tmpdir).listdir())
+    assert 2 == len(race_archives(tmpdir))
+    compress.Archiver(status).run()
+    assert 0 == len(raw_output_dir.listdir())
+    compress.Uncompressor(status).run()
+    assert pages == {path.basename: path.read_binary()
+                     for run_dir in raw_output_dir.listdir() for path in run_dir.listdir()}
+
+
+def test_recompress_archives(smet_bundle, tmpdir):
+    status = setup_bundle(smet_bundle, tmpdir)
+    engine = py.PyEngine(status, py.PyEngineConfig())
+    engine.run(prune.Pruner(status, prune.PrunerConfig(status)))
+    compress.Compressor(status, compress.CompressorConfig(codec="frames")).run()
+    raw_output_dir = collect_test.race_output_folder_path(tmpdir)
+    # tar records whole seconds
+    pages = {path.basename: (path.read_binary(), int(path.mtime()))
+             for run_dir in raw_output_dir.listdir() for path in run_dir.listdir()}
+    compress.Archiver(status).run()
+
+    # Runs newer than the threshold are left alone
+    recompressor = compress.Recompressor(status, compress.RecompressorConfig(codec="bz2", min_age_days=100000))
+    recompressor.run()
+    assert 0 == len(recompressor.runs_to_recompress)
+
+    recompressor = compress.Recompressor(status, compress.RecompressorConfig(codec="bz2", min_age_days=0, workers=2))
+    recompressor.run()
+    assert 0 == len(recompressor.failed_runs)
+    archives = race_archives(tmpdir)
+    assert 2 == len(archives)
+    assert all(path.basename.endswith(".tar.bz2") for path in archives)
+    verifier = compress.Verifier(status)
+    verifier.run()
+    assert 0 == len(verifier.failed_runs)
+
+    compress.Uncompressor(status).run()
+    assert pages == {path.basename: (path.read_binary(), int(path.mtime()))
+                     for run_dir in raw_output_dir.listdir() for path in run_dir.listdir()}
+
+
+def test_compact_archives(smet_bundle, tmpdir):
+    status = setup_bundle(smet_bundle, tmpdir)
+    engine = py.PyEngine(status, py.PyEngineConfig())
+    engine.run(prune.Pruner(status, prune.PrunerConfig(status, compress=True)))
+    raw_output_dir = collect_test.race_output_folder_path(tmpdir)
+    pages = {path.basename: path.read_binary() for run_dir in raw_output_dir.listdir() for path in run_dir.listdir()}
+    compress.Archiver(status).run()
+
+    # Compact one run, then add the other to its container
+    held_back = [path for path in race_compressed_data_folder_path(tmpdir).listdir(sort=True)
+                 if path.basename.startswith(race_archives(tmpdir)[1].purebasename.split(".")[0])]
+    for path in held_back:
+        path.move(tmpdir.join(path.basename))
+    compactor = compress.Compactor(status, compress.CompactorConfig("month", 0))
+    compactor.run()
+    assert 0 == len(compactor.failed_runs)
+    container_bytes = race_archives(tmpdir)[0].read_binary()
+    for path in held_back:
+        tmpdir.join(path.basename).move(path)
+    compactor = compress.Compactor(status, compress.CompactorConfig("month", 0))
+    compactor.run()
+    assert 0 == len(compactor.failed_runs)
+    archives = race_archives(tmpdir)
+    assert 1 == len(archives)
+    # The archive was appended, without rewriting the ones already in the container
+    assert archives[0].read_binary().startswith(container_bytes)
+    assert archives[0].basename.endswith(container.container_extension)
+    assert 2 == len(container.read_index(str(archives[0])))
+
+    # The runs are found in the container
+    race = status.races()[0]
+    for run in race.runs:
+        path = status.compressed_data_file_path_for_run(race, run)
+        assert container.split_member_path(path)[0] == str(archives[0])
+        assert archive.archive_exists(path)
+        assert status.raw_reader(race, run).in_archive()
+    verifier = compress.Verifier(status)
+    verifier.run()
+    assert 2 == sum(len(runs) for runs in verifier.runs_to_verify.values())
+    assert 0 == len(verifier.failed_runs)
+
+    # Compacting again leaves the container as it is
+    compactor = compress.Compactor(status, compress.CompactorConfig("month", 0))
+    compactor.run()
+    assert 0 == len(compactor.runs_to_compact)
+
+    compress.Uncompressor(status).run()
+    assert pages == {path.basename: path.read_binary()
+                     for run_dir in raw_output_dir.listdir() for path in run_dir.listdir()}
+
+
+def test_partition_pruned_data(smet_bundle, tmpdir):
+    status = setup_bundle(smet_bundle, tmpdir)
+    engine = py.PyEngine(status, py.PyEngineConfig())
+    engine.run(prune.Pruner(status, prune.PrunerConfig(status)))
+    race = status.races()[0]
+    records = {run.results_folder: json.loads(race_pruned_data_folder_path(tmpdir).join(
+        run.results_folder + ".json").read_text("utf-8")) for run in race.runs}
+
+    partitioner = compress.Partitioner(status, compress.PartitionerConfig("day", 0))
+    partitioner.run()
+    assert 0 == len(partitioner.failed_runs)
+    pruned_dir = race_pruned_data_folder_path(tmpdir)
+    partitions = pruned_dir.listdir(lambda p: p.basename.endswith(pruned.partition_extension))
+    assert 1 == len(partitions)
+    assert pruned_dir.join(pruned.catalog_filename).exists()
+    assert 0 == len(pruned_dir.listdir(lambda p: p.basename.startswith("20") and p.basename.endswith(".json")
+                                       and not p.basename.endswith(".index.json")))
+    # Tweets found by both runs are stored once
+    lines = partitions[0].read_binary().splitlines()
+    assert len(lines) == len(set(lines))
+    assert len(lines) <= sum(len(run_records) for run_records in records.values())
+
+    for run in race.runs:
+        assert status.has_pruned_data_for_run(race, run)
+        assert records[run.results_folder] == pruned.read_pruned_run(status.pruned_data_file_path_for_run(race, run))
+
+    # Partitioning again leaves the partitions as they are
+    partitioner = compress.Partitioner(status, compress.PartitionerConfig("day", 0))
+    partitioner.run()
+    assert 0 == len(partitioner.runs_to_partition)
+
+    # The same tweets with their fields in another order are not stored again
+    run_records = list(records.values())[0]
+    writer = pruned.PartitionWriter(str(tmpdir.join("order.jsonl")))
+    writer.add_run("first", run_records)
+    writer.add_run("second", [OrderedDict(reversed(list(record.items()))) for record in run_records])
+    writer.close()
+    writer = pruned.PartitionWriter(str(tmpdir.join("order.jsonl")))
+    writer.add_run("third", [OrderedDict(reversed(list(record.items()))) for record in run_records])
+    writer.close()
+    assert len(run_records) == len(tmpdir.join("order.jsonl").read_binary().splitlines())
+
+    # jq cannot read the partitions, so its analyzers leave the runs to the python engine
+    jq_analyzer = analyze.GenericAnalyzer(status, analyze.MetadataAnalyzerConfig(status))
+    jq.JqEngine(status, jq.JqEngineConfig()).run(jq_analyzer)
+    assert 0 == len(jq_analyzer.runs_to_process)
+
+    # The analyzers read the runs from the partition
+    engine.run(analyze.GenericAnalyzer(status, analyze.MetadataAnalyzerConfig(status)))
+    check_analyzer_output(race_analyzed_data_folder_path(tmpdir))
+    engine.run(analyze.GenericAnalyzer(status, analyze.HashtagAnalyzerConfig(status)))
+    check_hashtag_analyzer_output(race_analyzed_hashtag_data_folder_path(tmpdir))
+
+
+def test_columns(smet_bundle, tmpdir):
+    numpy = pytest.importorskip("numpy")
+    status = setup_bundle(smet_bundle, tmpdir)
+    engine = py.PyEngine(status, py.PyEngineConfig())
+    engine.run(prune.Pruner(status, prune.PrunerConfig(status)))
+    compress.Columnizer(status).run()
+
+    race = status.races()[0]
+    runs = list(race.runs.order_by(status_db.Run.start))
+    records = [record for run in runs
+               for record in pruned.read_pruned_run(status.pruned_data_file_path_for_run(race, run))]
+    store = columns.ColumnStore(status.columns_folder_path_for_race(race))
+    assert len(records) == store.count
+    assert [run.results_folder for run in runs] == store.runs
+
+    fav = store.column("fav")
+    assert isinstance(fav, numpy.memmap)
+    assert [record["fav"] for record in records] == fav.tolist()
+    assert [tweets.twitter_date_to_epoch(record["date"]) for record in records] == store.column("date").tolist()
+    rt_ids = store.column("rt_id")
+    assert [record["rt_id"] if record["rt_id"] is not None else -1 for record in records] == rt_ids.tolist()
+    candidates = store.dictionary("candidate")
+    assert [record["candidate"] for record in records] == [candidates[c] for c in store.column("candidate")]
+    hashtags = store.dictionary("hashtags")
+    for i in [0, len(records) // 2, len(records) - 1]:
+        assert records[i]["hashtags"] == [hashtags[c] for c in store.hashtags(i)]
+    code = store.code("candidate", records[0]["candidate"])
+    assert sum(1 for record in records if record["candidate"] == records[0]["candidate"]) == \
+        int((store.column("candidate") == code).sum())
+
+    # Runs already in the columns are not added again
+    columnizer = compress.Columnizer(status)
+    columnizer.run()
+    assert 0 == len(columnizer.runs_to_columnize)
+    assert len(records) == columns.ColumnStore(status.columns_folder_path_for_race(race)).count
+
+
+def test_rolling_aggregates(smet_bundle, tmpdir):
+    status = setup_bundle(smet_bundle, tmpdir)
+    engine = py.PyEngine(status, py.PyEngineConfig())
+    engine.run(prune.Pruner(status))
+    engine.run(analyze.GenericAnalyzer(status, analyze.AggregatesAnalyzerConfig(status)))
+
+    race = status.races()[0]
+    distinct = {}
+    for run in race.runs:
+        assert tmpdir.join("analyzed", race.slug, "aggregates", run.results_folder + ".json").exists()
+        for record in pruned.read_pruned_run(status.pruned_data_file_path_for_run(race, run)):
+            distinct.setdefault((record["candidate"], record["id"]), record)
+
+    start, end = datetime(2000, 1, 1), datetime(2100, 1, 1)
+    with aggregates.RaceAggregates(status.aggregates_path_for_race(race)) as race_aggregates:
+        window = race_aggregates.window(start, end)
+        assert sorted(set(candidate for candidate, _ in distinct.keys())) == [row["name"] for row in window]
+        for row in window:
+            tweets = [record for (candidate, _), record in distinct.items() if candidate == row["name"]]
+            assert len(tweets) == row["tweets"]
+            assert sum(record["fav"] for record in tweets) == row["favs"]
+            assert sum(record["rtc"] for record in tweets) == row["retweets"]
+            users = len(set(record["uid"] for record in tweets))
+            assert abs(users - row["users"]) <= users * 0.05 + 1
+            hours = list(race_aggregates.hourly(start, end, row["name"]))
+            assert row["tweets"] == sum(aggregate.tweets for _, _, aggregate in hours)
+        assert [] == race_aggregates.window(datetime(2000, 1, 1), datetime(2000, 1, 8))
+
+        # Runs are only added once
+        run = race.runs[0]
+        records = pruned.read_pruned_run(status.pruned_data_file_path_for_run(race, run))
+        assert race_aggregates.add_run(run.results_folder, records) is None
+        assert window == race_aggregates.window(start, end)
+
+
+def test_top_hashtags(smet_bundle, tmpdir):
+    status = setup_bundle(smet_bundle, tmpdir)
+    engine = py.PyEngine(status, py.PyEngineConfig())
+    engine.run(prune.Pruner(status))
+    engine.run(analyze.GenericAnalyzer(status, analyze.AggregatesAnalyzerConfig(status)))
+
+    race = status.races()[0]
+    distinct = {}
+    for run in race.runs:
+        for record in pruned.read_pruned_run(status.pruned_data_file_path_for_run(race, run)):
+            distinct.setdefault((record["candidate"], record["id"]), record)
+    counts = {}
+    for (candidate, _), record in distinct.items():
+        for tag in set(hashtag.lower() for hashtag in record["hashtags"]):
+            candidate_counts = counts.setdefault(candidate, {})
+            candidate_counts[tag] = candidate_counts.get(tag, 0) + 1
+
+    with aggregates.RaceAggregates(status.aggregates_path_for_race(race)) as race_aggregates:
+        top = race_aggregates.top_hashtags(datetime(2000, 1, 1), datetime(2100, 1, 1), 5)
+    assert sorted(counts.keys()) == sorted(row["name"] for row in top)
+    for row in top:
+        exact = counts[row["name"]]
+        assert sum(exact.values()) == row["uses"]
+        assert min(5, len(exact)) == len(row["hashtags"])
+        for entry in row["hashtags"]:
+            assert entry["min_count"] <= exact[entry["tag"]] <= entry["count"]
+        expected = sorted(exact.items(), key=lambda item: (-item[1], item[0]))[:5]
+        assert [tag for tag, _ in expected] == [entry["tag"] for entry in row["hashtags"]]
+
+    # A summary smaller than the number of values only keeps the frequent ones, within the error bounds
+    stream = [i % 7 if i % 3 else 100 + i for i in range(2000)]
+    halves = [sketch.SpaceSaving(10), sketch.SpaceSaving(10)]
+    for i, value in enumerate(stream):
+        halves[i % 2].add(value)
+    summary = sketch.SpaceSaving.from_json(json.loads(json.dumps(halves[0].to_json())))
+    summary.merge(halves[1])
+    assert 10 == len(summary.top())
+    assert len(stream) == summary.total
+    assert summary.floor() <= summary.total // 10
+    for value, count, error in summary.top():
+        assert count - error <= stream.count(value) <= count
+    for value in set(stream):
+        if value not in summary.counts:
+            assert stream.count(value) <= summary.floor()
+    assert set(range(7)) <= set(value for value, _, _ in summary.top())
+
+
+def test_hashtag_cooccurrence(smet_bundle, tmpdir):
+    status = setup_bundle(smet_bundle, tmpdir)
+    engine = py.PyEngine(status, py.PyEngineConfig())
+    engine.run(prune.Pruner(status))
+    engine.run(analyze.GenericAnalyzer(status, analyze.CooccurrenceAnalyzerConfig(status)))
+
+    race = status.races()[0]
+    folder = status.analysis_result_path(race, "cooccur")
+    expected = {}
+    for run in race.runs:
+        assert tmpdir.join("analyzed", race.slug, "cooccur", run.results_folder + ".json").exists()
+        for record in pruned.read_pruned_run(status.pruned_data_file_path_for_run(race, run)):
+            tags = sorted(set(hashtag.lower() for hashtag in record["hashtags"]))
+            for i, tag in enumerate(tags):
+                for other_tag in tags[i:]:
+                    key = (record["candidate"], tag, other_tag)
+                    expected[key] = expected.get(key, 0) + 1
+    assert len(expected) > 0
+
+    matrix = cooccur.update_race_matrix(folder)
+    assert sorted(run.results_folder for run in race.runs) == sorted(matrix.runs)
+    for (candidate, tag, other_tag), count in expected.items():
+        assert count == matrix.count(candidate, tag, other_tag)
+        assert count == matrix.count(candidate, other_tag, tag)
+    assert len(expected) == sum(len(entries) for entries in matrix.candidates.values())
+    candidate, tag, other_tag = next(key for key in expected.keys() if key[1] != key[2])
+    assert (other_tag, expected[(candidate, tag, other_tag)]) in matrix.related(candidate, tag)
+
+    # The race matrix is stored in compressed sparse row form and merging again does not count runs twice
+    with tmpdir.join("analyzed", race.slug, "cooccur", cooccur.race_matrix_filename).open() as f:
+        stored = json.load(f)
+    for entry in stored["candidates"]:
+        assert len(stored["tags"]) + 1 == len(entry["indptr"])
+        assert len(entry["columns"]) == entry["indptr"][-1] == len(entry["counts"])
+    again = cooccur.update_race_matrix(folder)
+    assert matrix.to_csr() == again.to_csr()
+
+
+def test_framed_archives(smet_bundle, tmpdir):
+    status = setup_bundle(smet_bundle, tmpdir)
+    engine = py.PyEngine(status, py.PyEngineConfig())
+    engine.run(prune.Pruner(status, prune.PrunerConfig(status)))
+    config = compress.CompressorConfig(codec="frames", workers=2)
+    compress.Compressor(status, config).run()
+    assert 2 == len(race_archives(tmpdir))
+
+    raw_output_dir = collect_test.race_output_folder_path(tmpdir)
+    run_dir = raw_output_dir.listdir(sort=True)[0]
+    archive_path = str(race_compressed_data_folder_path(tmpdir).join(run_dir.basename + ".frames"))
+    with archive.FramedRunReader(archive_path) as reader:
+        assert sorted(path.basename for path in run_dir.listdir()) == sorted(reader.filenames())
+        for path in run_dir.listdir():
+            assert path.read_binary() == reader.read_page(path.basename)
+        terms = reader.terms()
+        assert 0 < len(terms)
+        term_pages = list(reader.pages_for_term(terms[0]))
+        assert 0 < len(term_pages)
+        assert all(archive.page_term(contents) == terms[0] for filename, contents in term_pages)
+    assert [] == archive.verify_archive(archive_path)
+
+    pages = {path.basename: path.read_binary() for run_dir in raw_output_dir.listdir() for path in run_dir.listdir()}
+    compress.Archiver(status, config).run()
+    assert 0 == len(raw_output_dir.listdir())
+    compress.Uncompressor(status, config).run()
+    assert pages == {path.basename: path.read_binary()
+                     for run_dir in raw_output_dir.listdir() for path in run_dir.listdir()}
+
+
+def test_dedup_archives(smet_bundle, tmpdir):
+    status = setup_bundle(smet_bundle, tmpdir)
+    engine = py.PyEngine(status, py.PyEngineConfig())
+    engine.run(prune.Pruner(status, prune.PrunerConfig(status)))
+    config = compress.CompressorConfig(codec="dedup")
+    compress.Compressor(status, config).run()
+    compressed_output_dir = race_compressed_data_folder_path(tmpdir)
+    assert compressed_output_dir.join(dedup.store_filename).exists()
+    assert 2 == len(compressed_output_dir.listdir(lambda p: p.ext == ".dedup"))
+
+    # Each tweet is stored once, even though the runs and search terms overlap
+    raw_output_dir = collect_test.race_output_folder_path(tmpdir)
+    store = dedup.DedupStore(str(compressed_output_dir.join(dedup.store_filename)))
+    tweet_count = store.connection.execute("SELECT COUNT(*) FROM objects WHERE kind = 'tweet'").fetchone()[0]
+    store.close()
+    page_tweet_count = sum(len(json.loads(path.read_binary().decode("utf-8"))["statuses"])
+                           for run_dir in raw_output_dir.listdir() for path in run_dir.listdir())
+    assert 0 < tweet_count <= page_tweet_count
+
+    # The pages are reconstructed exactly
+    pages = {path.basename: path.read_binary() for run_dir in raw_output_dir.listdir() for path in run_dir.listdir()}
+    compress.Archiver(status, config).run()
+    assert 0 == len(raw_output_dir.listdir())
+    verifier = compress.Verifier(status)
+    verifier.run()
+    assert 0 == len(verifier.failed_runs)
+
+    # jq cannot read dedup archives, so it reports that instead of writing empty pruned data
+    pruned_folder = race_pruned_data_folder_path(tmpdir)
+    pruned_copy = tmpdir.join("pruned_copy")
+    pruned_folder.copy(pruned_copy)
+    for path in pruned_folder.listdir():
+        path.remove()
+    jq.JqEngine(status, jq.JqEngineConfig()).run(prune.Pruner(status))
+    assert 0 == len(pruned_folder.listdir())
+    logs = [path.read() for path in tmpdir.join("log").visit(fil=lambda p: p.check(file=1))]
+    assert 2 == sum(log.count("with jq. Use the python engine.") for log in logs)
+    pruned_copy.copy(pruned_folder)
+
+    compress.Uncompressor(status, config).run()
+    assert pages == {path.basename: path.read_binary()
+                     for run_dir in raw_output_dir.listdir() for path in run_dir.listdir()}
+
+
+def test_dictionary_compression(smet_bundle, tmpdir):
+    if "zlib" not in dictionary.dictionary_kinds():
+        pytest.skip("zlib dictionaries require python 3")
+    status = setup_bundle(smet_bundle, tmpdir)
+    trainer = compress.DictionaryTrainer(status)
+    trainer.run()
+    assert 1 == len(trainer.trained)
+    race = status.races()[0]
+    trained = trainer.trained[race]
+    assert 1 == trained.version
+    assert tmpdir.join("dictionaries", "chicago-mayor-runoff-2015", "1.dict").exists()
+
+    # Pages written by the collector with the dictionary are read back transparently
+    raw_output_dir = collect_test.race_output_folder_path(tmpdir)
+    run_dir = raw_output_dir.listdir(sort=True)[0]
+    page = run_dir.listdir(sort=True)[0]
+    results = json.loads(page.read_binary().decode("utf-8"))
+    new_run_dir = raw_output_dir.join("dictionary_run")
+    new_run_dir.ensure(dir=True)
+    now = results_filename_to_datetime(page.basename)
+    filename = collect.dictionary_results_save_func(now, results, str(new_run_dir))
+    assert filename.endswith(".zd")
+    assert new_run_dir.join(filename).size() < page.size()
+    assert [(page.basename, page.read_binary())] == list(raw.RawReader(str(new_run_dir)).pages())
+    new_run_dir.remove()
+
+    # Archives compressed with the dictionary
+    engine = py.PyEngine(status, py.PyEngineConfig())
+    engine.run(prune.Pruner(status, prune.PrunerConfig(status)))
+    config = compress.CompressorConfig(codec="zdict")
+    compress.Compressor(status, config).run()
+    assert 2 == len(race_archives(tmpdir))
+    archive_path = str(race_compressed_data_folder_path(tmpdir).join(run_dir.basename + ".zframes"))
+    with archive.FramedRunReader(archive_path) as reader:
+        for path in run_dir.listdir():
+            assert path.read_binary() == reader.read_page(path.basename)
+
+    results = dictionary.benchmark(list(raw.RawReader(str(run_dir)).pages()), [trained])
+    ratios = dict((result["method"], result["ratio"]) for result in results)
+    assert ratios["zlib dictionary v1 per page"] > ratios["zlib per page"]
+
+
+def test_block_compressed_file_is_multistream(tmpdir):
+    class SmallBlockBz2Codec(archive.Bz2Codec):
+        block_size = 1000
+
+    data = b"".join(str(i).encode("ascii") for i in range(5000))
+    path = tmpdir.join("blocks.bz2")
+    pool = ThreadPool(2)
+    block_file = archive.BlockCompressedFile(open(str(path), "wb"), SmallBlockBz2Codec, pool=pool, max_pending=2)
+    for i in range(0, len(data), 300):
+        block_file.write(data[i:i + 300])
+    block_file.close()
+    pool.close()
+    pool.join()
+    assert path.read_binary().count(b"BZh9") > 1
+    if not six.PY2:
+        assert data == bz2.BZ2File(str(path)).read()
+    # Also with the reader for python 2, whose BZ2File stops after the first stream
+    for chunk_size in [100, archive.MultiStreamBz2Reader.chunk_size]:
+        with open(str(path), "rb") as f:
+            reader = archive.MultiStreamBz2Reader(f)
+            reader.chunk_size = chunk_size
+            assert data[:10] == reader.read(10)
+            assert data[10:] == reader.read()
+        with open(str(path), "rb") as f:
+            assert data == archive.Bz2Codec.open_reader(f).read()
+
+
 def test_write_candidate_status(smet_bundle, tmpdir):
     status = collect_test.initialized_bundle_status(smet_bundle, tmpdir)
     config_to_json = analyze.CandidateConfigToJson(status)
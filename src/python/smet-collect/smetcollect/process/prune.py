@@ -13,15 +13,35 @@ Copyright (c) 2015 Chandrasekhar Ramakrishnan. All rights reserved.
 import os
 
 from . import command
-from ..bundle import slug_for_race
+from ..bundle import slug_for_race, archive, pruned
 
 
 class PrunerConfig(command.ProcessCommandConfig):
     """Gathers configuration information for the Pruner"""
 
-    def __init__(self, status, max_depth=5, just_config=False):
-        super(PrunerConfig, self).__init__("PruneTweets", "prune.rb", "Pruning", max_depth, just_config)
+    def __init__(self, status, max_depth=5, just_config=False, compress=False, compress_pruned=False,
+                 lines_pruned=False):
+        """
+        :param compress: Also compress the raw data while pruning it. Only supported by the python engine.
+        :param compress_pruned: Write the pruned data gzipped, as <run>.json.gz
+        :param lines_pruned: Write the pruned data as json lines, <run>.jsonl, with an index
+        """
+        if compress_pruned and lines_pruned:
+            raise ValueError("Pruned data can be written gzipped or as json lines, not both")
+        super(PrunerConfig, self).__init__("PruneTweets", "prune.rb", "Pruning", max_depth, just_config,
+                                           "prune_run")
         self.output_path_components = lambda race, run=None: status.pruned_data_file_path_components(race, run)
+        self.compress = compress
+        self.compress_pruned = compress_pruned
+        self.lines_pruned = lines_pruned
+
+    def pruned_extension(self):
+        """The extension of the pruned files written with this configuration."""
+        if self.lines_pruned:
+            return pruned.lines_extension
+        if self.compress_pruned:
+            return pruned.gzip_extension
+        return pruned.json_extension
 
 
 class Pruner(command.ProcessCommand):
@@ -42,10 +62,40 @@ class Pruner(command.ProcessCommand):
         raw_data_path = self.status.raw_data_folder_path_for_run(race, run)
         msg = "{} run: {}".format(self.process_description(), raw_data_path.encode('utf-8'))
         self.status.progress_func({'type': 'prune', 'message': msg})
-        self.add_spark_task(raw_data_path, pruned_data_path_components, slug_for_race(race))
+        extras = self.raw_extras(race, run)
+        extras.update(self.pruned_extras())
+        self.add_spark_task(raw_data_path, pruned_data_path_components, slug_for_race(race), **extras)
+
+    def raw_extras(self, race, run):
+        """The task parameters for reading and writing the archive of the run.
+
+        If the raw folder has been archived, rawarchive tells the task to read the pages from the archive instead.
+        Otherwise, the archive may be written while pruning (see archive_extras).
+        """
+        reader = self.status.raw_reader(race, run)
+        if reader.in_archive():
+            return {"rawarchive": reader.archive_path}
+        return self.archive_extras(race, run)
+
+    def pruned_extras(self):
+        """The task parameters for writing the pruned data."""
+        if self.config.lines_pruned:
+            return {"linespruned": True}
+        if self.config.compress_pruned:
+            return {"compresspruned": True}
+        return {}
+
+    def archive_extras(self, race, run):
+        """The task parameters for writing the archive of the run while pruning, if that is wanted."""
+        if not self.config.compress:
+            return {}
+        compressed_data_path = self.status.compressed_data_file_path_for_run(race, run)
+        if archive.archive_exists(compressed_data_path):
+            return {}
+        return {"archivepath": compressed_data_path}
 
     def should_process_run(self, race, run):
         """Prune the runs in the race down to the most relevant data
         """
-        return not self.status.has_pruned_data_for_run(race, run)
+        return not self.status.has_pruned_data_for_run(race, run) and self.status.raw_reader(race, run).exists()
 
@@ -0,0 +1,11 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+__init__.py
+
+Package for python-based processing. The drivers are imported when a command first uses one (command.py), so the
+other engines do not load them.
+"""
+
+from .py import (PyEngineConfig, PyEngine)
@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+drivers.py
+
+The functions the python engine runs for each task. A driver takes a task definition and the map from encoded search
+terms to candidate names. Drivers may run in a separate process, so they must not touch the status db.
+"""
+
+import gzip
+import io
+import json
+import os
+from collections import OrderedDict
+
+import six
+
+from . import tweets
+from . import vectorized
+from ...bundle.aggregates import RaceAggregates, aggregates_filename
+from ...bundle.archive import archive_writer, remove_archive
+from ...bundle.bundle import ensure_folder_exists
+from ...bundle.cooccur import CooccurrenceMatrix
+from ...bundle.sketch import write_run_sketches, sketches_analysis_type
+from ...bundle.pruned import has_pruned_run, read_pruned_run, write_lines, json_extension, gzip_extension, \
+    lines_extension
+from ...bundle.raw import RawReader
+
+
+def write_json(obj, path, newline=True):
+    """Write obj as compact json, the way jq -c does. The json is gzipped if the path ends with .gz."""
+    json_str = six.text_type(json.dumps(obj, ensure_ascii=False, separators=(',', ':')))
+    if newline:
+        json_str += u"\n"
+    if path.endswith(".gz"):
+        with gzip.open(path, "wb") as f:
+            f.write(json_str.encode("utf-8"))
+        return
+    with io.open(path, "w", encoding="utf-8") as f:
+        f.write(json_str)
+
+
+def write_pruned(pruned, task):
+    """Write the pruned tweets as a json array, gzipped if the task has compresspruned set, or as indexed json lines
+    if the task has linespruned set."""
+    if task.extras.get("linespruned"):
+        write_lines(os.path.join(task.out_folder, task.out_name + lines_extension), pruned)
+        return
+    extension = gzip_extension if task.extras.get("compresspruned") else json_extension
+    write_json(pruned, os.path.join(task.out_folder, task.out_name + extension))
+
+
+def raw_reader_for_task(task):
+    """The reader for the raw data of the task: the raw folder, or the rawarchive if the folder was archived."""
+    return RawReader(task.in_path, task.extras.get("rawarchive"))
+
+
+def prune_pages(pages, namemap):
+    """Prune (filename, contents) pages to the tweets as they are stored in the pruned file."""
+    records = []
+    for filename, contents in pages:
+        records.extend(tweets.prune_page(json.loads(contents.decode("utf-8"))))
+    return tweets.compress_pruned(records, namemap)
+
+
+def tee_to_archive(entries, writer):
+    """Add each page to the archive as it passes through."""
+    for filename, contents, mtime in entries:
+        writer.add_page(filename, contents, mtime)
+        yield filename, contents
+
+
+def prune_raw_run(task, namemap):
+    """Prune the pages of the run of the task.
+
+    If the task has an archivepath, the pages are also written to an archive as they are read, so the raw data is
+    read only once for both pruning and compression.
+    """
+    reader = raw_reader_for_task(task)
+    archive_path = task.extras.get("archivepath")
+    if archive_path is None:
+        return prune_pages(reader.pages(), namemap)
+
+    ensure_folder_exists(os.path.dirname(archive_path))
+    writer = archive_writer(archive_path, run_name_for_path(task.in_path))
+    try:
+        pruned = prune_pages(tee_to_archive(reader.entries(), writer), namemap)
+    except Exception:
+        writer.abort()
+        raise
+    writer.close()
+    problems = writer.verify()
+    if problems:
+        remove_archive(archive_path)
+        raise IOError("Archive {} is corrupt: {}".format(archive_path, "; ".join(problems)))
+    return pruned
+
+
+def run_name_for_path(path):
+    """The run name is the last component of the raw folder or pruned file path (without extension)."""
+    return os.path.basename(path)
+
+
+def prune_run(task, namemap):
+    """Prune the raw data of one run. Equivalent to prune.rb."""
+    pruned = prune_raw_run(task, namemap)
+    ensure_folder_exists(task.out_folder)
+    write_pruned(pruned, task)
+
+
+def write_metadata_summary(summary, records, run_name, out_folder, out_name):
+    """Write the metadata summary of a run, and the sketches of its distinct users and retweets into the sketches
+    folder next to the metadata folder."""
+    write_json(summary, os.path.join(out_folder, out_name))
+    sketches_folder = os.path.join(os.path.dirname(os.path.normpath(out_folder)), sketches_analysis_type)
+    ensure_folder_exists(sketches_folder)
+    write_run_sketches(os.path.join(sketches_folder, out_name), run_name, tweets.distinct_sketches(records))
+
+
+def summarize_run(task, namemap):
+    """Summarize the metadata of one pruned run. Equivalent to mdsummary.rb."""
+    records = read_pruned_run(task.in_path)
+    run_name = run_name_for_path(task.in_path)
+    write_metadata_summary(tweets.metadata_summary(records, run_name), records, run_name, task.out_folder,
+                           task.out_name)
+
+
+def vectorized_summarize_run(task, namemap):
+    """Summarize the metadata of one pruned run with numpy. Writes the same summary as summarize_run."""
+    records = read_pruned_run(task.in_path)
+    run_name = run_name_for_path(task.in_path)
+    write_metadata_summary(vectorized.metadata_summary(records, run_name), records, run_name, task.out_folder,
+                           task.out_name)
+
+
+def hashtags_run(task, namemap):
+    """Summarize the hashtags of one pruned run. Equivalent to hashtags.rb."""
+    if not has_pruned_run(task.in_path):
+        return
+    records = read_pruned_run(task.in_path)
+    counts = tweets.hashtag_counts(records, run_name_for_path(task.in_path))
+    write_json(counts, os.path.join(task.out_folder, task.out_name), newline=False)
+
+
+def aggregate_run(task, namemap):
+    """Add the tweets of one pruned run to the rolling aggregates of its race.
+
+    The output of the task is a summary of the tweets that the run added to the aggregates.
+    """
+    if not has_pruned_run(task.in_path):
+        return
+    ensure_folder_exists(task.out_folder)
+    with RaceAggregates(os.path.join(task.out_folder, aggregates_filename)) as aggregates:
+        added = aggregates.add_run(run_name_for_path(task.in_path), read_pruned_run(task.in_path))
+    summary = []
+    for candidate, aggregate in sorted((added or {}).items(), key=lambda item: tweets.jq_sort_key(item[0])):
+        candidate_summary = OrderedDict([("name", candidate)])
+        candidate_summary.update(aggregate.summary())
+        summary.append(candidate_summary)
+    write_json(summary, os.path.join(task.out_folder, task.out_name))
+
+
+def cooccur_run(task, namemap):
+    """Count the pairs of hashtags used together in the tweets of one pruned run, by candidate."""
+    run_name = run_name_for_path(task.in_path)
+    matrix = CooccurrenceMatrix(runs=[run_name])
+    for record in read_pruned_run(task.in_path):
+        matrix.add_tweet(record.get("candidate"), record.get("hashtags") or [])
+    write_json(matrix.to_coordinates(), os.path.join(task.out_folder, task.out_name))
+
+
+def fused_run(task, namemap):
+    """Prune one run and summarize its metadata and hashtags while reading the raw data only once."""
+    run_name = run_name_for_path(task.in_path)
+    pruned = prune_raw_run(task, namemap)
+    ensure_folder_exists(task.out_folder)
+    write_pruned(pruned, task)
+
+    extras = task.extras
+    ensure_folder_exists(extras["mdoutfolder"])
+    write_metadata_summary(tweets.metadata_summary(pruned, run_name), pruned, run_name, extras["mdoutfolder"],
+                           extras["mdoutname"])
+    ensure_folder_exists(extras["htoutfolder"])
+    write_json(tweets.hashtag_counts(pruned, run_name),
+               os.path.join(extras["htoutfolder"], extras["htoutname"]), newline=False)
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+py.py
+
+An engine that runs processing commands in python, without shelling out to ruby and jq.
+"""
+
+import multiprocessing
+import traceback
+from datetime import datetime
+
+from ..task_config import candidates_map
+
+
+def log_task_execution(log_file, task):
+    now_str = datetime.utcnow().strftime("%H:%M:%S")
+    log_file.write("\n{} ==== Processing {} -> {}\n".format(now_str, task.in_path, task.out_folder))
+    log_file.flush()
+
+
+def run_driver(args):
+    """Run a driver on a task. Returns None on success, or the traceback as a string on failure."""
+    driver, task, namemap = args
+    try:
+        driver(task, namemap)
+        return None
+    except Exception:
+        return traceback.format_exc()
+
+
+class PyEngineConfig(object):
+    """Configuration parameters for the python engine"""
+
+    def __init__(self, processes=1):
+        """
+        :param processes: The number of worker processes to use. Tasks are run in this process if 1 or less.
+        """
+        self.processes = processes
+
+
+class PyEngine(object):
+    """Engine that executes commands in python"""
+
+    def __init__(self, status, config=None):
+        """
+        Initialize the PyEngine.
+        :param status: The CollectorStatus object that tracks status state
+        :param config: The configuration for the engine
+        :return:
+        """
+        self.status = status
+        self.config = config if config else PyEngineConfig()
+        self.cmd = None
+        self.log_file_path = None
+        self.failed_tasks = []
+
+    @staticmethod
+    def prerequisites_satisfied():
+        """The python engine has no external prerequisites.
+
+        :return True
+        """
+        return True
+
+    def start_run(self):
+        self.log_file_path = self.status.generate_running_log_file_path("py")
+        self.failed_tasks = []
+
+    def stop_run(self):
+        if self.failed_tasks:
+            self.status.move_log_to_fail(self.log_file_path)
+        else:
+            self.status.move_log_to_success(self.log_file_path)
+
+    def task_args(self):
+        driver = self.cmd.config.py_driver
+        namemap = candidates_map(self.status)
+        return [(driver, task, namemap) for task in self.cmd.tasks]
+
+    def map_tasks(self, args):
+        processes = self.config.processes
+        if processes is None or processes <= 1 or len(args) <= 1:
+            return [run_driver(arg) for arg in args]
+        pool = multiprocessing.Pool(min(processes, len(args)))
+        try:
+            return pool.map(run_driver, args)
+        finally:
+            pool.close()
+            pool.join()
+
+    def process_tasks(self):
+        """Run the driver of the command on all the queued tasks"""
+        args = self.task_args()
+        results = self.map_tasks(args)
+        with open(self.log_file_path, "w+") as log_file:
+            for (driver, task, namemap), error in zip(args, results):
+                log_task_execution(log_file, task)
+                if error is None:
+                    continue
+                log_file.write(error)
+                self.failed_tasks.append(task)
+                msg = "{} failed for {}".format(self.cmd.process_description(), task.in_path)
+                self.status.progress_func({'type': 'error', 'message': msg})
+
+    def do_processing(self):
+        """Really process the races"""
+        self.cmd.queue_tasks()
+        if self.cmd.config.just_config:
+            self.cmd.generate_task_config(self.cmd.config.py_driver_name)
+            return
+
+        self.start_run()
+        self.process_tasks()
+        self.stop_run()
+        self.cmd.finish_processing()
+
+    def run(self, cmd):
+        """Run the command for matching races"""
+        self.cmd = cmd
+        self.cmd.collect_runs_to_process()
+        self.cmd.log_intermediate_progress_update()
+        self.status.ensure_folder_exists(self.status.tmp_folder_path())
+        self.do_processing()
+        msg = '{} finished'.format(self.cmd.process_description())
+        self.status.progress_func({'type': 'progress', 'message': msg})
+
+    def run_without_collect(self, cmd):
+        """Run the engine on the command, but do not collect runs to process"""
+        self.cmd = cmd
+        self.status.ensure_folder_exists(self.status.tmp_folder_path())
+        self.do_processing()
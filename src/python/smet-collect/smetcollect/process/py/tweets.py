@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+tweets.py
+
+Python implementations of the transformations performed by the jq filters in src/jq.
+
+The functions here produce the same structures as the jq filters and ruby scripts so that the outputs of the
+python engine can be used interchangeably with those of the jq engine.
+"""
+
+from collections import OrderedDict, defaultdict
+
+from ...bundle.bundle import twitter_date_to_epoch
+from ...bundle.sketch import HyperLogLog
+
+# The fields of a pruned tweet, in the order they are written by twitter_prune.jq
+pruned_fields = ["q", "id", "text", "date", "fav", "rtc", "u", "uid", "ufol", "hashtags",
+                 "rt_id", "rt_text", "rt_date", "rt_fav", "rt_rtc", "rt_u", "rt_uid", "rt_ufol"]
+
+
+def lookup(obj, *keys):
+    """Follow the keys into the nested dictionary obj, returning None if any step is missing (like jq's .a.b)"""
+    for key in keys:
+        if obj is None:
+            return None
+        obj = obj.get(key)
+    return obj
+
+
+def jq_sort_key(value):
+    """A sort key that orders None before all other values, as jq does."""
+    return (value is not None, value)
+
+
+def prune_status(query, status):
+    """Prune a status down to the fields used in analysis. Equivalent to twitter_prune.jq for one status."""
+    hashtags = lookup(status, "entities", "hashtags") or []
+    rt = status.get("retweeted_status")
+    return OrderedDict([
+        ("q", query),
+        ("id", status.get("id")),
+        ("text", status.get("text")),
+        ("date", status.get("created_at")),
+        ("fav", status.get("favorite_count")),
+        ("rtc", status.get("retweet_count")),
+        ("u", lookup(status, "user", "screen_name")),
+        ("uid", lookup(status, "user", "id")),
+        ("ufol", lookup(status, "user", "followers_count")),
+        ("hashtags", [tag.get("text") for tag in hashtags]),
+        ("rt_id", lookup(rt, "id")),
+        ("rt_text", lookup(rt, "text")),
+        ("rt_date", lookup(rt, "created_at")),
+        ("rt_fav", lookup(rt, "favorite_count")),
+        ("rt_rtc", lookup(rt, "retweet_count")),
+        ("rt_u", lookup(rt, "user", "screen_name")),
+        ("rt_uid", lookup(rt, "user", "id")),
+        ("rt_ufol", lookup(rt, "user", "followers_count"))])
+
+
+def prune_page(page):
+    """Prune one page of search results. Equivalent to twitter_prune.jq."""
+    query = lookup(page, "search_metadata", "query")
+    return [prune_status(query, status) for status in page.get("statuses", [])]
+
+
+def compress_pruned(records, namemap):
+    """Assign candidates and merge tweets that appear in multiple searches. Equivalent to prune_compress.jq.
+
+    :param records: The pruned tweets from all pages of a run, in file order
+    :param namemap: A dictionary mapping encoded search terms to candidate names
+    :return: The tweets, grouped by candidate and ordered by id, with the queries that found them in qs.
+    """
+    by_candidate = defaultdict(OrderedDict)
+    for record in records:
+        candidate = namemap.get(record["q"])
+        by_candidate[candidate].setdefault(record["id"], []).append(record)
+
+    result = []
+    for candidate in sorted(by_candidate.keys(), key=jq_sort_key):
+        tweets = by_candidate[candidate]
+        for tweet_id in sorted(tweets.keys(), key=jq_sort_key):
+            group = tweets[tweet_id]
+            tweet = OrderedDict((k, v) for k, v in group[0].items() if k != "q")
+            tweet["candidate"] = candidate
+            tweet["qs"] = [record["q"] for record in group]
+            result.append(tweet)
+    return result
+
+
+def group_by_candidate(records):
+    """Return a list of (candidate, records) pairs ordered as jq's group_by(.candidate) would order them."""
+    groups = defaultdict(list)
+    for record in records:
+        groups[record.get("candidate")].append(record)
+    return [(candidate, groups[candidate]) for candidate in sorted(groups.keys(), key=jq_sort_key)]
+
+
+def distinct_sketches(records):
+    """Return a list of (candidate, {"users": HyperLogLog, "retweets": HyperLogLog}) pairs with sketches of the users
+    and the retweeted tweets of each candidate. Unlike rt_idcount, tweets that are not retweets are not counted."""
+    result = []
+    for candidate, group in group_by_candidate(records):
+        users = HyperLogLog()
+        users.update(record["uid"] for record in group if record.get("uid") is not None)
+        retweets = HyperLogLog()
+        retweets.update(record["rt_id"] for record in group if record.get("rt_id") is not None)
+        result.append((candidate, {"users": users, "retweets": retweets}))
+    return result
+
+
+def metadata_summary(records, runname):
+    """Summarize the metadata of the pruned tweets of a run. Equivalent to twitter_summary.jq."""
+    result = []
+    tweetcount = len(records)
+    for candidate, group in group_by_candidate(records):
+        rt_rtcs = [record.get("rt_rtc") for record in group if record.get("rt_rtc") is not None]
+        # min_by keeps the first minimum, max_by the last maximum
+        earliest = latest = None
+        for record in group:
+            utime = twitter_date_to_epoch(record["date"])
+            if earliest is None or utime < earliest[0]:
+                earliest = (utime, record["date"])
+            if latest is None or utime >= latest[0]:
+                latest = (utime, record["date"])
+        summary = OrderedDict([
+            ("tweetcount", tweetcount),
+            ("runname", runname),
+            ("name", candidate),
+            ("idcount", len(group)),
+            ("user_idcount", len(set(record.get("uid") for record in group))),
+            ("rt_idcount", len(set(record.get("rt_id") for record in group))),
+            ("rt_rtcount", max(rt_rtcs) if rt_rtcs else None),
+            ("min_datetime", earliest[1]),
+            ("max_datetime", latest[1])])
+        result.append(summary)
+    return result
+
+
+def hashtag_counts(records, runname):
+    """Summarize the hashtags of the pruned tweets of a run. Equivalent to twitter_hashtags.jq + hashtags.rb."""
+    keys = ["rtc", "rt_rtc", "fav", "rt_fav"]
+    candidates = OrderedDict()
+    for record in records:
+        if len(record.get("hashtags") or []) < 1:
+            continue
+        counts = candidates.setdefault(record.get("candidate"), OrderedDict())
+        for hashtag in record["hashtags"]:
+            tag = hashtag.lower()
+            if tag not in counts:
+                counts[tag] = OrderedDict([("tag", tag)] + [(key, 0) for key in keys])
+            for key in keys:
+                if record.get(key) is not None:
+                    counts[tag][key] += record[key]
+
+    result = []
+    for candidate, counts in candidates.items():
+        ordered = sorted(counts.values(), key=lambda c: -c["rt_fav"])
+        tag_counts = [c for c in ordered if all(c[key] > 0 for key in keys)]
+        result.append(OrderedDict([("name", candidate), ("runname", runname), ("counts", tag_counts)]))
+    return result
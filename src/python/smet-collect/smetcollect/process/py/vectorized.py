@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+vectorized.py
+
+numpy implementations of the summaries in tweets.py, for runs with many tweets.
+
+The fields of the tweets are converted to integer arrays once, and the summaries are computed with array operations
+instead of sorting and parsing each tweet. The results are the same as those of tweets.py, and so of the jq filters.
+
+Requires numpy.
+"""
+
+from collections import OrderedDict
+
+from .tweets import jq_sort_key, twitter_date_to_epoch
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Stands for a missing value in the integer arrays. Ids and counts are never negative.
+missing = -1
+
+month_numbers = {"Jan": "01", "Feb": "02", "Mar": "03", "Apr": "04", "May": "05", "Jun": "06",
+                 "Jul": "07", "Aug": "08", "Sep": "09", "Oct": "10", "Nov": "11", "Dec": "12"}
+
+
+def int_array(records, field):
+    """The field of the records as an array of int64, with missing for None."""
+    return numpy.fromiter((missing if record.get(field) is None else record[field] for record in records),
+                          numpy.int64, len(records))
+
+
+def epoch_dates(dates):
+    """Convert dates of the form 'Wed Aug 05 18:48:36 +0000 2015' to an array of seconds since the epoch.
+
+    Twitter returns dates in UTC, which are rearranged into ISO dates and converted by numpy all at once. Dates in
+    other time zones are converted one at a time.
+    """
+    if all(date[20:25] == "+0000" for date in dates):
+        iso_dates = [date[26:30] + "-" + month_numbers[date[4:7]] + "-" + date[8:10] + "T" + date[11:19]
+                     for date in dates]
+        return numpy.array(iso_dates, dtype="datetime64[s]").astype(numpy.int64)
+    return numpy.array([twitter_date_to_epoch(date) for date in dates], dtype=numpy.int64)
+
+
+def metadata_summary(records, runname):
+    """Summarize the metadata of the pruned tweets of a run. Equivalent to tweets.metadata_summary."""
+    if numpy is None:
+        raise ImportError("The vectorized summary requires numpy")
+    result = []
+    if len(records) < 1:
+        return result
+    candidate_codes = OrderedDict()
+    codes = numpy.fromiter((candidate_codes.setdefault(record.get("candidate"), len(candidate_codes))
+                            for record in records), numpy.int32, len(records))
+    uids = int_array(records, "uid")
+    rt_ids = int_array(records, "rt_id")
+    rt_rtcs = int_array(records, "rt_rtc")
+    dates = epoch_dates([record["date"] for record in records])
+
+    for candidate in sorted(candidate_codes.keys(), key=jq_sort_key):
+        rows = numpy.flatnonzero(codes == candidate_codes[candidate])
+        group_dates = dates[rows]
+        # min_by keeps the first minimum, max_by the last maximum
+        earliest = rows[numpy.argmin(group_dates)]
+        latest = rows[len(rows) - 1 - numpy.argmax(group_dates[::-1])]
+        group_rt_rtcs = rt_rtcs[rows]
+        group_rt_rtcs = group_rt_rtcs[group_rt_rtcs != missing]
+        summary = OrderedDict([
+            ("tweetcount", len(records)),
+            ("runname", runname),
+            ("name", candidate),
+            ("idcount", len(rows)),
+            # A missing uid or rt_id counts as one distinct value, as null does in jq's unique_by
+            ("user_idcount", int(numpy.unique(uids[rows]).size)),
+            ("rt_idcount", int(numpy.unique(rt_ids[rows]).size)),
+            ("rt_rtcount", int(group_rt_rtcs.max()) if group_rt_rtcs.size > 0 else None),
+            ("min_datetime", records[earliest]["date"]),
+            ("max_datetime", records[latest]["date"])])
+        result.append(summary)
+    return result
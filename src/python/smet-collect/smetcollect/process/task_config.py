@@ -9,19 +9,19 @@ Module for producing configuration files for analysis tasks.
 Created by Chandrasekhar Ramakrishnan on 2016-04-20.
 Copyright (c) 2016 Chandrasekhar Ramakrishnan. All rights reserved.
 """
+import itertools
 import json
 import os
 from datetime import datetime
-import six
 
-if six.PY2:
-    from urllib import quote as urllibquote
-else:
-    from urllib.parse import quote as urllibquote
+# Numbers the task configurations written by this process, so configurations created at the same time get their
+# own files (see collect/pipeline.py)
+config_counter = itertools.count()
 
 
-def urlquote(string):
-    return urllibquote(string).replace("%20", " ")
+def candidates_map(status):
+    """Return a dictionary mapping encoded search terms to candidate names for all races."""
+    return dict(status.snapshot().candidates_map)
 
 
 class AnalysisTaskConfigToJson(object):
@@ -34,10 +34,10 @@ class AnalysisTaskConfigToJson(object):
         self.status = status
         self.task_slug = slug
         self.taskdefs = taskdefs
+        self.timestamp = "{}-{}".format(datetime.now().strftime("%Y-%m-%d-%H-%M-%S"), next(config_counter))
 
     def default_path(self):
-        timestamp = datetime.now().strftime("%Y-%m-%d-%H-%M-%S")
-        return os.path.join(self.status.tmp_folder_path(), "{}-{}.json".format(self.task_slug, timestamp))
+        return os.path.join(self.status.tmp_folder_path(), "{}-{}.json".format(self.task_slug, self.timestamp))
 
     def save(self, path=None):
         """Write out JSON describing the candidate config to path"""
@@ -45,17 +45,14 @@ class AnalysisTaskConfigToJson(object):
         if not path:
             path = self.default_path()
         races = []
-        for race in self.status.races():
-            race_dict = {"slug": race.slug, "candidates": []}
-            races.append(race_dict)
-            for candidate in race.candidates.all():
-                terms = [urlquote(term.term) for term in candidate.search_terms.all()]
-                candidate_dict = {"name": candidate.name, "terms": terms}
-                race_dict["candidates"].append(candidate_dict)
+        for race in self.status.snapshot().races:
+            candidates = [{"name": candidate.name, "terms": candidate.quoted_terms} for candidate in race.candidates]
+            races.append({"slug": race.slug, "candidates": candidates})
         tasks = []
         for task in self.taskdefs:
             task_dict = {"raceslug": task.race_slug, "inpath": task.in_path, "outfolder": task.out_folder,
                          "outname": task.out_name}
+            task_dict.update(task.extras)
             tasks.append(task_dict)
 
         with open(path, "w") as f:
@@ -65,8 +62,12 @@ class AnalysisTaskConfigToJson(object):
 class AnalysisTaskDef(object):
     """Definition of an analysis task"""
 
-    def __init__(self, in_path, out_folder, out_name, race_slug):
+    def __init__(self, in_path, out_folder, out_name, race_slug, extras=None):
+        """
+        :param extras: A dictionary of additional, command-specific, parameters for the task
+        """
         self.in_path = in_path
         self.out_folder = out_folder
         self.out_name = out_name
         self.race_slug = race_slug
+        self.extras = extras if extras is not None else {}
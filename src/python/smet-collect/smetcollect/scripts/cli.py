@@ -9,7 +9,10 @@ Created by Chandrasekhar Ramakrishnan on 2017-02-08.
 Copyright (c) 2017 Chandrasekhar Ramakrishnan. All rights reserved.
 """
 
-from datetime import datetime
+import json
+import os
+from collections import OrderedDict
+from datetime import datetime, timedelta
 
 import click
 import smetcollect
@@ -72,9 +75,14 @@ def cli(ctx, quiet):
 @click.option('--race', default=None, help="A single race to run a search for.")
 @click.option('-d', '--maxdepth', default=3, help="The max depth to search for each race.")
 @click.option('-u', '--until', default=None, help="Only retrieve tweets before date (YYYY-MM-DD).")
+@click.option('--dictionary', default=False, is_flag=True,
+              help="Compress each page with the race's newest trained dictionary (see train-dictionary).")
+@click.option('--storage', default=smetcollect.bundle.storage.default_storage,
+              type=click.Choice(smetcollect.bundle.storage.storage_names()),
+              help="Store the pages of a run as files in a folder, or in one segment file or sqlite db per run.")
 @click.argument('bundle', type=click.Path(exists=True))
 @click.pass_context
-def collect(ctx, limit, resume, race, maxdepth, until, bundle):
+def collect(ctx, limit, resume, race, maxdepth, until, dictionary, storage, bundle):
     """Collect data for a bundle.
 
     Perform a search against the twitter API to get the latest data for the races in the bundle. The search
@@ -89,7 +97,9 @@ def collect(ctx, limit, resume, race, maxdepth, until, bundle):
             click.echo('Capturing data for bundle {}'.format(click.format_filename(bundle)))
 
     status = initialized_status_for_bundle(bundle)
-    collector_config = smetcollect.CollectorConfig(wait_period=limit, max_depth=maxdepth)
+    status.raw_storage = smetcollect.bundle.storage.storage_for_name(storage)
+    save_func = smetcollect.collect.collect.dictionary_results_save_func if dictionary else None
+    collector_config = smetcollect.CollectorConfig(wait_period=limit, save_func=save_func, max_depth=maxdepth)
     collector = smetcollect.TweetCollector(status, collector_config, resume=resume, race=race, until=until)
     collector.run()
 
@@ -122,9 +132,14 @@ def import_raw(ctx, importroot, bundle):
 @click.option('--race', default=None, help="A single race to run prune.")
 @click.option('-d', '--maxdepth', default=5, help="The max number of runs to prune.")
 @click.option('-s', '--spark', 'master', default=None, help="Set non-empty to use spark, otherwise jq is used")
+@click.option('-z', '--gzip', 'compress_pruned', default=False, is_flag=True, help="Write the pruned data gzipped.")
+@click.option('-l', '--lines', 'lines_pruned', default=False, is_flag=True,
+              help="Write the pruned data as json lines with an index.")
+@click.option('--columns', 'columnize', default=False, is_flag=True,
+              help="Also append the pruned data to the columns of each race.")
 @click.argument('bundle', type=click.Path(exists=True))
 @click.pass_context
-def prune(ctx, race, maxdepth, master, bundle):
+def prune(ctx, race, maxdepth, master, compress_pruned, lines_pruned, columnize, bundle):
     """Prune down bundle run data to the relevant data.
 
     :param master: If empty, use jq. If local[n], use a local
@@ -133,7 +148,8 @@ def prune(ctx, race, maxdepth, master, bundle):
     """
     quiet = ctx.obj['quiet']
     status = initialized_status_for_bundle(bundle)
-    pruner_config = smetcollect.process.prune.PrunerConfig(None, maxdepth)
+    pruner_config = smetcollect.process.prune.PrunerConfig(None, maxdepth, compress_pruned=compress_pruned,
+                                                           lines_pruned=lines_pruned)
     if master is None:
         engine_config = smetcollect.process.jq.JqEngineConfig()
         engine = smetcollect.process.jq.JqEngine(status, engine_config)
@@ -150,6 +166,43 @@ def prune(ctx, race, maxdepth, master, bundle):
     pruner = smetcollect.process.prune.Pruner(status, pruner_config, race)
     if engine.prerequisites_satisfied():
         engine.run(pruner)
+    if columnize:
+        smetcollect.Columnizer(status, race).run()
+
+    if not quiet:
+        click.echo('Done.')
+
+
+@cli.command()
+@click.option('--race', default=None, help="A single race to process.")
+@click.option('-d', '--maxdepth', default=5, help="The max number of runs to process.")
+@click.option('-p', '--processes', default=1, help="The number of processes to use.")
+@click.option('-c', '--compress', default=False, is_flag=True, help="Also compress the raw data while reading it.")
+@click.option('-z', '--gzip', 'compress_pruned', default=False, is_flag=True, help="Write the pruned data gzipped.")
+@click.option('-l', '--lines', 'lines_pruned', default=False, is_flag=True,
+              help="Write the pruned data as json lines with an index.")
+@click.option('--columns', 'columnize', default=False, is_flag=True,
+              help="Also append the pruned data to the columns of each race.")
+@click.argument('bundle', type=click.Path(exists=True))
+@click.pass_context
+def process(ctx, race, maxdepth, processes, compress, compress_pruned, lines_pruned, columnize, bundle):
+    """Prune runs and summarize metadata and hashtags in one pass.
+
+    Reads the raw data of each run once and writes the pruned data, the metadata summary, and the hashtag summary.
+    With --compress, the compressed archive of the raw data is written in the same pass.
+    """
+    quiet = ctx.obj['quiet']
+    status = initialized_status_for_bundle(bundle)
+    if not quiet:
+        click.echo('Processing data for bundle {}'.format(click.format_filename(bundle)))
+
+    engine = smetcollect.PyEngine(status, smetcollect.PyEngineConfig(processes))
+    processor_config = smetcollect.FusedProcessorConfig(status, maxdepth, compress=compress,
+                                                        compress_pruned=compress_pruned, lines_pruned=lines_pruned)
+    processor = smetcollect.FusedProcessor(status, processor_config, race)
+    engine.run(processor)
+    if columnize:
+        smetcollect.Columnizer(status, race).run()
 
     if not quiet:
         click.echo('Done.')
@@ -158,13 +211,20 @@ def prune(ctx, race, maxdepth, master, bundle):
 @cli.command()
 @click.option('--race', default=None, help="A single race to run compress.")
 @click.option('-d', '--maxdepth', default=5, help="The max number of runs to compress.")
+@click.option('--codec', default=smetcollect.bundle.archive.default_codec,
+              type=click.Choice(smetcollect.bundle.archive.codec_names()), help="The codec to compress with.")
+@click.option('--level', default=None, type=int, help="The compression level. Defaults to the codec's default.")
+@click.option('-j', '--workers', default=None, type=int, help="The number of compression threads. Defaults to #cpus.")
 @click.argument('bundle', type=click.Path(exists=True))
 @click.pass_context
-def compress(ctx, race, maxdepth, bundle):
+def compress(ctx, race, maxdepth, codec, level, workers, bundle):
     """Compress pruned runs in a bundle.
     """
     quiet = ctx.obj['quiet']
-    config = smetcollect.CompressorConfig(maxdepth)
+    try:
+        config = smetcollect.CompressorConfig(maxdepth, codec, level, workers)
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint='--codec')
     if not quiet:
         click.echo('Compressing data for bundle {}'.format(click.format_filename(bundle)))
 
@@ -176,6 +236,37 @@ def compress(ctx, race, maxdepth, bundle):
         click.echo('Done.')
 
 
+@cli.command()
+@click.option('--race', default=None, help="A single race to run recompress.")
+@click.option('-d', '--maxdepth', default=5, help="The max number of runs to recompress.")
+@click.option('--codec', default=smetcollect.bundle.archive.dense_codec(),
+              type=click.Choice(smetcollect.bundle.archive.codec_names()), help="The codec to recompress with.")
+@click.option('--level', default=None, type=int, help="The compression level. Defaults to the codec's default.")
+@click.option('--age', default=7, help="Only recompress the archives of runs at least this many days old.")
+@click.option('-j', '--workers', default=None, type=int, help="The number of compression threads. Defaults to #cpus.")
+@click.argument('bundle', type=click.Path(exists=True))
+@click.pass_context
+def recompress(ctx, race, maxdepth, codec, level, age, workers, bundle):
+    """Recompress the archives of old runs at a higher ratio.
+    """
+    quiet = ctx.obj['quiet']
+    try:
+        config = smetcollect.RecompressorConfig(maxdepth, codec, level, age, workers)
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint='--codec')
+    if not quiet:
+        click.echo('Recompressing data for bundle {}'.format(click.format_filename(bundle)))
+
+    status = initialized_status_for_bundle(bundle)
+    recompressor = smetcollect.Recompressor(status, config, race)
+    recompressor.run()
+
+    if not quiet:
+        click.echo('Done.')
+    if recompressor.failed_runs:
+        ctx.exit(1)
+
+
 @cli.command()
 @click.option('--race', default=None, help="A single race to run uncompress.")
 @click.option('-d', '--maxdepth', default=5, help="The max number of runs to uncompress.")
@@ -197,12 +288,278 @@ def uncompress(ctx, race, maxdepth, bundle):
         click.echo('Done.')
 
 
+@cli.command('train-dictionary')
+@click.option('--race', default=None, help="A single race to train a dictionary for.")
+@click.option('--kind', default="zlib", type=click.Choice(["zlib", "zstd"]), help="The kind of dictionary.")
+@click.option('-n', '--samples', default=1000, help="The max number of pages to train on.")
+@click.option('--size', default=None, type=int, help="The size of the dictionary in bytes.")
+@click.argument('bundle', type=click.Path(exists=True))
+@click.pass_context
+def train_dictionary(ctx, race, kind, samples, size, bundle):
+    """Train compression dictionaries from the raw pages of races.
+
+    Each training adds a new version; data compressed with older versions stays readable.
+    """
+    quiet = ctx.obj['quiet']
+    try:
+        config = smetcollect.DictionaryTrainerConfig(kind, samples, size)
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint='--kind')
+    if not quiet:
+        click.echo('Training dictionaries for bundle {}'.format(click.format_filename(bundle)))
+
+    status = initialized_status_for_bundle(bundle)
+    trainer = smetcollect.DictionaryTrainer(status, config, race)
+    trainer.run()
+
+    if not quiet:
+        click.echo('Done.')
+
+
+@cli.command('benchmark-dictionary')
+@click.option('--race', default=None, help="A single race to benchmark.")
+@click.argument('bundle', type=click.Path(exists=True))
+@click.pass_context
+def benchmark_dictionary(ctx, race, bundle):
+    """Compare the dictionaries of races to tar -cjf on the newest run of each race.
+    """
+    status = initialized_status_for_bundle(bundle)
+    for race_obj in status.races_matching_slug(race):
+        runs = race_obj.runs.order_by(smetcollect.bundle.status_db.Run.start.desc())
+        readers = [status.raw_reader(race_obj, run) for run in runs]
+        readers = [reader for reader in readers if reader.exists()]
+        if len(readers) < 1:
+            continue
+        store = smetcollect.bundle.dictionary.DictionaryStore(status.dictionary_folder_path_for_race(race_obj))
+        dictionaries = [store.get(entry["version"]) for entry in store.index()]
+        pages = list(readers[0].pages())
+        click.echo('{} ({} pages from {})'.format(race_obj.name, len(pages), readers[0].source()))
+        for result in smetcollect.bundle.dictionary.benchmark(pages, dictionaries):
+            click.echo('\t{:<32} ratio {:6.2f}  compress {:8.2f} MB/s  decompress {:8.2f} MB/s'.format(
+                *result.values()))
+
+
+@cli.command()
+@click.option('--race', default=None, help="A single race to run verify.")
+@click.option('-d', '--maxdepth', default=5, help="The max number of runs to verify.")
+@click.option('--add-missing', default=False, is_flag=True,
+              help="Write manifests for archives that do not have one, trusting the archive contents.")
+@click.argument('bundle', type=click.Path(exists=True))
+@click.pass_context
+def verify(ctx, race, maxdepth, add_missing, bundle):
+    """Verify compressed runs against their manifests.
+    """
+    quiet = ctx.obj['quiet']
+    config = smetcollect.VerifierConfig(maxdepth, add_missing)
+    if not quiet:
+        click.echo('Verifying data for bundle {}'.format(click.format_filename(bundle)))
+
+    status = initialized_status_for_bundle(bundle)
+    verifier = smetcollect.Verifier(status, config, race)
+    verifier.run()
+
+    if not quiet:
+        click.echo('Done.')
+    if verifier.failed_runs:
+        ctx.exit(1)
+
+
+@cli.command()
+@click.option('--race', default=None, help="A single race to run compact.")
+@click.option('--period', default="month",
+              type=click.Choice(sorted(smetcollect.bundle.container.period_formats.keys())),
+              help="Put the archives of each day or each month in one container.")
+@click.option('--age', default=30, help="Only compact the archives of runs at least this many days old.")
+@click.argument('bundle', type=click.Path(exists=True))
+@click.pass_context
+def compact(ctx, race, period, age, bundle):
+    """Move the archives of old runs into per-day or per-month containers.
+    """
+    quiet = ctx.obj['quiet']
+    config = smetcollect.CompactorConfig(period, age)
+    if not quiet:
+        click.echo('Compacting data for bundle {}'.format(click.format_filename(bundle)))
+
+    status = initialized_status_for_bundle(bundle)
+    compactor = smetcollect.Compactor(status, config, race)
+    compactor.run()
+
+    if not quiet:
+        click.echo('Done.')
+    if compactor.failed_runs:
+        ctx.exit(1)
+
+
+@cli.command()
+@click.option('--race', default=None, help="A single race to run partition.")
+@click.option('--period', default="day", type=click.Choice(smetcollect.bundle.pruned.period_types),
+              help="Put the pruned data of each day or each week in one partition.")
+@click.option('--age', default=1, help="Only partition the pruned data of runs at least this many days old.")
+@click.argument('bundle', type=click.Path(exists=True))
+@click.pass_context
+def partition(ctx, race, period, age, bundle):
+    """Merge the pruned data of old runs into per-day or per-week partitions.
+    """
+    quiet = ctx.obj['quiet']
+    config = smetcollect.PartitionerConfig(period, age)
+    if not quiet:
+        click.echo('Partitioning data for bundle {}'.format(click.format_filename(bundle)))
+
+    status = initialized_status_for_bundle(bundle)
+    partitioner = smetcollect.Partitioner(status, config, race)
+    partitioner.run()
+
+    if not quiet:
+        click.echo('Done.')
+    if partitioner.failed_runs:
+        ctx.exit(1)
+
+
+@cli.command()
+@click.option('--race', default=None, help="A single race to run columns.")
+@click.argument('bundle', type=click.Path(exists=True))
+@click.pass_context
+def columns(ctx, race, bundle):
+    """Append the pruned data of runs to the columns of their race.
+
+    The columns are in columns/<race>/ and can be read as numpy arrays with smetcollect.bundle.columns.ColumnStore.
+    """
+    quiet = ctx.obj['quiet']
+    if not quiet:
+        click.echo('Columnizing data for bundle {}'.format(click.format_filename(bundle)))
+
+    status = initialized_status_for_bundle(bundle)
+    smetcollect.Columnizer(status, race).run()
+
+    if not quiet:
+        click.echo('Done.')
+
+
+@cli.command()
+@click.option('--race', default=None, help="A single race to analyze.")
+@click.option('-d', '--maxdepth', default=0, help="The max number of runs to analyze. 0 analyzes all.")
+@click.argument('bundle', type=click.Path(exists=True))
+@click.pass_context
+def cooccur(ctx, race, maxdepth, bundle):
+    """Count the hashtags used together in pruned runs and merge the counts into the matrix of their race.
+    """
+    quiet = ctx.obj['quiet']
+    status = initialized_status_for_bundle(bundle)
+    if not quiet:
+        click.echo('Analyzing hashtag co-occurrence for bundle {}'.format(click.format_filename(bundle)))
+
+    engine = smetcollect.PyEngine(status, smetcollect.PyEngineConfig())
+    config = smetcollect.CooccurrenceAnalyzerConfig(status, maxdepth)
+    engine.run(smetcollect.GenericAnalyzer(status, config, race))
+    for race_obj in status.races_matching_slug(race):
+        folder = status.analysis_result_path(race_obj, "cooccur")
+        if os.path.exists(folder):
+            smetcollect.bundle.cooccur.update_race_matrix(folder)
+
+    if not quiet:
+        click.echo('Done.')
+
+
+@cli.command()
+@click.option('--race', default=None, help="A single race to aggregate.")
+@click.option('-d', '--maxdepth', default=0, help="The max number of runs to aggregate. 0 aggregates all.")
+@click.argument('bundle', type=click.Path(exists=True))
+@click.pass_context
+def aggregate(ctx, race, maxdepth, bundle):
+    """Add pruned runs to the per-hour aggregates of their race.
+    """
+    quiet = ctx.obj['quiet']
+    status = initialized_status_for_bundle(bundle)
+    if not quiet:
+        click.echo('Aggregating data for bundle {}'.format(click.format_filename(bundle)))
+
+    engine = smetcollect.PyEngine(status, smetcollect.PyEngineConfig())
+    config = smetcollect.AggregatesAnalyzerConfig(status, maxdepth)
+    engine.run(smetcollect.GenericAnalyzer(status, config, race))
+
+    if not quiet:
+        click.echo('Done.')
+
+
+@cli.command()
+@click.option('--race', default=None, help="A single race to report on.")
+@click.option('--days', default=7, help="The length of the window in days.")
+@click.option('--end', default=None, help="The end of the window, as YYYY-MM-DD-HH in UTC. Defaults to now.")
+@click.argument('bundle', type=click.Path(exists=True))
+@click.pass_context
+def rolling(ctx, race, days, end, bundle):
+    """Print the tweets, favorites, retweets and users of each candidate over a window, from the aggregates.
+    """
+    status = initialized_status_for_bundle(bundle)
+    end = datetime.strptime(end, "%Y-%m-%d-%H") if end is not None else status.datetime_provider()
+    start = end - timedelta(days=days)
+    result = OrderedDict()
+    for race_obj in status.races_matching_slug(race):
+        path = status.aggregates_path_for_race(race_obj)
+        if not os.path.exists(path):
+            continue
+        with smetcollect.bundle.aggregates.RaceAggregates(path) as aggregates:
+            result[race_obj.slug] = aggregates.window(start, end)
+    click.echo(json.dumps(result, indent=2))
+
+
+@cli.command('top-hashtags')
+@click.option('--race', default=None, help="A single race to report on.")
+@click.option('--days', default=7, help="The length of the window in days.")
+@click.option('--end', default=None, help="The end of the window, as YYYY-MM-DD-HH in UTC. Defaults to now.")
+@click.option('-n', '--top', default=10, help="The number of hashtags to print for each candidate.")
+@click.argument('bundle', type=click.Path(exists=True))
+@click.pass_context
+def top_hashtags(ctx, race, days, end, top, bundle):
+    """Print the most used hashtags of each candidate over a window, with error bounds, from the aggregates.
+    """
+    status = initialized_status_for_bundle(bundle)
+    end = datetime.strptime(end, "%Y-%m-%d-%H") if end is not None else status.datetime_provider()
+    start = end - timedelta(days=days)
+    result = OrderedDict()
+    for race_obj in status.races_matching_slug(race):
+        path = status.aggregates_path_for_race(race_obj)
+        if not os.path.exists(path):
+            continue
+        with smetcollect.bundle.aggregates.RaceAggregates(path) as aggregates:
+            result[race_obj.slug] = aggregates.top_hashtags(start, end, top)
+    click.echo(json.dumps(result, indent=2))
+
+
+@cli.command()
+@click.option('--race', default=None, help="A single race to report on.")
+@click.option('--days', default=7, help="The length of the window in days.")
+@click.option('--end', default=None, help="The end of the window, as YYYY-MM-DD-HH in UTC. Defaults to now.")
+@click.argument('bundle', type=click.Path(exists=True))
+@click.pass_context
+def distinct(ctx, race, days, end, bundle):
+    """Print the estimated distinct users and retweeted tweets of each candidate over the runs in a window, merged
+    from the sketches written by the metadata analysis.
+    """
+    status = initialized_status_for_bundle(bundle)
+    end = datetime.strptime(end, "%Y-%m-%d-%H") if end is not None else status.datetime_provider()
+    start = end - timedelta(days=days)
+    Run = smetcollect.bundle.status_db.Run
+    sketches_analysis_type = smetcollect.bundle.sketch.sketches_analysis_type
+    result = OrderedDict()
+    for race_obj in status.races_matching_slug(race):
+        runs = race_obj.runs.filter(Run.start >= start, Run.start < end).order_by(Run.start)
+        paths = [status.analysis_result_path(race_obj, sketches_analysis_type, run) for run in runs]
+        result[race_obj.slug] = smetcollect.bundle.sketch.distinct_counts([p for p in paths if os.path.exists(p)])
+    click.echo(json.dumps(result, indent=2))
+
+
 @cli.command()
 @click.option('--race', default=None, help="A single race to run rebuild.")
 @click.option('-d', '--maxdepth', default=5, help="The max number of runs to rebuild.")
+@click.option('-z', '--gzip', 'compress_pruned', default=False, is_flag=True,
+              help="Write the pruned data gzipped. By default, runs keep the format they were pruned in.")
+@click.option('-l', '--lines', 'lines_pruned', default=False, is_flag=True,
+              help="Write the pruned data as json lines with an index. By default, runs keep the format they were "
+                   "pruned in.")
 @click.argument('bundle', type=click.Path(exists=True))
 @click.pass_context
-def rebuild(ctx, race, maxdepth, bundle):
+def rebuild(ctx, race, maxdepth, compress_pruned, lines_pruned, bundle):
     """Rebuild prune data in a bundle.
     """
     quiet = ctx.obj['quiet']
@@ -211,9 +568,13 @@ def rebuild(ctx, race, maxdepth, bundle):
         click.echo('Rebuilding data for bundle {}'.format(click.format_filename(bundle)))
 
     status = initialized_status_for_bundle(bundle)
+    pruner_config = None
+    if compress_pruned or lines_pruned:
+        pruner_config = smetcollect.process.prune.PrunerConfig(status, maxdepth, compress_pruned=compress_pruned,
+                                                               lines_pruned=lines_pruned)
     engine_config = smetcollect.JqEngineConfig()
     engine = smetcollect.JqEngine(status, engine_config)
-    rebuilder = smetcollect.Rebuilder(engine, config, race)
+    rebuilder = smetcollect.Rebuilder(engine, config, race, pruner_config)
     rebuilder.run()
 
     if not quiet:
@@ -268,17 +629,32 @@ def purge(ctx, race, run, execute, bundle):
 @cli.command()
 @click.option('-d', '--maxdepth', default=3, help="The max number of runs to analyze.")
 @click.option('-s', '--skipcollect', default=False, is_flag=True, help="Skip collecting data from twitter.")
+@click.option('-f', '--fused', default=False, is_flag=True,
+              help="Prune, summarize, and compress each run in a single read of the raw data.")
+@click.option('-t', '--tiered', default=False, is_flag=True,
+              help="Compress with the fastest codec, leaving the recompress command to shrink old runs.")
+@click.option('-z', '--gzip', 'compress_pruned', default=False, is_flag=True, help="Write the pruned data gzipped.")
+@click.option('-l', '--lines', 'lines_pruned', default=False, is_flag=True,
+              help="Write the pruned data as json lines with an index.")
+@click.option('--columns', 'columnize', default=False, is_flag=True,
+              help="Also append the pruned data to the columns of each race.")
+@click.option('-w', '--workers', default=None, type=int,
+              help="The number of threads each job runs stages on. Defaults to the number of cpus.")
+@click.option('-j', '--jobs', default=1, help="The number of processes to split the races among.")
+@click.option('--ledger', default=None, type=click.Path(),
+              help="Share the rate limit budget of the credentials with other collectors through this folder.")
 @click.argument('bundle', type=click.Path(exists=True))
 @click.pass_context
-def pipeline(ctx, maxdepth, skipcollect, bundle):
+def pipeline(ctx, maxdepth, skipcollect, fused, tiered, compress_pruned, lines_pruned, columnize, workers, jobs,
+             ledger, bundle):
     """Run the full SMET pipeline once. Logs are in the bundle log folder.
     - Collect runs
-    - [start spark]
     - Prune
-    - Analyze
     - Compress
     - Archive
-    - [stop spark]
+
+    Each run moves on to the next stage as soon as it is ready, so the stages of different runs overlap. With
+    more than one job, the races are split among several processes.
     """
     quiet = ctx.obj['quiet']
     status = initialized_status_for_bundle(bundle)
@@ -292,46 +668,79 @@ def pipeline(ctx, maxdepth, skipcollect, bundle):
     if not quiet:
         click.echo('{} Running pipeline for bundle {}...'.format(datetime.now().strftime("%Y-%m-%d"),
                                                                  click.format_filename(bundle)))
+        click_echo('Using python' if fused else 'Using jq')
 
-    # collect
-    if not skipcollect:
-        if not quiet:
-            click_echo('-- Collecting tweets')
-        collector_config = smetcollect.CollectorConfig(wait_period=1.0, max_depth=maxdepth)
-        collector = smetcollect.TweetCollector(status, collector_config)
-        collector.run()
+    codec = smetcollect.bundle.archive.fast_codec() if tiered else smetcollect.bundle.archive.default_codec
+    config = smetcollect.PipelineConfig(maxdepth, skipcollect, fused, codec, compress_pruned, lines_pruned,
+                                        columnize, workers, rate_ledger_folder=ledger)
+    if jobs > 1:
+        failures = smetcollect.ShardedPipeline(status, config, jobs).run()
     else:
-        if not quiet:
-            click_echo('-- Skip Collecting tweets')
+        failures = smetcollect.Pipeline(status, config).run()
 
-    engine_config = smetcollect.JqEngineConfig()
-    engine = smetcollect.JqEngine(status, engine_config)
-    if not quiet:
-        click.echo('Using jq')
+    file_progress.close()
+    if failures:
+        status.move_log_to_fail(log_file_path)
+    else:
+        status.move_log_to_success(log_file_path)
 
-    # prune
     if not quiet:
-        click_echo('-- Pruning tweets')
-    pruner_config = smetcollect.process.prune.PrunerConfig(None, maxdepth)
-    pruner = smetcollect.process.prune.Pruner(status, pruner_config)
-    if engine.prerequisites_satisfied():
-        engine.run(pruner)
+        for name in failures.keys():
+            click_echo('Failed: {}'.format(name))
+        click_echo('Done.')
 
-    # compress
-    if not quiet:
-        click_echo('-- Compressing tweets')
-    compressor_config = smetcollect.CompressorConfig(maxdepth)
-    compressor = smetcollect.Compressor(status, compressor_config)
-    compressor.run()
 
-    # archive -- use the same config as for the compressor
+@cli.command()
+@click.option('-d', '--maxdepth', default=3, help="The max number of runs to analyze.")
+@click.option('-s', '--skipcollect', default=False, is_flag=True, help="Skip collecting data from twitter.")
+@click.option('-f', '--fused', default=False, is_flag=True,
+              help="Prune, summarize, and compress each run in a single read of the raw data.")
+@click.option('-t', '--tiered', default=False, is_flag=True,
+              help="Compress with the fastest codec, leaving the recompress command to shrink old runs.")
+@click.option('-w', '--workers', default=None, type=int,
+              help="The number of threads each bundle runs stages on. Defaults to the number of cpus.")
+@click.option('-j', '--jobs', default=None, type=int,
+              help="The most bundles to run at a time. Defaults to all of them.")
+@click.option('--ledger', default=smetcollect.collect.ledger.default_ledger_folder, type=click.Path(),
+              help="The folder of the rate limit budgets shared by bundles with the same credentials.")
+@click.argument('bundles', nargs=-1, required=True, type=click.Path(exists=True))
+@click.pass_context
+def multi(ctx, maxdepth, skipcollect, fused, tiered, workers, jobs, ledger, bundles):
+    """Run the pipeline for several bundles in parallel.
+
+    Each bundle runs in its own process and writes its own pipeline log, as with the pipeline command. Bundles that
+    use the same twitter credentials share their rate limit budget through a ledger, so together they use each rate
+    limit window without going over.
+    """
+    quiet = ctx.obj['quiet']
+    codec = smetcollect.bundle.archive.fast_codec() if tiered else smetcollect.bundle.archive.default_codec
+    config = smetcollect.PipelineConfig(maxdepth, skipcollect, fused, codec, workers=workers,
+                                        rate_ledger_folder=ledger)
+    pipeline_jobs = smetcollect.PipelineJobs(jobs if jobs else len(bundles))
+
+    logs = []
+    for bundle in bundles:
+        status = initialized_status_for_bundle(bundle)
+        # Log to a file in each bundle instead of stdout
+        log_file_path = status.generate_running_log_file_path("pipeline")
+        file_progress = FileProgress(log_file_path)
+        file_progress.open()
+        pipeline_jobs.add(status, config, progress_func=file_progress.progress)
+        logs.append((status, log_file_path, file_progress))
+
     if not quiet:
-        click_echo('-- Archiving tweets')
-    archiver = smetcollect.Archiver(status, compressor_config)
-    archiver.run()
+        click.echo('{} Running pipeline for {} bundles...'.format(datetime.now().strftime("%Y-%m-%d"), len(bundles)))
+    results = pipeline_jobs.run()
 
-    file_progress.close()
-    status.move_log_to_success(log_file_path)
+    for bundle, (status, log_file_path, file_progress), failures in zip(bundles, logs, results):
+        file_progress.close()
+        if failures:
+            status.move_log_to_fail(log_file_path)
+        else:
+            status.move_log_to_success(log_file_path)
+        if not quiet:
+            outcome = 'failed {} stages'.format(len(failures)) if failures else 'done'
+            click_echo('{}: {}'.format(click.format_filename(bundle), outcome))
 
     if not quiet:
         click_echo('Done.')
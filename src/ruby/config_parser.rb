@@ -68,4 +68,27 @@ class SmetTask
   def outfolder
     @task_json['outfolder']
   end
+
+  # The archive to read the raw data from if the inpath folder has been archived
+  def rawarchive
+    @task_json['rawarchive']
+  end
+
+  # Write the pruned data gzipped
+  def compresspruned
+    @task_json['compresspruned']
+  end
+
+  # Write the pruned data as json lines
+  def linespruned
+    @task_json['linespruned']
+  end
+
+  # The pruned file of the run, plain json, gzipped json, or json lines, or the plain json path if there is none
+  def prunedpath
+    [".json", ".json.gz", ".jsonl"].each do | ext |
+      return inpath + ext if File.file?(inpath + ext)
+    end
+    inpath + ".json"
+  end
 end
@@ -53,18 +53,32 @@ def hashtag_counts(summary, run_name)
 end
 
 def summarize(run_path, outdir)
-  return unless File.file? run_path
+  if !File.file?(run_path)
+    # Runs merged into a partition no longer have their own pruned file
+    if File.file?(File.join(File.dirname(run_path), "partitions.json"))
+      puts "The pruned data for #{run_path} may be in a partition. Use the python engine."
+    end
+    return
+  end
 
   jq = "jq"
-  run_name = File.basename(run_path)
-  # drop the '.json' from the run name before passing to jq filter
-  base_summary = "#{jq} -c --arg runname #{run_name[0..-6]} -f #{filter_path} #{run_path}"
-  outpath = File.join(outdir, run_name)
+  # drop the '.json', '.json.gz' or '.jsonl' from the run name before passing to jq filter
+  run_name = File.basename(run_path).sub(/\.json(\.gz|l)?$/, "")
+  if run_path.end_with?(".jsonl")
+    # Slurp the lines into the array the filter expects
+    base_summary = "#{jq} -c -s --arg runname #{run_name} -f #{filter_path} #{run_path}"
+  elsif run_path.end_with?(".gz")
+    # Decompress the pruned data as it is read
+    base_summary = "gzip -dc #{run_path} | #{jq} -c --arg runname #{run_name} -f #{filter_path}"
+  else
+    base_summary = "#{jq} -c --arg runname #{run_name} -f #{filter_path} #{run_path}"
+  end
+  outpath = File.join(outdir, run_name + ".json")
 
   cmd = "#{base_summary}"
   result_json = run_cmd(cmd)
   result = JSON.parse(result_json)
-  result = hashtag_counts(result, run_name[0..-6])
+  result = hashtag_counts(result, run_name)
   File.open(outpath, "w") do |f|
     f.write(result.to_json)
   end
@@ -88,5 +102,5 @@ end
 
 config = SmetConfigParser.parse(ARGV[0])
 config.tasks.each do | task |
-  summarize(task.inpath + ".json", task.outfolder)
+  summarize(task.prunedpath, task.outfolder)
 end
@@ -21,11 +21,25 @@ def filter_path
 end
 
 def summarize(run_path, outdir)
+  # Runs merged into a partition no longer have their own pruned file
+  if !File.file?(run_path) && File.file?(File.join(File.dirname(run_path), "partitions.json"))
+    puts "The pruned data for #{run_path} may be in a partition. Use the python engine."
+    return
+  end
+
   jq = "jq"
-  run_name = File.basename(run_path)
-  # drop the '.json' from the run name before passing to jq filter
-  base_summary = "#{jq} -c --arg runname #{run_name[0..-6]} -f #{filter_path} #{run_path}"
-  outpath = File.join(outdir, run_name)
+  # drop the '.json', '.json.gz' or '.jsonl' from the run name before passing to jq filter
+  run_name = File.basename(run_path).sub(/\.json(\.gz|l)?$/, "")
+  if run_path.end_with?(".jsonl")
+    # Slurp the lines into the array the filter expects
+    base_summary = "#{jq} -c -s --arg runname #{run_name} -f #{filter_path} #{run_path}"
+  elsif run_path.end_with?(".gz")
+    # Decompress the pruned data as it is read
+    base_summary = "gzip -dc #{run_path} | #{jq} -c --arg runname #{run_name} -f #{filter_path}"
+  else
+    base_summary = "#{jq} -c --arg runname #{run_name} -f #{filter_path} #{run_path}"
+  end
+  outpath = File.join(outdir, run_name + ".json")
 
   cmd = "#{base_summary} > #{outpath}"
   run_cmd(cmd)
@@ -49,5 +63,5 @@ end
 
 config = SmetConfigParser.parse(ARGV[0])
 config.tasks.each do | task |
-  summarize(task.inpath + ".json", task.outfolder)
+  summarize(task.prunedpath, task.outfolder)
 end
@@ -26,15 +26,57 @@ def prune_compress_path
   File.join(File.dirname(__FILE__), "..", "jq", "prune_compress.jq")
 end
 
-def prune(candidates, rundir, outdir)
+def prune(candidates, rundir, outdir, rawarchive, compresspruned, linespruned)
   jq = "jq"
-  files = File.join(rundir, "*")
-  base_prune = "#{jq} -c -f #{filter_path} #{files}"
+  if rawarchive && !File.directory?(rundir)
+    # Stream the pages out of the archive instead of extracting it. tar can only read the tar codecs.
+    if rawarchive.include?(".container/")
+      puts "Cannot read #{rawarchive}, which has been moved into a container, with jq. Use the python engine."
+      return
+    end
+    if ![".tar.bz2", ".tar.xz", ".tar.zst"].any? { |ext| rawarchive.end_with?(ext) }
+      puts "Cannot read #{rawarchive} with jq. Use the python engine."
+      return
+    end
+    # Pages compressed with a dictionary can only be read by python. Take the members from the manifest, since
+    # listing them with tar would decompress the whole archive. Archives without a manifest predate dictionaries.
+    manifestpath = rawarchive.sub(/\.tar\.(bz2|xz|zst)$/, ".manifest.json")
+    if File.file?(manifestpath) &&
+       JSON.parse(File.read(manifestpath))["members"].keys.any? { |member| member.end_with?(".zd") }
+      puts "Cannot read #{rawarchive} with jq. Use the python engine."
+      return
+    end
+    base_prune = "tar -xOf #{rawarchive} | #{jq} -c -f #{filter_path}"
+  else
+    # Pages stored in a segment file or sqlite db instead of a folder can only be read by python
+    if !File.directory?(rundir)
+      puts "The raw data for #{rundir} is not in a folder. Use the python engine."
+      return
+    end
+    # Pages compressed with a dictionary can only be read by python
+    if !Dir.glob(File.join(rundir, "*.zd")).empty?
+      puts "Cannot read the dictionary compressed pages in #{rundir} with jq. Use the python engine."
+      return
+    end
+    files = File.join(rundir, "*")
+    base_prune = "#{jq} -c -f #{filter_path} #{files}"
+  end
   uniquify = "#{jq} -c -s --argjson namemap '#{candidates}' -f #{prune_compress_path}"
   FileUtils.mkdir_p(outdir)
-  outpath = File.join(outdir, File.basename(rundir) + ".json")
-
-  cmd = "#{base_prune} | #{uniquify} > #{outpath}"
+  if linespruned
+    # One tweet per line. The python engine indexes the file the first time it reads it.
+    outpath = File.join(outdir, File.basename(rundir) + ".jsonl")
+    # The index of an earlier prune would no longer match the lines
+    indexpath = File.join(outdir, File.basename(rundir) + ".index.json")
+    File.delete(indexpath) if File.exist?(indexpath)
+    cmd = "#{base_prune} | #{uniquify} | #{jq} -c '.[]' > #{outpath}"
+  elsif compresspruned
+    outpath = File.join(outdir, File.basename(rundir) + ".json.gz")
+    cmd = "#{base_prune} | #{uniquify} | gzip -c > #{outpath}"
+  else
+    outpath = File.join(outdir, File.basename(rundir) + ".json")
+    cmd = "#{base_prune} | #{uniquify} > #{outpath}"
+  end
   run_cmd(cmd)
 end
 
@@ -56,5 +98,5 @@ end
 
 config = SmetConfigParser.parse(ARGV[0])
 config.tasks.each do | task |
-  prune(config.candidates_map, task.inpath, task.outfolder)
+  prune(config.candidates_map, task.inpath, task.outfolder, task.rawarchive, task.compresspruned, task.linespruned)
 end